@@ -5,18 +5,35 @@ from flask import Flask, render_template, request, session
 from flask_bootstrap import Bootstrap
 from flask_login import LoginManager
 from flask_migrate import Migrate
-from flask_sqlalchemy import SQLAlchemy
 from flask_babel import Babel, gettext
 # local imports
 from config import app_config
+from .cache import SharedCache
+from .choices import ChoiceCache
+from .dashboard import DashboardSnapshot
+from .database import SQLAlchemy
+from .pdf import PdfQueue
+from .prices import PriceCache
+from .principals import PrincipalCache
+from .profiling import QueryProfiler
+from .search import SearchIndex
 
 db = SQLAlchemy()
 login_manager = LoginManager()
+search_index = SearchIndex()
+shared_cache = SharedCache()
+choice_cache = ChoiceCache()
+price_cache = PriceCache()
+dashboard_snapshot = DashboardSnapshot()
+principal_cache = PrincipalCache()
+pdf_queue = PdfQueue()
+query_profiler = QueryProfiler()
 
 
 def create_app(config_name):
     if os.getenv('FLASK_CONFIG') == "production":
         app = Flask(__name__)
+        app.config.from_object(app_config['production'])
         app.config.update(
             SECRET_KEY=os.getenv('SECRET_KEY'),
             SQLALCHEMY_DATABASE_URI=os.getenv('SQLALCHEMY_DATABASE_URI')
@@ -29,6 +46,9 @@ def create_app(config_name):
     Bootstrap(app)
     db.init_app(app)
     login_manager.init_app(app)
+    pdf_queue.init_app(app)
+    shared_cache.init_app(app)
+    query_profiler.init_app(app)
     login_manager.login_message = "You must be logged in to access this page."
     login_manager.login_view = "auth.login"
     migrate = Migrate(app, db)
@@ -47,6 +67,16 @@ def create_app(config_name):
     # End Jason
 
     from app import models
+    from .pipeline import pipeline_rollups
+    search_index.init_app(app, db)
+    choice_cache.init_app(app, db, shared_cache)
+    price_cache.init_app(app, db, shared_cache)
+    principal_cache.init_app(app, db, shared_cache)
+    pipeline_rollups.init_app(app)
+    dashboard_snapshot.init_app(app, db, shared_cache)
+
+    from .commands import register_commands
+    register_commands(app)
 
     from .admin import admin as admin_blueprint
     app.register_blueprint(admin_blueprint, url_prefix='/admin')
@@ -1,15 +1,49 @@
+import six
+from flask import url_for
 from flask_wtf import FlaskForm
-from wtforms import StringField, SubmitField, FloatField, TextField, IntegerField, BooleanField, SelectField
+from flask_wtf.file import FileField
+from wtforms import StringField, SubmitField, FloatField, TextField, IntegerField, BooleanField, SelectField, TextAreaField, HiddenField
 from wtforms.ext.sqlalchemy.fields import QuerySelectField
 from wtforms.validators import DataRequired, Optional
 from wtforms.fields.html5 import DateField
 # Import fixes issues parsing DateFields:
 import wtforms.ext.dateutil
-from app import gettext
+from app import choice_cache, gettext
 
 from ..models import *
 
 
+class TypeaheadSelectField(SelectField):
+    """
+    A select box over one of the cached choice lists in app.choices
+
+    Only the selected option is rendered rather than the whole list; the
+    typeahead script fills in the options matching what the user types
+    from the admin.typeahead endpoint.
+    """
+
+    def __init__(self, label=None, validators=None, source=None, **kwargs):
+        super(TypeaheadSelectField, self).__init__(label, validators, choices=[], **kwargs)
+        self.source = source
+
+    def __call__(self, **kwargs):
+        kwargs.setdefault('data-typeahead', url_for('admin.typeahead', source=self.source))
+        return super(TypeaheadSelectField, self).__call__(**kwargs)
+
+    def iter_choices(self):
+        label = None
+        if self.data is not None:
+            label = choice_cache.label(self.source, self.data)
+        if label is None:
+            yield (u'', u'', True)
+        else:
+            yield (self.data, label, True)
+
+    def pre_validate(self, form):
+        if self.data is None or choice_cache.label(self.source, self.data) is None:
+            raise ValueError(self.gettext('Not a valid choice'))
+
+
 class DepartmentForm(FlaskForm):
     """
     Form for admin to add or edit a department
@@ -62,6 +96,8 @@ class CustomerForm(FlaskForm):
     status = StringField(gettext('Status'))
     rating = StringField(gettext('Rating'))
 
+    # the row version the form was filled from, see app.concurrency
+    version = HiddenField()
     submit = SubmitField(gettext('Submit'))
 
 
@@ -71,7 +107,7 @@ class ContactForm(FlaskForm):
     """
     # acc_code = QuerySelectField('Account Code', query_factory=lambda: Customer.query.all(),
     #                         get_label="acc_code") 
-    acc_code = SelectField(gettext('Account Code'), coerce=int)
+    acc_code = TypeaheadSelectField(gettext('Account Code'), source='customers', coerce=int)
     f_name = StringField(gettext('First Name'), validators=[DataRequired()])
     l_name = StringField(gettext('Last Name'), validators=[DataRequired()])
     phone = StringField(gettext('Phone Number'))
@@ -103,8 +139,8 @@ class ProductForm(FlaskForm):
     p_category = StringField(gettext('Product Category'))
     p_status = StringField(gettext('Product Status'))
     date_created = DateField(gettext('Date Created'))  #date field?
-    person_created = QuerySelectField(gettext('Person Created'), query_factory=lambda: Employee.query.all(),
-                            get_label="username")
+    person_created = TypeaheadSelectField(gettext('Person Created'), source='employees',
+                                          coerce=six.text_type)
     remarks = TextField(gettext('Remarks'))
 
     submit = SubmitField(gettext('Submit'))
@@ -116,11 +152,11 @@ class QuotationForm(FlaskForm):
     """
     # acc_code = QuerySelectField('Account Code', query_factory=lambda: Customer.query.all(),
     #                         get_label="acc_code", id='acc_code')   
-    acc_code = SelectField(gettext('Account Code'), id='acc_code', coerce=int)
-    contact = SelectField(gettext('Contact'), id='contacts', coerce=int, validators=[Optional()])
+    acc_code = TypeaheadSelectField(gettext('Account Code'), source='customers', id='acc_code', coerce=int)
+    contact = TypeaheadSelectField(gettext('Contact'), source='contacts', id='contacts', coerce=int,
+                                   validators=[Optional()])
     q_num = IntegerField(gettext('Quotation Number'), validators=[DataRequired()])
-    e_id = QuerySelectField(gettext('Employee'), query_factory=lambda: Employee.query.all(),
-                            get_label="username")
+    e_id = TypeaheadSelectField(gettext('Employee'), source='employees', coerce=six.text_type)
     date = DateField(gettext('Quotaton Date'))
     revision = StringField(gettext('Revision'))
     pay_terms = SelectField(gettext('Payment Terms'), choices=[('None', ''),
@@ -145,6 +181,7 @@ class QuotationForm(FlaskForm):
     q_note = TextField(gettext('Quotation Note'))
     #q_amount = IntegerField('Quote Amount')
 
+    version = HiddenField()
     submit = SubmitField(gettext('Submit'))
 
 
@@ -152,8 +189,7 @@ class OpportunityForm(FlaskForm):
     """
     Form for admin to add or edit an opportunity
     """
-    q_num = QuerySelectField(gettext('Quotation Number'), query_factory=lambda: Quotation.query.all(),
-                            get_label="q_num")       
+    q_num = TypeaheadSelectField(gettext('Quotation Number'), source='quotations', coerce=int)
     source_of_lead = StringField(gettext('Source of Lead'))
     sale_ref_fee = StringField(gettext('Sales referal Fee'))
     competitors = IntegerField(gettext('Competitors'))
@@ -171,6 +207,7 @@ class OpportunityForm(FlaskForm):
     integrator = StringField(gettext('Integrator'))
     region = StringField(gettext('Region'))
     
+    version = HiddenField()
     submit = SubmitField(gettext('Submit'))
 
 
@@ -180,8 +217,8 @@ class Quotation_DetailForm(FlaskForm):
     """
     #q_num = QuerySelectField('Quotation Number', query_factory=lambda: Quotation.query.all(),
     #                        get_label="q_num") 
-    q_num = SelectField(gettext('Quotation Number'), coerce=int)    
-    p_num = SelectField(gettext('Product Number'), coerce=int, id='product')           
+    q_num = TypeaheadSelectField(gettext('Quotation Number'), source='quotations', coerce=int)
+    p_num = TypeaheadSelectField(gettext('Product Number'), source='products', coerce=int, id='product')
     # p_num = QuerySelectField('Product Number', query_factory=lambda: Product.query.all(),
     #                         get_label="p_number", id='product')
     p_name = StringField(gettext('Product Name'), id='product_name')
@@ -191,9 +228,35 @@ class Quotation_DetailForm(FlaskForm):
     q_price = FloatField(gettext('Quote Price'), id='quote_price')#, validators=[DataRequired()])       
     option = BooleanField(gettext('Optional'))
 
+    version = HiddenField()
     submit = SubmitField(gettext('Submit'))
 
 
+class QuotationLinesForm(FlaskForm):
+    """
+    Form for admin to add many lines to a quotation at once, pasted from a
+    spreadsheet or uploaded as CSV
+    """
+    lines = TextAreaField(gettext('Lines'), render_kw={'rows': 15})
+    csv_file = FileField(gettext('CSV File'))
+
+    submit = SubmitField(gettext('Add Lines'))
+
+
+class BulkDeleteForm(FlaskForm):
+    """
+    Form for admin to delete the rows ticked in a list
+    """
+    submit = SubmitField(gettext('Delete Selected'))
+
+
+class CopyQuotationsForm(FlaskForm):
+    """
+    Form for admin to copy all of a customer's quotations
+    """
+    submit = SubmitField(gettext('Copy Quotations'))
+
+
 class SearchForm(FlaskForm):
     search_string = StringField(gettext('Search'))
 
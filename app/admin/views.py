@@ -1,27 +1,130 @@
-from flask import abort, flash, redirect, render_template, url_for, make_response, request, jsonify, session
+from flask import abort, current_app, flash, redirect, render_template, url_for, make_response, request, jsonify, session, send_file
 from flask_login import current_user, login_required
-import pdfkit
 
 from . import admin
 from forms import *
-from .. import db
+from .. import choice_cache, db, pdf_queue, price_cache, query_profiler, search_index, shared_cache
+from ..choices import SOURCES
+from ..cloning import clone_quotation, clone_quotations
+from ..concurrency import CONFLICT_MESSAGE, EditConflict, check_version, retry_on_conflict
+from ..database import read_only
+from ..deletion import delete_customers, delete_products, delete_quotations
+from ..documents import document_fingerprint, load_quotation_document
+from ..export import WRITERS as EXPORT_WRITERS, export_response
+from ..lines import LineErrors, add_lines, parse_lines
+from ..listing import ListEngine
+from ..lookups import contact_info, contact_name, customer_info, lookup, product_info
+from ..pipeline import forecast, rollup_frame, weighted_pipeline, win_rates
 from ..models import *
+from ..totals import apply_line_change, line_snapshot
+
+from collections import OrderedDict
+
+from sqlalchemy import false, or_
+from sqlalchemy.inspection import inspect
+from sqlalchemy.orm.exc import StaleDataError
+
+
+# Column sets shown by each list template, anything else is left unloaded
+customer_list = ListEngine(Customer, ('c_id', 'acc_code', 'f_name', 'l_name',
+                                      'comp_name', 'email', 'phone'),
+                           sortable=('acc_code', 'comp_name'))
+contact_list = ListEngine(Contact, ('contact_id', 'c_id', 'acc_code', 'f_name',
+                                    'l_name', 'email', 'phone'),
+                          sortable=('acc_code',))
+product_list = ListEngine(Product, ('p_id', 'p_number', 'p_name', 'unit_price',
+                                    'unit_cost', 'exchange_rate', 'cost_native',
+                                    'p_category', 'supplier'),
+                          sortable=('p_number',))
+quotation_list = ListEngine(Quotation, ('q_id', 'q_num', 'c_id', 'acc_code',
+                                        'contact_id', 'f_name', 'l_name', 'e_id',
+                                        'date', 'q_amount'),
+                            sortable=('q_num', 'acc_code'))
+opportunity_list = ListEngine(Opportunity, ('o_id', 'q_id', 'q_num', 'close_date',
+                                            'potential_money', 'probable_money',
+                                            'actual_money', 'revenue'),
+                              sortable=('q_num',))
+quotation_detail_list = ListEngine(Quotation_Detail, ('quote_detail_id', 'q_id', 'q_num',
+                                                      'p_id', 'p_num', 'p_name', 'quantity',
+                                                      'discount', 'q_price', 'option'),
+                                   sortable=('q_num', 'p_num'))
+
+# The columns the pipeline report can be grouped by, with their headings
+PIPELINE_GROUPS = OrderedDict([('sales_stage', 'Sales Stage'), ('region', 'Region'),
+                               ('family', 'Family'), ('rev_category', 'Revenue Category')])
+
+
+def list_page(engine, query, page_num):
+    """
+    Fetch one page of a list view, following the cursor and sort in the url
+    """
+    return engine.page(query, page_num,
+                       after=request.args.get('after'),
+                       before=request.args.get('before'),
+                       sort=request.args.get('sort'))
+
+
+# Models whose list views can be exported, by the name in the export url
+EXPORTS = {
+    'customers': Customer,
+    'contacts': Contact,
+    'products': Product,
+    'quotations': Quotation,
+    'opportunities': Opportunity,
+    'quotation_details': Quotation_Detail,
+}
+
+
+def quotation_detail_matches(search):
+    # quotation details are not in the search index, so they are searched
+    # with LIKE
+    pattern = "%" + search + "%"
+    return or_(Quotation_Detail.q_num.like(pattern),
+               Quotation_Detail.p_num.like(pattern),
+               Quotation_Detail.p_name.like(pattern))
+
+
+# How to search the exports whose model is not in the search index
+LIKE_SEARCHES = {
+    'quotation_details': quotation_detail_matches,
+}
+
+
+@admin.route('/<source>/export.<fmt>')
+@login_required
+@read_only
+def export_list(source, fmt):
+    """
+    Download every row of a list view, or only its search results when
+    searching, as CSV or xlsx
+    """
+    check_admin()
 
-import random
+    model = EXPORTS.get(source)
+    if model is None or fmt not in EXPORT_WRITERS:
+        abort(404)
+    query = model.query
+    search = request.args.get('search')
+    if search and source in LIKE_SEARCHES:
+        query = query.filter(LIKE_SEARCHES[source](search))
+    elif search:
+        # every match, not just the first page of them
+        ids = search_index.search(model, search, limit=0)
+        primary_key = inspect(model).primary_key[0]
+        query = query.filter(primary_key.in_(ids) if ids else false())
 
-from sqlalchemy import or_
+    return export_response(query, model, source, fmt)
 
 
 @admin.route('/background_process/change_language/')
 def change_language():
-    if session.get('language') == 'en':
-        session['language'] = 'ja'
-        current_user.language = 'ja'
-    else:
-        session['language'] = 'en'
-        current_user.language = 'en'
-
-    db.session.commit()
+    language = 'ja' if session.get('language') == 'en' else 'en'
+    session['language'] = language
+    if current_user.is_authenticated:
+        # current_user is a cached principal; saving the employee refreshes it
+        employee = Employee.query.get(int(current_user.get_id()))
+        employee.language = language
+        db.session.commit()
     return redirect(url_for('home.homepage'))
 
 
@@ -36,6 +139,7 @@ def check_admin():
 
 @admin.route('/departments/<int:page_num>/', methods=['GET', 'POST'])
 @login_required
+@read_only
 def list_departments(page_num):
     """
     List all departments
@@ -133,6 +237,7 @@ def delete_department(id):
 
 @admin.route('/customers/view/<int:id>', methods=['GET'])
 @login_required
+@read_only
 def view_customer(id):
     """
     View a customer
@@ -140,32 +245,38 @@ def view_customer(id):
     check_admin()
 
     customer = Customer.query.filter_by(c_id=id).first()
+    copy_form = CopyQuotationsForm()
 
     return render_template('admin/customers/view_customer.html', action="View",
-                           customer=customer, title="View Customer")
+                           customer=customer, copy_form=copy_form, title="View Customer")
 
 
 @admin.route('/customers/<int:page_num>/', methods=['GET', 'POST'])
 @login_required
+@read_only
 def list_customers(page_num):
     """
     List all customers
     """
     check_admin()
 
-    # customers = Customer.query.all()
-    # customers = Customer.query.paginate(per_page=5, page=page_num, error_out=True)
-
-    customers = Customer.query.all()
     form = SearchForm()
     if form.validate_on_submit():
-        customers = Customer.query.filter(or_(Customer.acc_code.like("%" + form.search_string.data + "%"), 
-                                        Customer.email.like("%" + form.search_string.data + "%"),
-                                        Customer.f_name.like("%" + form.search_string.data + "%"),
-                                        Customer.l_name.like("%" + form.search_string.data + "%"))).all()
+        # start the search over from the first page
+        return redirect(url_for('admin.list_customers', page_num=1,
+                                search=form.search_string.data or None))
+
+    search = request.args.get('search', '')
+    form.search_string.data = search
+    if search:
+        # ranked matches from the full-text index
+        ids = search_index.search(Customer, search, limit=0)
+        customers = customer_list.ranked(Customer.query, ids, page_num)
+    else:
+        customers = list_page(customer_list, Customer.query, page_num)
 
     return render_template('admin/customers/customers.html', form=form,
-                           customers=customers, title="Customers")
+                           customers=customers, search=search, title="Customers")
 
 
 @admin.route('/customers/add', methods=['GET', 'POST'])
@@ -229,30 +340,37 @@ def edit_customer(id):
     customer = Customer.query.get_or_404(id)
     form = CustomerForm(obj=customer)
     if form.validate_on_submit():
-        customer.acc_code = form.acc_code.data
-        customer.comp_name = form.comp_name.data
-        customer.f_name = form.f_name.data
-        customer.l_name = form.l_name.data
-        customer.phone = form.phone.data
-        customer.email = form.email.data
-        customer.b_address = form.b_address.data
-        customer.city = form.city.data
-        customer.state_province = form.state_province.data
-        customer.post_code = form.post_code.data
-        customer.count_region = form.count_region.data
-        customer.cont_title = form.cont_title.data
-        customer.fax = form.fax.data
-        customer.notes = form.notes.data
-        customer.order = form.order.data
-        customer.state = form.state.data
-        customer.status = form.status.data
-        customer.rating = form.rating.data
+        try:
+            check_version(customer, form.version.data)
+            customer.acc_code = form.acc_code.data
+            customer.comp_name = form.comp_name.data
+            customer.f_name = form.f_name.data
+            customer.l_name = form.l_name.data
+            customer.phone = form.phone.data
+            customer.email = form.email.data
+            customer.b_address = form.b_address.data
+            customer.city = form.city.data
+            customer.state_province = form.state_province.data
+            customer.post_code = form.post_code.data
+            customer.count_region = form.count_region.data
+            customer.cont_title = form.cont_title.data
+            customer.fax = form.fax.data
+            customer.notes = form.notes.data
+            customer.order = form.order.data
+            customer.state = form.state.data
+            customer.status = form.status.data
+            customer.rating = form.rating.data
 
-        db.session.commit()
-        flash('You have successfully edited the customer.')
+            db.session.commit()
+        except (EditConflict, StaleDataError):
+            db.session.rollback()
+            flash(CONFLICT_MESSAGE, 'conflict')
+            customer = Customer.query.get_or_404(id)
+        else:
+            flash('You have successfully edited the customer.')
 
-        # redirect to the customers page
-        return redirect(url_for('admin.list_customers', page_num=1))
+            # redirect to the customers page
+            return redirect(url_for('admin.list_customers', page_num=1))
 
     # fill the form with current data to show what changes are to be made
     form.acc_code.data = customer.acc_code 
@@ -273,6 +391,7 @@ def edit_customer(id):
     form.state.data = customer.state
     form.status.data = customer.status
     form.rating.data = customer.rating
+    form.version.data = customer.version
 
     return render_template('admin/customers/customer.html', action="Edit",
                            add_customer=add_customer, form=form,
@@ -287,9 +406,9 @@ def delete_customer(id):
     """
     check_admin()
 
-    customer = Customer.query.get_or_404(id)
-    db.session.delete(customer)
-    db.session.commit()
+    # the customer's contacts and quotations go with it
+    if not delete_customers([id]):
+        abort(404)
     flash('You have successfully deleted the customer.')
 
     # redirect to the customers page
@@ -301,109 +420,147 @@ def delete_customer(id):
 
 @admin.route('/contacts/background_process/customer')
 @login_required
+@read_only
 def _get_customer_info():
     """
-    Retrieve a list of contacts from a specified account code
+    Retrieve a customer's details from its account code
     """
     check_admin()
 
     acc_code = request.args.get('acc_code', '1')
-    customer = Customer.query.filter_by(acc_code=acc_code).first()
-    # Can't serialize an sqlalchmy object using jsonify, so just make a dictionary with relevant data
-    data = {}
-    data['title'] = customer.cont_title
-    data['f_name'] = customer.f_name
-    data['l_name'] = customer.l_name
-    data['address'] = customer.b_address
-    data['city'] = customer.city
-    data['state'] = customer.state_province
-    data['country'] = customer.count_region
-    data['zip'] = customer.post_code
-    data['tel'] = customer.phone
-    
-    return jsonify(data)
+    customer = Customer.query.filter_by(acc_code=acc_code).first_or_404()
+    return jsonify(customer_info(customer))
 
 
 @admin.route('/contacts/background_process/contact_info')
 @login_required
+@read_only
 def _get_contact_info():
     """
-    Retrieve a list of contacts from a specified account code
+    Retrieve a contact's details, defaulting to its customer's where the
+    contact has none
     """
     check_admin()
 
     contact_id = request.args.get('contact_id', '1', type=int)
-    print(contact_id)
-    contact = Contact.query.filter_by(contact_id=contact_id).first()
+    contact = Contact.query.filter_by(contact_id=contact_id).first_or_404()
     customer = Customer.query.filter_by(c_id=contact.c_id).first()
-    # Can't serialize an sqlalchmy object using jsonify, so just make a dictionary with relevant data
-    data = {}
+    return jsonify(contact_info(contact, customer))
 
-    # Only use contact data if it's available otherwise default to the customer's data
-    if contact.cont_title:
-        data['title'] = contact.cont_title
-    else:
-        data['title'] = customer.cont_title
 
-    if contact.f_name:
-        data['f_name'] = contact.f_name
-    else:
-        data['f_name'] = customer.f_name
+@admin.route('/contacts/background_process')
+@login_required
+@read_only
+def _get_contacts_list():
+    """
+    Retrieve a list of contacts from a specified account code
+    """
+    check_admin()
 
-    if contact.l_name:
-        data['l_name'] = contact.l_name
-    else:
-        data['l_name'] = customer.l_name
+    acc_code = request.args.get('acc_code', '1', type=str)
+    # Query for all the contacts that share this account code and index theyre names by their contact id
+    contacts = [(contact.contact_id, contact_name(contact)) for contact in Contact.query.filter_by(acc_code=acc_code).all()]
+    return jsonify(contacts)
 
-    if contact.city:
-        data['city'] = contact.city
-    else:
-        data['city'] = customer.city
 
-    if contact.state_province:
-        data['state'] = contact.state_province
-    else:
-        data['state'] = customer.state_province
+@admin.route('/lookup')
+@login_required
+@read_only
+def lookup_keys():
+    """
+    Retrieve customers by account code, contacts by id and products by
+    part number for the quotation forms, as many as needed in one request.
+    The response carries an ETag and may be reused by the browser for
+    LOOKUP_MAX_AGE seconds.
+    """
+    check_admin()
 
-    if contact.count_region:
-        data['country'] = contact.count_region
-    else:
-        data['country'] = customer.count_region
+    acc_codes = request.args.getlist('acc_code')
+    contact_ids = request.args.getlist('contact_id', type=int)
+    part_numbers = request.args.getlist('part_number')
+    if len(acc_codes) + len(contact_ids) + len(part_numbers) > current_app.config.get('LOOKUP_MAX_KEYS', 200):
+        abort(400)
 
-    if contact.phone:
-        data['tel'] = contact.phone
-    else:
-        data['tel'] = customer.phone
+    response = jsonify(lookup(acc_codes, contact_ids, part_numbers))
+    response.add_etag()
+    response.cache_control.private = True
+    response.cache_control.max_age = current_app.config.get('LOOKUP_MAX_AGE', 60)
+    return response.make_conditional(request)
 
-    if contact.post_code:
-        data['zip'] = contact.post_code
-    else:
-        data['zip'] = customer.post_code
 
-    if contact.b_address:
-        data['address'] = contact.b_address
-    else:
-        data['address'] = customer.b_address
+@admin.route('/cache/stats')
+@login_required
+def cache_stats():
+    """
+    Retrieve the shared cache backend and this worker's hit and miss
+    counters for each namespace
+    """
+    check_admin()
 
-    return jsonify(data)
+    return jsonify(shared_cache.stats())
 
 
-@admin.route('/contacts/background_process')
+@admin.route('/profiling')
 @login_required
-def _get_contacts_list():
+def profiling():
     """
-    Retrieve a list of contacts from a specified account code
+    Retrieve this worker's request histograms by endpoint and its slowest
+    statements, when PROFILE_REQUESTS is on
     """
     check_admin()
 
-    acc_code = request.args.get('acc_code', '1', type=str)
-    # Query for all the contacts that share this account code and index theyre names by their contact id
-    contacts = [(contact.contact_id, str(contact.f_name + ' ' + contact.l_name)) for contact in Contact.query.filter_by(acc_code=acc_code).all()]
-    return jsonify(contacts)
+    if not query_profiler.enabled(current_app):
+        abort(404)
+    return jsonify(query_profiler.report(top=request.args.get('top', 20, type=int)))
+
+
+@admin.route('/profiling/reset', methods=['POST'])
+@login_required
+def reset_profiling():
+    """
+    Start this worker's request histograms afresh
+    """
+    check_admin()
+
+    if not query_profiler.enabled(current_app):
+        abort(404)
+    query_profiler.reset()
+    return jsonify({'reset': True})
+
+
+@admin.route('/database/pools')
+@login_required
+def database_pools():
+    """
+    Retrieve this worker's connection pool sizes, utilisation and checkout
+    waits, for the primary and each replica
+    """
+    check_admin()
+
+    return jsonify({'pools': db.pool_stats()})
+
+
+@admin.route('/choices/<source>')
+@login_required
+@read_only
+def typeahead(source):
+    """
+    Retrieve the choices of a select field whose labels start with `q`,
+    for the typeahead select boxes
+    """
+    check_admin()
+
+    if source not in SOURCES:
+        abort(404)
+    limit = min(request.args.get('limit', current_app.config.get('TYPEAHEAD_LIMIT', 20), type=int),
+                current_app.config.get('TYPEAHEAD_MAX_LIMIT', 100))
+    results = choice_cache.search(source, request.args.get('q', u''), max(limit, 1))
+    return jsonify(results=results)
 
 
 @admin.route('/contacts/view/<int:id>', methods=['GET'])
 @login_required
+@read_only
 def view_contact(id):
     """
     View a contact
@@ -418,23 +575,28 @@ def view_contact(id):
 
 @admin.route('/contacts/<int:page_num>/', methods=['GET', 'POST'])
 @login_required
+@read_only
 def list_contacts(page_num):
     """
     List all contacts
     """
     check_admin()
 
-    # contacts = Contact.query.paginate(per_page=5, page=page_num, error_out=True)
-    contacts = Contact.query.all()
     form = SearchForm()
     if form.validate_on_submit():
-        contacts = Contact.query.filter(or_(Contact.acc_code.like("%" + form.search_string.data + "%"), 
-                                        Contact.email.like("%" + form.search_string.data + "%"),
-                                        Contact.f_name.like("%" + form.search_string.data + "%"),
-                                        Contact.l_name.like("%" + form.search_string.data + "%"))).all()
+        return redirect(url_for('admin.list_contacts', page_num=1,
+                                search=form.search_string.data or None))
+
+    search = request.args.get('search', '')
+    form.search_string.data = search
+    if search:
+        ids = search_index.search(Contact, search, limit=0)
+        contacts = contact_list.ranked(Contact.query, ids, page_num)
+    else:
+        contacts = list_page(contact_list, Contact.query, page_num)
 
     return render_template('admin/contacts/contacts.html', form=form,
-                           contacts=contacts, title="Contacts")
+                           contacts=contacts, search=search, title="Contacts")
 
 
 @admin.route('/contacts/add/<int:c_id>', methods=['GET', 'POST'])
@@ -448,7 +610,6 @@ def add_contact(c_id):
     add_contact = True
 
     form = ContactForm()
-    form.acc_code.choices = [(customer.c_id, str(customer.acc_code)) for customer in Customer.query.all()]
     if c_id is not None:
         form.acc_code.data = c_id
     if form.validate_on_submit():
@@ -499,7 +660,6 @@ def edit_contact(id):
 
     contact = Contact.query.get_or_404(id)
     form = ContactForm(obj=contact)
-    form.acc_code.choices = [(customer.c_id, str(customer.acc_code)) for customer in Customer.query.all()]
     if form.validate_on_submit():
         c_id = form.acc_code.data
         contact.c_id = c_id
@@ -566,6 +726,7 @@ def delete_contact(id):
 
 @admin.route('/roles/<int:page_num>/')
 @login_required
+@read_only
 def list_roles(page_num):
     check_admin()
     """
@@ -661,6 +822,7 @@ def delete_role(id):
 
 @admin.route('/employees/<int:page_num>')
 @login_required
+@read_only
 def list_employees(page_num):
     """
     List all employees
@@ -709,6 +871,7 @@ def assign_employee(id):
 
 @admin.route('/products/view/<int:id>', methods=['GET'])
 @login_required
+@read_only
 def view_product(id):
     """
     View a product
@@ -723,24 +886,28 @@ def view_product(id):
 
 @admin.route('/products/<int:page_num>', methods=['GET', 'POST'])
 @login_required
+@read_only
 def list_products(page_num):
     """
     List all products
     """
     check_admin()
 
-    # products = Product.query.paginate(per_page=20, page=page_num, error_out=True)
-    # products = products.filter(Product.p_number.like('%EX002%'))
-    products = Product.query.all()
     form = SearchForm()
     if form.validate_on_submit():
-        products = Product.query.filter(or_(Product.p_number.like("%" + form.search_string.data + "%"), 
-                                        Product.japanese_p_name.like("%" + form.search_string.data + "%"),
-                                        Product.p_name.like("%" + form.search_string.data + "%"),
-                                        Product.supplier.like("%" + form.search_string.data + "%"))).all()
+        return redirect(url_for('admin.list_products', page_num=1,
+                                search=form.search_string.data or None))
+
+    search = request.args.get('search', '')
+    form.search_string.data = search
+    if search:
+        ids = search_index.search(Product, search, limit=0)
+        products = product_list.ranked(Product.query, ids, page_num)
+    else:
+        products = list_page(product_list, Product.query, page_num)
 
-    return render_template('admin/products/products.html',
-                           products=products, title="Products", form=form)
+    return render_template('admin/products/products.html', delete_form=BulkDeleteForm(),
+                           products=products, search=search, title="Products", form=form)
 
 
 @admin.route('/products/add', methods=['GET', 'POST'])
@@ -850,10 +1017,13 @@ def delete_product(id):
     """
     check_admin()
 
-    product = Product.query.get_or_404(id)
-    db.session.delete(product)
-    db.session.commit()
-    flash('You have successfully deleted the product.')
+    deleted, kept = delete_products([id])
+    if kept:
+        flash('The product is on quotations and cannot be deleted.')
+    elif not deleted:
+        abort(404)
+    else:
+        flash('You have successfully deleted the product.')
 
     # redirect to the products page
     return redirect(url_for('admin.list_products', page_num=1))
@@ -861,116 +1031,106 @@ def delete_product(id):
     return render_template(title="Delete Product")
 
 
+@admin.route('/products/delete', methods=['POST'])
+@login_required
+def delete_selected_products():
+    """
+    Delete the products ticked in the list, except those on quotations
+    """
+    check_admin()
+
+    form = BulkDeleteForm()
+    if form.validate_on_submit():
+        count, kept = delete_products(request.form.getlist('ids', type=int))
+        flash('You have successfully deleted {} products.'.format(count))
+        if kept:
+            flash('These products are on quotations and were kept: {}'.format(', '.join(kept)))
+
+    # redirect to the products page
+    return redirect(url_for('admin.list_products', page_num=1))
+
+
 # Quotation Views
 
 
 @admin.route('/quotations/copy/<int:id>', methods=['GET'])
 @login_required
 def _copy_quotation(id):
-    # Get the relevant db objects to make a copy of the Quotation
-    quotation = Quotation.query.get_or_404(id)
-    customer = Customer.query.get_or_404(quotation.c_id)
-    contact = Contact.query.get_or_404(quotation.contact_id)    
-
-    new_q_num = quotation.q_num + 10000 + random.randint(0,100)
-    # Recreate the new Quotation
-    new_quotation = Quotation(c_id = quotation.c_id,           
-                                acc_code = quotation.acc_code,
-                                contact_id = quotation.contact_id,
-                                q_num = new_q_num,
-                                e_id = quotation.e_id,           
-                                date = quotation.date,
-                                revision = quotation.revision,
-                                pay_terms = quotation.pay_terms,
-                                title = quotation.title,
-                                f_name = quotation.f_name,
-                                l_name = quotation.l_name,
-                                address = quotation.address,
-                                city = quotation.city,
-                                state = quotation.state,
-                                country = quotation.country,
-                                postal = quotation.postal,
-                                tel = quotation.tel,
-                                s_sched = quotation.s_sched,
-                                s_term = quotation.s_term,
-                                q_title = quotation.q_title,
-                                q_note = quotation.q_note,
-                                q_amount = quotation.q_amount)
-                                
-    try:
-        # add new quotation to the database
-        db.session.add(new_quotation)
-        db.session.commit()
-        flash('You have successfully added a new quotation.')
-    except:
-        # in case Quotation already exists
-        flash('Error: Quotation already exists.')
-
-    # Get the new quotation id
-    new_q_id = Quotation.query.filter_by(q_num=new_q_num).first().q_id
-    # Get all the quote details attached to this quotation
-    quote_details = Quotation_Detail.query.filter_by(q_id=id).all()
-
-    # Recreate each quote detail to be used in the new quotation
-    for quote_detail in quote_details:
-        product_associated = Product.query.get_or_404(quote_detail.p_id)
-        new_quote_detail = Quotation_Detail(q_id = new_q_id,     
-                                p_id = quote_detail.p_id,                
-                                p_name = product_associated.p_name,           
-                                q_num = new_q_num,
-                                p_num = product_associated.p_number,
-                                quantity = quote_detail.quantity,
-                                discount = quote_detail.discount,
-                                q_price = quote_detail.q_price,
-                                option = quote_detail.option)
-                                
-        try:
-            # add new quotation_detail to the database
-            db.session.add(new_quote_detail)
-            db.session.commit()
-            flash('You have successfully added a new quotation_detail.')
-        except:
-            # in case Quotation_Detail already exists
-            flash('Error: Quotation_Detail already exists.')
+    """
+    Copy a quotation and its details under a new quotation number
+    """
+    quotation = clone_quotation(id)
+    if quotation is None:
+        abort(404)
+    flash('You have successfully copied the quotation to number {}.'.format(quotation.q_num))
 
     # redirect to quotations page
     return redirect(url_for('admin.list_quotations', page_num=1))
-    
+
+
+@admin.route('/customers/copy_quotations/<int:id>', methods=['POST'])
+@login_required
+def copy_customer_quotations(id):
+    """
+    Copy all of a customer's quotations, to renew them in one go
+    """
+    check_admin()
+
+    customer = Customer.query.get_or_404(id)
+    form = CopyQuotationsForm()
+    if not form.validate_on_submit():
+        abort(400)
+    ids = [q_id for q_id, in db.session.query(Quotation.q_id)
+           .filter(Quotation.c_id == customer.c_id).order_by(Quotation.q_num)]
+    copies = clone_quotations(ids)
+    flash('You have successfully copied {} quotations.'.format(len(copies)))
+
+    # redirect to quotations page
+    return redirect(url_for('admin.list_quotations', page_num=1))
+
 
 @admin.route('/quotations/view/<int:id>', methods=['GET'])
 @login_required
+@read_only
 def view_quotation(id):
     """
     View a quotation
     """
     check_admin()
 
-    quotation = Quotation.query.filter_by(q_id=id).first()
-    quote_details = Quotation_Detail.query.filter_by(q_id=id).all()
+    document = load_quotation_document(id)
+    if document is None:
+        abort(404)
 
     return render_template('admin/quotations/view_quotation.html', action="View",
-                           quotation=quotation, quote_details=quote_details, title="View Quotation")
+                           title="View Quotation", **document.context())
 
 
 @admin.route('/quotations/<int:page_num>', methods=['GET', 'POST'])
 @login_required
+@read_only
 def list_quotations(page_num):
     """
     List all quotations
     """
     check_admin()
 
-    # quotations = Quotation.query.all()
-    # quotations = Quotation.query.paginate(per_page=5, page=page_num, error_out=True)
-
-    quotations = Quotation.query.all()
     form = SearchForm()
     if form.validate_on_submit():
-        quotations = Quotation.query.filter(or_(Quotation.acc_code.like("%" + form.search_string.data + "%"), 
-                                        Quotation.q_num.like("%" + form.search_string.data + "%"))).all()
+        return redirect(url_for('admin.list_quotations', page_num=1,
+                                search=form.search_string.data or None))
+
+    search = request.args.get('search', '')
+    form.search_string.data = search
+    if search:
+        ids = search_index.search(Quotation, search, limit=0)
+        quotations = quotation_list.ranked(Quotation.query, ids, page_num)
+    else:
+        quotations = list_page(quotation_list, Quotation.query, page_num)
 
     return render_template('admin/quotations/quotations.html', form=form,
-                           quotations=quotations, title="Quotations")
+                           delete_form=BulkDeleteForm(),
+                           quotations=quotations, search=search, title="Quotations")
 
 
 @admin.route('/quotations/add', methods=['GET', 'POST'])
@@ -984,8 +1144,6 @@ def add_quotation():
     add_quotation = True
 
     form = QuotationForm()
-    form.contact.choices = [(contact.contact_id, str(contact.f_name + ' ' + contact.l_name)) for contact in Contact.query.all()]
-    form.acc_code.choices = [(customer.c_id, str(customer.acc_code)) for customer in Customer.query.all()]
     if form.validate_on_submit():
         c_id = form.acc_code.data
         customer = Customer.query.filter_by(c_id=c_id).first()
@@ -994,7 +1152,7 @@ def add_quotation():
                                 acc_code = acc_code,
                                 contact_id = form.contact.data,
                                 q_num = form.q_num.data,
-                                e_id = form.e_id.data.username,           
+                                e_id = form.e_id.data,
                                 date = form.date.data,
                                 revision = form.revision.data,
                                 pay_terms = form.pay_terms.data,
@@ -1043,39 +1201,44 @@ def edit_quotation(id):
 
     quotation = Quotation.query.get_or_404(id)
     form = QuotationForm(obj=quotation)
-    form.contact.choices = [(contact.contact_id, str(contact.f_name + ' ' + contact.l_name)) for contact in Contact.query.all()]
-    form.acc_code.choices = [(customer.c_id, str(customer.acc_code)) for customer in Customer.query.all()]
     if form.validate_on_submit():
-        c_id = form.acc_code.data
-        customer = Customer.query.filter_by(c_id=c_id).first()
-        acc_code = customer.acc_code
-        quotation.c_id = c_id
-        quotation.acc_code = acc_code
-        quotation.contact_id = form.contact.data
-        quotation.q_num = form.q_num.data        
-        quotation.e_id = form.e_id.data.username         
-        quotation.date = form.date.data
-        quotation.revision = form.revision.data
-        quotation.pay_terms = form.pay_terms.data
-        quotation.title = form.title.data
-        quotation.f_name = form.f_name.data
-        quotation.l_name = form.l_name.data
-        quotation.address = form.address.data
-        quotation.city = form.city.data
-        quotation.state = form.state.data
-        quotation.country = form.country.data
-        quotation.postal = form.postal.data
-        quotation.tel = form.tel.data
-        quotation.s_sched = form.s_sched.data
-        quotation.s_term = form.s_term.data
-        quotation.q_title = form.q_title.data
-        quotation.q_note = form.q_note.data
+        try:
+            check_version(quotation, form.version.data)
+            c_id = form.acc_code.data
+            customer = Customer.query.filter_by(c_id=c_id).first()
+            acc_code = customer.acc_code
+            quotation.c_id = c_id
+            quotation.acc_code = acc_code
+            quotation.contact_id = form.contact.data
+            quotation.q_num = form.q_num.data        
+            quotation.e_id = form.e_id.data
+            quotation.date = form.date.data
+            quotation.revision = form.revision.data
+            quotation.pay_terms = form.pay_terms.data
+            quotation.title = form.title.data
+            quotation.f_name = form.f_name.data
+            quotation.l_name = form.l_name.data
+            quotation.address = form.address.data
+            quotation.city = form.city.data
+            quotation.state = form.state.data
+            quotation.country = form.country.data
+            quotation.postal = form.postal.data
+            quotation.tel = form.tel.data
+            quotation.s_sched = form.s_sched.data
+            quotation.s_term = form.s_term.data
+            quotation.q_title = form.q_title.data
+            quotation.q_note = form.q_note.data
 
-        db.session.commit()
-        flash('You have successfully edited the quotation.')
+            db.session.commit()
+        except (EditConflict, StaleDataError):
+            db.session.rollback()
+            flash(CONFLICT_MESSAGE, 'conflict')
+            quotation = Quotation.query.get_or_404(id)
+        else:
+            flash('You have successfully edited the quotation.')
 
-        # redirect to the quotations page
-        return redirect(url_for('admin.list_quotations', page_num=1))
+            # redirect to the quotations page
+            return redirect(url_for('admin.list_quotations', page_num=1))
 
     # fill the form with current data to show what changes are to be made
     # Find the value corresponding to the selected account code so when they edit it doesnt default to a-tech
@@ -1100,6 +1263,7 @@ def edit_quotation(id):
     form.s_term.data = quotation.s_term
     form.q_title.data = quotation.q_title
     form.q_note.data = quotation.q_note
+    form.version.data = quotation.version
 
     return render_template('admin/quotations/quotation.html', action="Edit",
                            add_quotation=add_quotation, form=form,
@@ -1114,16 +1278,9 @@ def delete_quotation(id):
     """
     check_admin()
 
-    quote_details = Quotation_Detail.query.filter_by(q_id=id).all()
-    for quote_detail in quote_details:
-
-        db.session.delete(quote_detail)
-        db.session.commit()
-        flash('You have successfully deleted the associated quotation details.')
-
-    quotation = Quotation.query.get_or_404(id)
-    db.session.delete(quotation)
-    db.session.commit()
+    # the details and opportunities go with it, in the same transaction
+    if not delete_quotations([id]):
+        abort(404)
     flash('You have successfully deleted the quotation.')
 
     # redirect to the quotations page
@@ -1132,79 +1289,105 @@ def delete_quotation(id):
     return render_template(title="Delete Quotation")
 
 
+@admin.route('/quotations/delete', methods=['POST'])
+@login_required
+def delete_selected_quotations():
+    """
+    Delete the quotations ticked in the list, with their details and
+    opportunities, in one transaction
+    """
+    check_admin()
+
+    form = BulkDeleteForm()
+    if form.validate_on_submit():
+        count = delete_quotations(request.form.getlist('ids', type=int))
+        flash('You have successfully deleted {} quotations.'.format(count))
+
+    # redirect to the quotations page
+    return redirect(url_for('admin.list_quotations', page_num=1))
+
+
 @admin.route('/quotations/pdf/<int:id>/', methods=['GET', 'POST'])
 @login_required
 def gen_pdf(id):
+    """
+    Preview the quotation's PDF layout as HTML
+    """
+    return render_quotation_pdf_html(id)
 
-    # Get the quotation from its unique id
-    quotation = Quotation.query.filter_by(q_id=id).first()
-
-    # Get the customer from the Quotation's Customer ID
-    customer = Customer.query.filter_by(c_id=quotation.c_id).first()    
-
-    # Get the contact frmo the Quotation's Contact ID
-    contact = Contact.query.filter_by(contact_id=quotation.contact_id).first()
-
-    # Get all of the Quotation Details that are tied to this Quotation
-    # quote_details = Quotation_Detail.query.filter_by(q_id=id, option=False).all()
-    quote_details = Quotation_Detail.query.filter_by(q_id=id).all()
-    # Get each product associated with each Quote Detail and save to dictionary
-    products = {}
-    subtotal = 0
-    total = 0
-    for detail in quote_details:
-        qd_id = detail.quote_detail_id
-        product = Product.query.filter_by(p_id=detail.p_id).first()
-        # products[qd_id] = product
-        detail.product = product
-
-        if detail.discount:
-            total += detail.quantity * detail.q_price * (1 - detail.discount)
-        else:
-            total += detail.quantity * detail.q_price
-
-        subtotal += detail.quantity * detail.q_price
-
-    # Find the 'optional' items and pass them in
-    # optional = Quotation_Detail.query.filter_by(q_id=id, option=True).all()
-    # for detail in optional:
-    #     qd_id = detail.quote_detail_id
-    #     product = Product.query.filter_by(p_id=detail.p_id).first()
-    #     products[qd_id] = product
-
-    return render_template('admin/quotations/pdf.html', 
-                            quotation=quotation,
-                            contact=contact,
-                            customer=customer,
-                            quote_details=quote_details,
-                            products=products,
-                            # optional=optional,
-                            title="PDF",
-                            total=total,
-                            subtotal=subtotal)
-
-    # Use the pdfkit library to convert HTML to PDF
-    # rendered = render_template('admin/quotations/pdf.html', 
-    #                         quotation=quotation,
-    #                         customer=customer,
-    #                         quote_details=quote_details,
-    #                         products=products,
-    #                         optional=quote_details, #change quote_details to optional 
-    #                         title="PDF",
-    #                         total=total,
-    #                         subtotal=subtotal)
-    # False because we aren't sending it to the client yet
-    # css = [url_for('../../', filename='static/css/pdf.css')]
-    # css = ['/media/sf_Ubuntu/quote/project-dream-team-three/app/static/css/pdf.css']
-    # print(css)
-    # pdf = pdfkit.from_string(rendered, False, css=css)
-
-    # response = make_response(pdf)
-    # response.headers['Content-Type'] = 'application/pdf' 
-    # modify inline to attachment for a download
-    # response.headers['Content-Disposition'] = 'inline; filname=quotation-{}.pdf'.format(id)
-
-    # return response
+
+def render_quotation_pdf_html(id):
+    # Get the quotation with its customer, contact, details and their products
+    document = load_quotation_document(id)
+    if document is None:
+        abort(404)
+
+    # The optional lines are listed apart but counted in the totals
+    return render_template('admin/quotations/pdf.html', title="PDF",
+                           **document.context())
+
+
+@admin.route('/quotations/pdf/<int:id>/download', methods=['GET'])
+@login_required
+def download_pdf(id):
+    """
+    Send the quotation as a PDF if an up to date one is cached, otherwise
+    queue it for rendering and reply with a url to poll
+    """
+    check_admin()
+
+    fingerprint = document_fingerprint(id)
+    if fingerprint is None:
+        abort(404)
+    key = pdf_queue.submit(pdf_queue.key(fingerprint), lambda: render_quotation_pdf_html(id))
+    if pdf_queue.status(key) == 'ready':
+        return pdf_file(id, key)
+
+    return jsonify(status=pdf_queue.status(key),
+                   status_url=url_for('admin.pdf_status', id=id, key=key)), 202
+
+
+@admin.route('/quotations/pdf/<int:id>/jobs/<key>', methods=['GET'])
+@login_required
+def pdf_status(id, key):
+    """
+    Report on a queued PDF, with its download url once it is ready
+    """
+    check_admin()
+
+    try:
+        status = pdf_queue.status(key)
+    except ValueError:
+        abort(404)
+
+    data = {'status': status}
+    if status == 'ready':
+        data['url'] = url_for('admin.pdf_file', id=id, key=key)
+    elif status == 'failed':
+        data['error'] = pdf_queue.error(key)
+    elif status == 'missing':
+        # the job was lost, asking for the download again requeues it
+        data['url'] = url_for('admin.download_pdf', id=id)
+    return jsonify(data)
+
+
+@admin.route('/quotations/pdf/<int:id>/files/<key>', methods=['GET'])
+@login_required
+def pdf_file(id, key):
+    """
+    Download a rendered PDF from the cache
+    """
+    check_admin()
+
+    try:
+        if pdf_queue.status(key) != 'ready':
+            abort(404)
+    except ValueError:
+        abort(404)
+
+    return send_file(pdf_queue.path(key), mimetype='application/pdf',
+                     as_attachment=True,
+                     attachment_filename='quotation-{}.pdf'.format(id))
 
 
 # Opportunity Views
@@ -1212,6 +1395,7 @@ def gen_pdf(id):
 
 @admin.route('/opportunities/view/<int:id>', methods=['GET'])
 @login_required
+@read_only
 def view_opportunity(id):
     """
     View a opportunity
@@ -1226,23 +1410,51 @@ def view_opportunity(id):
 
 @admin.route('/opportunities/<int:page_num>', methods=['GET', 'POST'])
 @login_required
+@read_only
 def list_opportunities(page_num):
     """
     List all opportunities
     """
     check_admin()
 
-    # opportunities = Opportunity.query.all()
-    # opportunities = Opportunity.query.paginate(per_page=5, page=page_num, error_out=True)
-    opportunities = Opportunity.query.all()
     form = SearchForm()
     if form.validate_on_submit():
-        opportunities = Opportunity.query.filter(or_(Opportunity.q_num.like("%" + form.search_string.data + "%"), 
-                                        Opportunity.integrator.like("%" + form.search_string.data + "%"),
-                                        Opportunity.source_of_lead.like("%" + form.search_string.data + "%"))).all()
+        return redirect(url_for('admin.list_opportunities', page_num=1,
+                                search=form.search_string.data or None))
+
+    search = request.args.get('search', '')
+    form.search_string.data = search
+    if search:
+        ids = search_index.search(Opportunity, search, limit=0)
+        opportunities = opportunity_list.ranked(Opportunity.query, ids, page_num)
+    else:
+        opportunities = list_page(opportunity_list, Opportunity.query, page_num)
 
     return render_template('admin/opportunities/opportunities.html', form=form,
-                           opportunities=opportunities, title="Opportunities")
+                           opportunities=opportunities, search=search, title="Opportunities")
+
+
+@admin.route('/opportunities/pipeline', methods=['GET'])
+@login_required
+@read_only
+def opportunity_pipeline():
+    """
+    Weighted pipeline, forecast by close month and win rates, from the
+    pipeline rollups
+    """
+    check_admin()
+
+    group = request.args.get('group', 'sales_stage')
+    if group not in PIPELINE_GROUPS:
+        abort(404)
+    frame = rollup_frame()
+
+    return render_template('admin/opportunities/pipeline.html', group=group,
+                           groups=PIPELINE_GROUPS,
+                           pipeline=weighted_pipeline(frame, [group]).to_dict('records'),
+                           forecast=forecast(frame).to_dict('records'),
+                           win_rates=win_rates(frame, [group]).to_dict('records'),
+                           title="Pipeline")
 
 
 @admin.route('/opportunities/add', methods=['GET', 'POST'])
@@ -1257,8 +1469,8 @@ def add_opportunity():
 
     form = OpportunityForm()
     if form.validate_on_submit():
-        q_num = form.q_num.data.q_num           # Select form returns quotation object, not q_num field
-        q_id = form.q_num.data.q_id
+        q_id = form.q_num.data
+        q_num = db.session.query(Quotation.q_num).filter_by(q_id=q_id).scalar()
         opportunity = Opportunity(q_id = q_id,           # special
                                     q_num = q_num,
                                     source_of_lead = form.source_of_lead.data,           
@@ -1309,33 +1521,40 @@ def edit_opportunity(id):
     opportunity = Opportunity.query.get_or_404(id)
     form = OpportunityForm(obj=opportunity)
     if form.validate_on_submit():
-        opportunity.q_id = form.q_num.data.q_id      # special
-        opportunity.q_num = form.q_num.data.q_num
-        opportunity.source_of_lead = form.source_of_lead.data,          
-        opportunity.sale_ref_fee = form.sale_ref_fee.data
-        opportunity.competitors = form.competitors.data
-        opportunity.sales_stage = form.sales_stage.data
-        opportunity.close_date = form.close_date.data
-        opportunity.probability = form.probability.data
-        opportunity.rev_category = form.rev_category.data
-        opportunity.proj_note = form.proj_note.data
-        opportunity.application = form.application.data
-        opportunity.family = form.family.data
-        opportunity.potential_money = form.potential_money.data
-        opportunity.probable_money = form.probable_money.data
-        opportunity.actual_money = form.actual_money.data
-        opportunity.revenue = form.revenue.data
-        opportunity.integrator = form.integrator.data
-        opportunity.region = form.region.data
+        try:
+            check_version(opportunity, form.version.data)
+            opportunity.q_id = form.q_num.data      # special
+            opportunity.q_num = db.session.query(Quotation.q_num).filter_by(q_id=opportunity.q_id).scalar()
+            opportunity.source_of_lead = form.source_of_lead.data
+            opportunity.sale_ref_fee = form.sale_ref_fee.data
+            opportunity.competitors = form.competitors.data
+            opportunity.sales_stage = form.sales_stage.data
+            opportunity.close_date = form.close_date.data
+            opportunity.probability = form.probability.data
+            opportunity.rev_category = form.rev_category.data
+            opportunity.proj_note = form.proj_note.data
+            opportunity.application = form.application.data
+            opportunity.family = form.family.data
+            opportunity.potential_money = form.potential_money.data
+            opportunity.probable_money = form.probable_money.data
+            opportunity.actual_money = form.actual_money.data
+            opportunity.revenue = form.revenue.data
+            opportunity.integrator = form.integrator.data
+            opportunity.region = form.region.data
 
-        db.session.commit()
-        flash('You have successfully edited the opportunity.')
+            db.session.commit()
+        except (EditConflict, StaleDataError):
+            db.session.rollback()
+            flash(CONFLICT_MESSAGE, 'conflict')
+            opportunity = Opportunity.query.get_or_404(id)
+        else:
+            flash('You have successfully edited the opportunity.')
 
-        # redirect to the opportunities page
-        return redirect(url_for('admin.list_opportunities', page_num=1))
+            # redirect to the opportunities page
+            return redirect(url_for('admin.list_opportunities', page_num=1))
 
     # fill the form with current data to show what changes are to be made
-    form.q_num.data = opportunity.q_num       
+    form.q_num.data = opportunity.q_id
     form.source_of_lead.data = opportunity.source_of_lead       
     form.sale_ref_fee.data = opportunity.sale_ref_fee
     form.competitors.data = opportunity.competitors
@@ -1352,6 +1571,7 @@ def edit_opportunity(id):
     form.revenue.data = opportunity.revenue
     form.integrator.data = opportunity.integrator 
     form.region.data = opportunity.region
+    form.version.data = opportunity.version
 
     return render_template('admin/opportunities/opportunity.html', action="Edit",
                            add_opportunity=add_opportunity, form=form,
@@ -1383,9 +1603,13 @@ def delete_opportunity(id):
 @login_required
 def optional_quotation_detail(id, option):
     # Modify the option parameter of the quotation detail to boolean value: option
-    quotation_detail = Quotation_Detail.query.filter_by(quote_detail_id=id).first()
-    quotation_detail.option = bool(option)
-    db.session.commit()
+    def toggle():
+        quotation_detail = Quotation_Detail.query.filter_by(quote_detail_id=id).first()
+        before = line_snapshot(quotation_detail)
+        quotation_detail.option = bool(option)
+        apply_line_change(before, line_snapshot(quotation_detail))
+
+    retry_on_conflict(toggle)
     # return "hello world" + str(id) + str(option)
 
     # redirect to quotation_details page
@@ -1395,6 +1619,7 @@ def optional_quotation_detail(id, option):
 
 @admin.route('/quotation_details/view/<int:id>', methods=['GET'])
 @login_required
+@read_only
 def view_quotation_detail(id):
     """
     View a quotation_detail
@@ -1409,23 +1634,28 @@ def view_quotation_detail(id):
 
 @admin.route('/quotation_details/<int:page_num>', methods=['GET', 'POST'])
 @login_required
+@read_only
 def list_quotation_details(page_num):
     """
     List all quotation_details
     """
     check_admin()
 
-    # quotation_details = Quotation_Detail.query.all()
-    # quotation_details = Quotation_Detail.query.paginate(per_page=5, page=page_num, error_out=True)
-    quotation_details = Quotation_Detail.query.all()
     form = SearchForm()
     if form.validate_on_submit():
-        quotation_details = Quotation_Detail.query.filter(or_(Quotation_Detail.q_num.like("%" + form.search_string.data + "%"), 
-                                        Quotation_Detail.p_num.like("%" + form.search_string.data + "%"),
-                                        Quotation_Detail.p_name.like("%" + form.search_string.data + "%"))).all()
+        return redirect(url_for('admin.list_quotation_details', page_num=1,
+                                search=form.search_string.data or None))
+
+    search = request.args.get('search', '')
+    form.search_string.data = search
+    query = Quotation_Detail.query
+    if search:
+        query = query.filter(quotation_detail_matches(search))
+    quotation_details = list_page(quotation_detail_list, query, page_num)
 
     return render_template('admin/quotation_details/quotation_details.html', form=form,
-                           quotation_details=quotation_details, title="Quotation_Details")
+                           quotation_details=quotation_details, search=search,
+                           title="Quotation_Details")
 
 
 @admin.route('/quotation_details/add/<int:q_id>', methods=['GET', 'POST'])
@@ -1439,8 +1669,6 @@ def add_quotation_detail(q_id):
     add_quotation_detail = True
 
     form = Quotation_DetailForm()
-    form.p_num.choices = [(product.p_id, str(product.p_number)) for product in Product.query.all()]
-    form.q_num.choices = [(quotation.q_id, str(quotation.q_num)) for quotation in Quotation.query.all()]
     if q_id is not None:
         form.q_num.data = q_id
     if form.validate_on_submit():
@@ -1448,11 +1676,11 @@ def add_quotation_detail(q_id):
         quotation = Quotation.query.filter_by(q_id=q_id).first()
         q_num = quotation.q_num
         p_id = form.p_num.data
-        product = Product.query.filter_by(p_id=p_id).first()
-        p_num = product.p_number
+        product = price_cache.by_id(p_id)
+        p_num = product['p_number']
         quotation_detail = Quotation_Detail(q_id = q_id,     
                                 p_id = p_id,                
-                                p_name = product.p_name,           
+                                p_name = product['p_name'],           
                                 q_num = q_num,
                                 p_num = p_num,
                                 quantity = form.quantity.data,
@@ -1461,25 +1689,16 @@ def add_quotation_detail(q_id):
                                 option = form.option.data)
                                 
         try:
-            # add quotation_detail to the database
+            # add quotation_detail to the database, and its amount to the quote
             db.session.add(quotation_detail)
+            apply_line_change(after=line_snapshot(quotation_detail))
             db.session.commit()
             flash('You have successfully added a new quotation_detail.')
         except:
             # in case Quotation_Detail already exists
+            db.session.rollback()
             flash('Error: Quotation_Detail already exists.')
 
-        # Update the quote amount for the parent quote to reflect this new quotation detail
-        quotation = Quotation.query.get_or_404(q_id)
-        quotation.q_amount = 0
-        quote_details = Quotation_Detail.query.filter_by(q_id=q_id).all()
-
-        for quote_detail in quote_details:
-            if quote_detail.option is False:
-                quotation.q_amount += quote_detail.quantity * quote_detail.q_price * (1 - quote_detail.discount)
-
-        db.session.commit()
-
         # redirect to quotation_details page
         return redirect(url_for('admin.list_quotation_details', page_num=1))
 
@@ -1489,6 +1708,44 @@ def add_quotation_detail(q_id):
                            title="Add Quotation_Detail")
 
 
+@admin.route('/quotations/<int:id>/lines', methods=['GET', 'POST'])
+@login_required
+def add_quotation_lines(id):
+    """
+    Add many lines to a quotation at once: part number, quantity, discount,
+    quote price and optional, from pasted spreadsheet rows, a CSV file or,
+    for scripts, a JSON body of {"lines": [{"p_number": ..., ...}]}
+    """
+    check_admin()
+
+    quotation = Quotation.query.get_or_404(id)
+
+    if request.is_json:
+        try:
+            added = add_lines(id, (request.get_json().get('lines') or []))
+        except LineErrors as e:
+            return jsonify(errors=[{'line': number, 'error': error} for number, error in e.errors]), 400
+        return jsonify(added=added)
+
+    form = QuotationLinesForm()
+    errors = []
+    if form.validate_on_submit():
+        upload = form.csv_file.data
+        text = upload.read() if upload else form.lines.data or u''
+        try:
+            added = add_lines(id, parse_lines(text))
+        except LineErrors as e:
+            errors = e.errors
+        else:
+            if added:
+                flash('You have successfully added {} lines.'.format(added))
+                return redirect(url_for('admin.view_quotation', id=id))
+            flash('There were no lines to add.')
+
+    return render_template('admin/quotations/lines.html', form=form, errors=errors,
+                           quotation=quotation, title="Add Lines")
+
+
 @admin.route('/quotation_details/edit/<int:id>', methods=['GET', 'POST'])
 @login_required
 def edit_quotation_detail(id):
@@ -1500,43 +1757,39 @@ def edit_quotation_detail(id):
     add_quotation_detail = False
 
     quotation_detail = Quotation_Detail.query.get_or_404(id)
+    before = line_snapshot(quotation_detail)
     form = Quotation_DetailForm(obj=quotation_detail)
-    form.p_num.choices = [(product.p_id, str(product.p_number)) for product in Product.query.all()]
-    form.q_num.choices = [(quotation.q_id, str(quotation.q_num)) for quotation in Quotation.query.all()]
     if form.validate_on_submit():
-        q_id = form.q_num.data
-        quotation = Quotation.query.filter_by(q_id=q_id).first()
-        q_num = quotation.q_num
-        p_id = form.p_num.data
-        product = Product.query.filter_by(p_id=p_id).first()
-        p_num = product.p_number
-        quotation_detail.q_num = q_num
-        quotation_detail.p_num = p_num
-        quotation_detail.q_id = q_id
-        quotation_detail.p_id = p_id
-        quotation_detail.p_name = product.p_name
-        quotation_detail.quantity = form.quantity.data
-        quotation_detail.discount = form.discount.data
-        quotation_detail.q_price = form.q_price.data
-        quotation_detail.option = form.option.data
-
-        db.session.commit()
-        flash('You have successfully edited the quotation_detail.')
-
-
-        # Update the quote amount for the parent quote to reflect this new quotation detail
-        quotation = Quotation.query.get_or_404(q_id)
-        quotation.q_amount = 0
-        quote_details = Quotation_Detail.query.filter_by(q_id=q_id).all()
-
-        for quote_detail in quote_details:
-            if quote_detail.option is False:
-                quotation.q_amount += quote_detail.quantity * quote_detail.q_price * (1 - quote_detail.discount)
-
-        db.session.commit()
+        try:
+            check_version(quotation_detail, form.version.data)
+            q_id = form.q_num.data
+            quotation = Quotation.query.filter_by(q_id=q_id).first()
+            q_num = quotation.q_num
+            p_id = form.p_num.data
+            product = price_cache.by_id(p_id)
+            p_num = product['p_number']
+            quotation_detail.q_num = q_num
+            quotation_detail.p_num = p_num
+            quotation_detail.q_id = q_id
+            quotation_detail.p_id = p_id
+            quotation_detail.p_name = product['p_name']
+            quotation_detail.quantity = form.quantity.data
+            quotation_detail.discount = form.discount.data
+            quotation_detail.q_price = form.q_price.data
+            quotation_detail.option = form.option.data
+
+            # Swap the line's old amount for its new one on the parent quote
+            apply_line_change(before, line_snapshot(quotation_detail))
+            db.session.commit()
+        except (EditConflict, StaleDataError):
+            db.session.rollback()
+            flash(CONFLICT_MESSAGE, 'conflict')
+            quotation_detail = Quotation_Detail.query.get_or_404(id)
+        else:
+            flash('You have successfully edited the quotation_detail.')
 
-        # redirect to the quotation_details page
-        return redirect(url_for('admin.list_quotation_details', page_num=1))
+            # redirect to the quotation_details page
+            return redirect(url_for('admin.list_quotation_details', page_num=1))
 
     # fill the form with current data to show what changes are to be made
     form.q_num.data = quotation_detail.q_id
@@ -1547,6 +1800,7 @@ def edit_quotation_detail(id):
     
     form.q_price.data = quotation_detail.q_price 
     form.option.data = quotation_detail.option
+    form.version.data = quotation_detail.version
 
     return render_template('admin/quotation_details/quotation_detail.html', action="Edit",
                            add_quotation_detail=add_quotation_detail, form=form,
@@ -1561,23 +1815,14 @@ def delete_quotation_detail(id):
     """
     check_admin()
 
-    quotation_detail = Quotation_Detail.query.get_or_404(id)
-    # Save the quotation ID to update the quotation amount post deletion
-    q_id = quotation_detail.q_id
-    db.session.delete(quotation_detail)
-    db.session.commit()
-    flash('You have successfully deleted the quotation_detail.')
-
-    # Update the quote amount for the parent quote to reflect this new quotation detail
-    quotation = Quotation.query.get_or_404(q_id)
-    quotation.q_amount = 0
-    quote_details = Quotation_Detail.query.filter_by(q_id=q_id).all()
+    def delete():
+        quotation_detail = Quotation_Detail.query.get_or_404(id)
+        # Take the line's amount off the parent quote in the same transaction
+        apply_line_change(before=line_snapshot(quotation_detail))
+        db.session.delete(quotation_detail)
 
-    for quote_detail in quote_details:
-        if quote_detail.option is False:
-            quotation.q_amount += quote_detail.quantity * quote_detail.q_price * (1 - quote_detail.discount)
-
-    db.session.commit()
+    retry_on_conflict(delete)
+    flash('You have successfully deleted the quotation_detail.')
 
     # redirect to the quotation_details page
     return redirect(url_for('admin.list_quotation_details', page_num=1))
@@ -1587,18 +1832,13 @@ def delete_quotation_detail(id):
 
 @admin.route('/quotation_details/background_process')
 @login_required
+@read_only
 def _get_unit_price():
     p_num = request.args.get('product_num', '1', type=str)
-    product = Product.query.filter_by(p_number=p_num).first()
-    print(p_num, product.unit_price, product.p_name)
-    try:
-        price = product.unit_price
-        name = product.p_name
-    except Exception as e:
-        price = 0
-
-    result = {'price': price, 'name': name}
-    return jsonify(result)
+    product = price_cache.by_number(p_num)
+    if product is None:
+        return jsonify({'price': 0, 'name': None})
+    return jsonify(product_info(product))
 
 
 
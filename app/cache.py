@@ -0,0 +1,356 @@
+import errno
+import hashlib
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, g, has_request_context
+from six.moves import cPickle as pickle
+
+
+class LRUCache(object):
+    """
+    A thread safe, size bounded cache whose entries also expire after
+    `ttl` seconds. The least recently used entry is evicted to make room.
+    Hits, misses, expiries and evictions are counted for stats().
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.expired = self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires, value = entry
+            if expires <= self.clock():
+                self.expired += 1
+                self.misses += 1
+                return default
+            # re-inserting moves the entry to the most recently used end
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (self.clock() + (ttl or self.ttl), value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self._entries), 'maxsize': self.maxsize, 'ttl': self.ttl,
+                'hits': self.hits, 'misses': self.misses, 'expired': self.expired,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / lookups if lookups else None}
+
+
+class MemoryBackend(object):
+    """
+    Cache in the memory of this process only, the default for development
+    and tests. Nothing is shared between workers.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.entries = LRUCache(maxsize, ttl)
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.entries.set(key, value, ttl)
+
+    def delete(self, key):
+        self.entries.delete(key)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def stats(self):
+        return self.entries.stats()
+
+
+class FileBackend(object):
+    """
+    Cache in files under `directory`, shared by every worker on the host.
+    Values are pickled, one file per key, and written under a temporary
+    name then renamed into place so readers never see half a file.
+
+    Expired entries are only removed when read, and entries left under an
+    old namespace version never are, so one `set` in `sweep_every` also
+    sweeps the directory, see sweep().
+    """
+
+    # Temporary files older than this were left by a writer that died
+    STALE_TMP = 3600
+
+    def __init__(self, directory, ttl=300, sweep_every=1000):
+        self.directory = directory
+        self.ttl = ttl
+        self.sweep_every = sweep_every
+        self.swept = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                expires, value = pickle.load(f)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+        if expires is not None and expires <= time.time():
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        self._write(self._path(key), (time.time() + (ttl or self.ttl), value))
+        if self.sweep_every and random.randint(1, self.sweep_every) == 1:
+            self.sweep()
+
+    def delete(self, key):
+        self._remove(self._path(key))
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def sweep(self):
+        """
+        Remove the expired entries and abandoned temporary files, returning
+        how many files were removed. Counters never expire.
+        """
+        now = time.time()
+        removed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.lock'):
+                continue
+            if name.endswith('.tmp'):
+                try:
+                    stale = os.path.getmtime(path) < now - self.STALE_TMP
+                except OSError:
+                    continue
+                if stale:
+                    self._remove(path)
+                    removed += 1
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    expires, value = pickle.load(f)
+            except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+                continue
+            if expires is not None and expires <= now:
+                self._remove(path)
+                removed += 1
+        self.swept += removed
+        return removed
+
+    def incr(self, key):
+        import fcntl
+        path = self._path(key)
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                value = (self.get(key) or 0) + 1
+                # counters never expire
+                self._write(path, (None, value))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return value
+
+    def counter(self, key):
+        return self.get(key) or 0
+
+    def _write(self, path, entry):
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+
+    def stats(self):
+        return {'directory': self.directory, 'swept': self.swept}
+
+
+class RedisBackend(object):
+    """
+    Cache in Redis, or anything speaking its protocol, shared by every
+    worker that can reach it. Needs the redis package unless a client
+    with the same get/set/delete/incr methods is passed in. Counters are
+    kept as plain integers so INCR works on them.
+    """
+
+    def __init__(self, url=None, ttl=300, client=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise ValueError("CACHE_BACKEND 'redis' needs the redis package, see requirements.txt")
+            client = redis.StrictRedis.from_url(url or 'redis://localhost:6379/0')
+        self.client = client
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(key)
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), ex=int(ttl or self.ttl))
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def incr(self, key):
+        return self.client.incr(key)
+
+    def counter(self, key):
+        return int(self.client.get(key) or 0)
+
+    def stats(self):
+        return {}
+
+
+def make_backend(config, instance_path):
+    """
+    The backend named by CACHE_BACKEND: 'memory', 'file' or 'redis'
+    """
+    name = config.get('CACHE_BACKEND', 'memory')
+    ttl = config.get('CACHE_DEFAULT_TTL', 300)
+    if name == 'memory':
+        return MemoryBackend(config.get('CACHE_MEMORY_SIZE', 10000), ttl)
+    if name == 'file':
+        return FileBackend(config.get('CACHE_DIR') or os.path.join(instance_path, 'cache'), ttl,
+                           config.get('CACHE_FILE_SWEEP_EVERY', 1000))
+    if name == 'redis':
+        return RedisBackend(config.get('CACHE_REDIS_URL'), ttl)
+    raise ValueError('Unknown CACHE_BACKEND: {}'.format(name))
+
+
+class SharedCache(object):
+    """
+    Namespaced cache over the configured backend, see make_backend
+
+    Every key lives in a namespace ('prices', 'choices.customers', ...)
+    and is stored under the namespace's current version. Bumping the
+    version, which is kept in the backend too, invalidates the whole
+    namespace for every worker sharing the backend at once without
+    having to find and delete its keys. Single keys can still be deleted.
+    Hits and misses are counted per namespace in each process.
+
+    A request reads each namespace's version once, so its later lookups
+    cost one backend read each.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, backend=None):
+        app.extensions['cache'] = {
+            'backend': backend or make_backend(app.config, app.instance_path),
+            'prefix': app.config.get('CACHE_KEY_PREFIX', 'dreamteam:'),
+            'counters': {},
+        }
+
+    def _state(self, app=None):
+        return (app or current_app).extensions['cache']
+
+    @property
+    def backend(self):
+        return self._state()['backend']
+
+    def _versions(self, app):
+        # The versions read during the current request, if it is one of `app`
+        if not has_request_context() or \
+                (app is not None and app is not current_app._get_current_object()):
+            return None
+        return g.setdefault('_cache_versions', {})
+
+    def version(self, namespace, app=None):
+        state = self._state(app)
+        versions = self._versions(app)
+        if versions is not None and namespace in versions:
+            return versions[namespace]
+        version = state['backend'].counter(u'{}version:{}'.format(state['prefix'], namespace))
+        if versions is not None:
+            versions[namespace] = version
+        return version
+
+    def bump(self, namespace, app=None):
+        """
+        Invalidate everything cached in `namespace`
+        """
+        state = self._state(app)
+        version = state['backend'].incr(u'{}version:{}'.format(state['prefix'], namespace))
+        versions = self._versions(app)
+        if versions is not None:
+            versions[namespace] = version
+        return version
+
+    def _key(self, namespace, key, app=None):
+        state = self._state(app)
+        return u'{}{}:{}:{}'.format(state['prefix'], namespace, self.version(namespace, app), key)
+
+    def get(self, namespace, key):
+        value = self.backend.get(self._key(namespace, key))
+        counters = self._state()['counters'].setdefault(namespace, {'hits': 0, 'misses': 0})
+        counters['hits' if value is not None else 'misses'] += 1
+        return value
+
+    def set(self, namespace, key, value, ttl=None):
+        self.backend.set(self._key(namespace, key), value, ttl)
+
+    def delete(self, namespace, key, app=None):
+        self._state(app)['backend'].delete(self._key(namespace, key, app))
+
+    def stats(self, namespace=None):
+        """
+        This process's hit and miss counts by namespace, with what the
+        backend reports about itself; or the counts of one namespace
+        """
+        state = self._state()
+        namespaces = {}
+        for name, counters in state['counters'].items():
+            lookups = counters['hits'] + counters['misses']
+            namespaces[name] = dict(counters, hit_rate=float(counters['hits']) / lookups if lookups else None)
+        if namespace is not None:
+            return namespaces.get(namespace, {'hits': 0, 'misses': 0, 'hit_rate': None})
+        return {'backend': type(state['backend']).__name__,
+                'storage': state['backend'].stats(),
+                'namespaces': namespaces}
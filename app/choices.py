@@ -0,0 +1,148 @@
+import six
+from flask import current_app
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+from sqlalchemy.inspection import inspect
+
+# Choice lists the forms pick from: the model, the attribute submitted as
+# the value and the attributes joined into the label
+SOURCES = {
+    'customers': ('Customer', 'c_id', ('acc_code',)),
+    'contacts': ('Contact', 'contact_id', ('f_name', 'l_name')),
+    'products': ('Product', 'p_id', ('p_number',)),
+    'quotations': ('Quotation', 'q_id', ('q_num',)),
+    'employees': ('Employee', 'username', ('username',)),
+}
+
+
+def _label(values):
+    return u' '.join(six.text_type(value) for value in values if value not in (None, u''))
+
+
+def _namespace(name):
+    return 'choices.' + name
+
+
+class ChoiceList(object):
+    """
+    The (value, label) pairs of one source, sorted by label, with a value
+    to label mapping for validation and lowercased labels for searching
+    """
+
+    def __init__(self, rows):
+        self.choices = sorted(((row[0], _label(row[1:])) for row in rows),
+                              key=lambda choice: choice[1].lower())
+        self.labels = dict(self.choices)
+        self.lowered = [label.lower() for value, label in self.choices]
+
+    def search(self, prefix, limit):
+        """
+        Up to `limit` choices whose label, or a word in it, starts with
+        `prefix`; labels starting with it come first
+        """
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return self.choices[:limit]
+        starts, words = [], []
+        for choice, lowered in zip(self.choices, self.lowered):
+            if lowered.startswith(prefix):
+                starts.append(choice)
+                if len(starts) == limit:
+                    break
+            elif len(words) < limit and any(word.startswith(prefix) for word in lowered.split()):
+                words.append(choice)
+        return (starts + words)[:limit]
+
+
+class ChoiceCache(object):
+    """
+    Cached choice lists for the select fields
+
+    Each list is built from its value and label columns alone, the first
+    time it is needed, and kept until a commit inserts, deletes or changes
+    the value or label of one of its rows. Bulk statements that bypass the
+    session should call invalidate() themselves.
+
+    The lists live in each process, but whether one is still current is
+    told by the version of its namespace in the shared cache (see
+    app.cache), so invalidating a list in one worker rebuilds it in all.
+    """
+
+    def __init__(self, app=None, db=None, cache=None):
+        self._listening = False
+        if app is not None:
+            self.init_app(app, db, cache)
+
+    def init_app(self, app, db, cache):
+        registry = db.Model._decl_class_registry
+        sources = {}
+        for name, (model_name, value, label) in SOURCES.items():
+            sources[name] = (registry[model_name], value, label)
+        app.extensions['choices'] = {'db': db, 'cache': cache, 'sources': sources, 'lists': {}}
+
+        if not self._listening:
+            event.listen(SignallingSession, 'after_flush', self._after_flush)
+            event.listen(SignallingSession, 'after_commit', self._after_commit)
+            event.listen(SignallingSession, 'after_rollback', self._after_rollback)
+            self._listening = True
+
+    def _state(self, app=None):
+        return (app or current_app).extensions['choices']
+
+    def choice_list(self, name):
+        state = self._state()
+        version = state['cache'].version(_namespace(name))
+        cached = state['lists'].get(name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        model, value, label = state['sources'][name]
+        columns = [getattr(model, attr) for attr in (value,) + label]
+        # from the primary, a lagging replica would cache a stale list
+        with state['db'].primary():
+            choice_list = ChoiceList(state['db'].session.query(*columns))
+        state['lists'][name] = (version, choice_list)
+        return choice_list
+
+    def choices(self, name):
+        return self.choice_list(name).choices
+
+    def label(self, name, value):
+        """
+        The label of `value`, or None when it is not a valid choice
+        """
+        return self.choice_list(name).labels.get(value)
+
+    def search(self, name, prefix, limit):
+        return self.choice_list(name).search(prefix, limit)
+
+    def invalidate(self, *models, **kwargs):
+        state = self._state(kwargs.get('app'))
+        for name, (model, value, label) in state['sources'].items():
+            if model in models:
+                state['lists'].pop(name, None)
+                state['cache'].bump(_namespace(name), kwargs.get('app'))
+
+    def _after_flush(self, session, flush_context):
+        changed = session.info.setdefault('choices_changed', set())
+        for obj in list(session.new) + list(session.deleted):
+            changed.add(type(obj))
+        for obj in session.dirty:
+            state = inspect(obj)
+            if any(state.attrs[attr].history.has_changes()
+                   for attr in self._watched(session.app, type(obj))):
+                changed.add(type(obj))
+
+    def _watched(self, app, model):
+        attrs = set()
+        for source_model, value, label in self._state(app)['sources'].values():
+            if source_model is model:
+                attrs.update((value,) + label)
+        return attrs
+
+    def _after_commit(self, session):
+        changed = session.info.pop('choices_changed', None)
+        if changed:
+            self.invalidate(*changed, app=session.app)
+
+    def _after_rollback(self, session):
+        session.info.pop('choices_changed', None)
@@ -0,0 +1,102 @@
+from sqlalchemy import case, func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.inspection import inspect
+
+from . import choice_cache, dashboard_snapshot, db, search_index
+from .models import Product, Quotation, Quotation_Detail
+
+# Attempts at allocating quotation numbers before giving up, for when
+# another clone takes the same numbers first
+ATTEMPTS = 3
+
+
+def next_quotation_numbers(count):
+    """
+    `count` unused quotation numbers following the highest one in use
+    """
+    highest = db.session.query(func.max(Quotation.q_num)).scalar() or 0
+    return list(range(highest + 1, highest + 1 + count))
+
+
+def clone_quotations(ids):
+    """
+    Copy the quotations with the given ids, details and all, in one
+    transaction and return the copies in the same order. Ids that do not
+    exist are skipped.
+
+    Each copy gets a new quotation number from next_quotation_numbers; the
+    unique constraint on the number catches a concurrent clone taking the
+    same ones, in which case the clone is retried with fresh numbers.
+    """
+    ids = list(ids)
+    sources = [q_id for q_id, in db.session.query(Quotation.q_id).filter(Quotation.q_id.in_(ids))]
+    if not sources:
+        return []
+    sources.sort(key=ids.index)
+
+    for attempt in range(ATTEMPTS):
+        numbers = dict(zip(sources, next_quotation_numbers(len(sources))))
+        try:
+            new_ids = _copy(numbers)
+            db.session.commit()
+            break
+        except IntegrityError:
+            db.session.rollback()
+            if attempt == ATTEMPTS - 1:
+                raise
+
+    copies = Quotation.query.filter(Quotation.q_id.in_(list(new_ids.values()))).all()
+    # The copies were written with plain SQL, out of sight of the session
+    search_index.update(Quotation, copies)
+    choice_cache.invalidate(Quotation)
+    dashboard_snapshot.invalidate()
+    copies = dict((copy.q_id, copy) for copy in copies)
+    return [copies[new_ids[q_id]] for q_id in sources]
+
+
+def clone_quotation(q_id):
+    """
+    Copy one quotation, returning the copy or None if it does not exist
+    """
+    copies = clone_quotations([q_id])
+    return copies[0] if copies else None
+
+
+def _copy(numbers):
+    # Copy the headers with one INSERT ... SELECT, giving each its new
+    # number, then the details of all of them with another. Returns a
+    # mapping from source to copy ids.
+    quotations = inspect(Quotation).columns
+    details = inspect(Quotation_Detail).columns
+    products = inspect(Product).columns
+
+    header_columns = [column for key, column in quotations.items()
+                      if key not in ('q_id', 'q_num')]
+    new_number = case(numbers, value=quotations['q_id'])
+    headers = select(header_columns + [new_number]).where(quotations['q_id'].in_(list(numbers)))
+    db.session.execute(Quotation.__table__.insert().from_select(
+        header_columns + [quotations['q_num']], headers))
+
+    new_ids = dict(db.session.query(Quotation.q_num, Quotation.q_id)
+                   .filter(Quotation.q_num.in_(list(numbers.values()))))
+    new_ids = dict((source, new_ids[number]) for source, number in numbers.items())
+
+    # Lines take the current name and number of their product, as the
+    # details form does, or keep their own if the product is gone
+    lines = select([case(new_ids, value=details['q_id']),
+                    details['p_id'],
+                    func.coalesce(products['p_name'], details['p_name']),
+                    case(numbers, value=details['q_id']),
+                    func.coalesce(products['p_number'], details['p_num']),
+                    details['quantity'],
+                    details['discount'],
+                    details['q_price'],
+                    details['option']]) \
+        .select_from(Quotation_Detail.__table__.outerjoin(Product.__table__,
+                                                          details['p_id'] == products['p_id'])) \
+        .where(details['q_id'].in_(list(numbers))) \
+        .order_by(details['quote_detail_id'])
+    db.session.execute(Quotation_Detail.__table__.insert().from_select(
+        [details[key] for key in ('q_id', 'p_id', 'p_name', 'q_num', 'p_num',
+                                  'quantity', 'discount', 'q_price', 'option')], lines))
+    return new_ids
@@ -0,0 +1,61 @@
+import click
+
+from . import dashboard_snapshot, db, search_index
+from .pipeline import rebuild
+from .queryplan import check_indexes
+from .search import searchable_models
+from .totals import reconcile
+
+
+def register_commands(app):
+    """
+    Maintenance commands, run with `flask <command>`
+    """
+
+    @app.cli.command('search-reindex')
+    def search_reindex():
+        """
+        Rebuild the full-text search indexes from the database
+        """
+        for model in searchable_models(db):
+            count = search_index.rebuild(model)
+            click.echo('Indexed {} {} rows'.format(count, model.__name__))
+
+    @app.cli.command('reconcile-totals')
+    def reconcile_totals():
+        """
+        Recompute every quotation's totals from its details
+        """
+        click.echo('Repaired the totals of {} quotations'.format(reconcile()))
+
+    @app.cli.command('rebuild-pipeline')
+    def rebuild_pipeline():
+        """
+        Recompute the pipeline rollups from the opportunities
+        """
+        click.echo('Rolled up the pipeline into {} groups'.format(rebuild()))
+
+    @app.cli.command('refresh-dashboard')
+    def refresh_dashboard():
+        """
+        Recompute the dashboard KPIs, e.g. from cron
+        """
+        dashboard_snapshot.refresh()
+        click.echo('Refreshed the dashboard')
+
+    @app.cli.command('check-indexes')
+    def check_indexes_command():
+        """
+        Report the common lookups the database answers with a full table scan
+        """
+        failed = 0
+        for description, tables in check_indexes():
+            if tables is None:
+                raise click.ClickException('Query plans are not understood for this database')
+            if tables:
+                failed += 1
+                click.echo('{}: full scan of {}'.format(description, ', '.join(tables)))
+            else:
+                click.echo('{}: ok'.format(description))
+        if failed:
+            raise click.ClickException('{} lookups do full scans'.format(failed))
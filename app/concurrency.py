@@ -0,0 +1,49 @@
+from sqlalchemy.orm.exc import StaleDataError
+
+from . import db
+
+CONFLICT_MESSAGE = ('Someone else changed this record while you were editing it. '
+                    'It is shown below as it is now; please make your changes again.')
+
+
+class EditConflict(Exception):
+    """
+    Raised when a form was filled from an older version of its row than
+    the one now in the database
+    """
+
+
+def check_version(obj, version):
+    """
+    Raise EditConflict unless `version`, posted back by the form, is the
+    version `obj` has now. A form posted without one is not checked here;
+    the versioned UPDATE still catches a change made since `obj` was read.
+    """
+    if version in (None, u''):
+        return
+    try:
+        version = int(version)
+    except (TypeError, ValueError):
+        raise EditConflict()
+    if version != obj.version:
+        raise EditConflict()
+
+
+def retry_on_conflict(operation, attempts=3):
+    """
+    Run `operation` and commit, starting again with fresh rows when one
+    of those it changed was changed by someone else in the meantime. For
+    changes that do not depend on what the employee saw, such as toggling
+    or removing a quotation line: `operation` reads the line again each
+    time, so the totals are moved from its latest amounts. Returns what
+    `operation` returns.
+    """
+    for attempt in range(attempts):
+        try:
+            result = operation()
+            db.session.commit()
+            return result
+        except StaleDataError:
+            db.session.rollback()
+            if attempt == attempts - 1:
+                raise
@@ -0,0 +1,201 @@
+import threading
+import time
+
+from flask import current_app
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import and_, desc, event, exists, func
+from sqlalchemy.inspection import inspect
+
+NAMESPACE = 'dashboard'
+# Bumped by every commit changing what the KPIs are computed from
+WRITES = 'dashboard.writes'
+# How long a snapshot is kept, stale or not, and how long a refresh may
+# take before another worker is allowed to try
+KEEP = 24 * 60 * 60
+REFRESH_TIMEOUT = 5 * 60
+
+MODELS = ('Customer', 'Product', 'Quotation', 'Quotation_Detail', 'Opportunity')
+
+# The attributes the KPIs depend on, by model; the pipeline fields of
+# opportunities are added in init_app. The line fields besides quantity
+# and product move the quotation amount.
+WATCHED = {
+    'Customer': ('c_id', 'acc_code', 'comp_name'),
+    'Quotation': ('q_id', 'c_id', 'q_amount'),
+    'Quotation_Detail': ('q_id', 'p_num', 'p_name', 'quantity', 'q_price', 'discount', 'option'),
+    'Opportunity': ('q_id', 'actual_money'),
+}
+
+
+class DashboardSnapshot(object):
+    """
+    KPIs for the dashboards, computed away from the request path
+
+    The latest snapshot is kept in the shared cache (see app.cache) and
+    served as is. When a commit has added, deleted or changed the WATCHED
+    attributes of quotations, their details, customers or opportunities
+    since, or it is older than
+    DASHBOARD_MAX_AGE seconds, a request schedules a refresh in a
+    background thread and still gets the snapshot it found. With
+    DASHBOARD_BACKGROUND off the refresh runs inline instead, as in the
+    tests. `flask refresh-dashboard` refreshes it from cron.
+    """
+
+    def __init__(self, app=None, db=None, cache=None):
+        self._listening = False
+        if app is not None:
+            self.init_app(app, db, cache)
+
+    def init_app(self, app, db, cache):
+        from .pipeline import FIELDS
+        registry = db.Model._decl_class_registry
+        watched = dict((registry[name], set(fields)) for name, fields in WATCHED.items())
+        watched[registry['Opportunity']].update(FIELDS)
+        app.extensions['dashboard'] = {
+            'db': db, 'cache': cache, 'lock': threading.Lock(),
+            'models': tuple(registry[name] for name in MODELS),
+            'watched': watched,
+            'max_age': app.config.get('DASHBOARD_MAX_AGE', 300),
+            'top': app.config.get('DASHBOARD_TOP', 10),
+            'background': app.config.get('DASHBOARD_BACKGROUND', True),
+        }
+
+        if not self._listening:
+            event.listen(SignallingSession, 'after_flush', self._after_flush)
+            event.listen(SignallingSession, 'after_commit', self._after_commit)
+            event.listen(SignallingSession, 'after_rollback', self._after_rollback)
+            self._listening = True
+
+    def _state(self, app=None):
+        return (app or current_app).extensions['dashboard']
+
+    def get(self):
+        """
+        The latest snapshot, or None until the first one is computed
+        """
+        state = self._state()
+        snapshot = state['cache'].get(NAMESPACE, 'snapshot')
+        if snapshot is None or self._stale(snapshot):
+            self.schedule()
+            if not state['background']:
+                snapshot = state['cache'].get(NAMESPACE, 'snapshot')
+        return snapshot
+
+    def _stale(self, snapshot):
+        state = self._state()
+        return snapshot['version'] != state['cache'].version(WRITES) or \
+            time.time() - snapshot['computed_at'] > state['max_age']
+
+    def schedule(self):
+        """
+        Refresh the snapshot in a background thread, unless this or another
+        worker is already at it
+        """
+        state = self._state()
+        if not state['background']:
+            self.refresh()
+            return
+        if state['cache'].get(NAMESPACE, 'refreshing') or not state['lock'].acquire(False):
+            return
+        state['cache'].set(NAMESPACE, 'refreshing', True, REFRESH_TIMEOUT)
+        thread = threading.Thread(target=self._refresh_in_background,
+                                  args=(current_app._get_current_object(),))
+        thread.daemon = True
+        thread.start()
+
+    def _refresh_in_background(self, app):
+        state = self._state(app)
+        try:
+            with app.app_context():
+                try:
+                    self.refresh()
+                finally:
+                    state['db'].session.remove()
+        finally:
+            state['lock'].release()
+
+    def refresh(self):
+        """
+        Compute a new snapshot and store it. Returns it.
+        """
+        state = self._state()
+        # Read first, so a write made while computing triggers another refresh
+        version = state['cache'].version(WRITES)
+        try:
+            snapshot = self.compute()
+            snapshot.update(version=version, computed_at=time.time())
+            state['cache'].set(NAMESPACE, 'snapshot', snapshot, KEEP)
+        finally:
+            # let the next request try again should this one fail
+            state['cache'].delete(NAMESPACE, 'refreshing')
+        return snapshot
+
+    def compute(self):
+        """
+        The KPIs as plain values, with one aggregate query each:
+
+        - open quotations, those without a won opportunity: count and value
+        - top customers by quoted amount
+        - top products by quoted quantity
+        - the pipeline by sales stage, from the pipeline rollups
+        """
+        from .pipeline import rollup_frame, weighted_pipeline
+        state = self._state()
+        session = state['db'].session
+        customer, product, quotation, detail, opportunity = state['models']
+        top = state['top']
+
+        won = exists().where(and_(opportunity.q_id == quotation.q_id,
+                                  opportunity.actual_money > 0))
+        count, value = session.query(func.count(quotation.q_id),
+                                     func.coalesce(func.sum(quotation.q_amount), 0)) \
+            .filter(~won).one()
+
+        amount = func.coalesce(func.sum(quotation.q_amount), 0).label('amount')
+        customers = session.query(customer.acc_code, customer.comp_name, amount) \
+            .join(quotation, quotation.c_id == customer.c_id) \
+            .group_by(customer.c_id, customer.acc_code, customer.comp_name) \
+            .order_by(desc(amount)).limit(top).all()
+
+        quantity = func.coalesce(func.sum(detail.quantity), 0).label('quantity')
+        products = session.query(detail.p_num, func.max(detail.p_name), quantity) \
+            .group_by(detail.p_num) \
+            .order_by(desc(quantity)).limit(top).all()
+
+        pipeline = weighted_pipeline(rollup_frame())
+        return {
+            'open_quotations': {'count': count, 'value': value},
+            'top_customers': [tuple(row) for row in customers],
+            'top_products': [tuple(row) for row in products],
+            'pipeline': [(int(row.sales_stage), int(row.opportunities), float(row.potential),
+                          float(row.weighted)) for row in pipeline.itertuples(index=False)],
+        }
+
+    def invalidate(self, app=None):
+        """
+        Have the next request refresh the snapshot, for bulk statements
+        that bypass the session
+        """
+        self._state(app)['cache'].bump(WRITES, app)
+
+    def _after_flush(self, session, flush_context):
+        watched = self._state(session.app)['watched']
+        for obj in list(session.new) + list(session.deleted):
+            if type(obj) in watched:
+                session.info['dashboard_stale'] = True
+                return
+        for obj in session.dirty:
+            fields = watched.get(type(obj))
+            if fields is None:
+                continue
+            attrs = inspect(obj).attrs
+            if any(attrs[field].history.has_changes() for field in fields):
+                session.info['dashboard_stale'] = True
+                return
+
+    def _after_commit(self, session):
+        if session.info.pop('dashboard_stale', False):
+            self.invalidate(app=session.app)
+
+    def _after_rollback(self, session):
+        session.info.pop('dashboard_stale', None)
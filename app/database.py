@@ -0,0 +1,367 @@
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy, SignallingSession, _EngineConnector
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.selectable import CompoundSelect, Select
+
+from .profiling import TIME_BUCKETS, Histogram
+
+# Options only a QueuePool takes, dropped for SQLite's own pools
+QUEUE_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+
+class PoolStats(object):
+    """
+    What an engine's pool has done in this process: connections checked
+    out now and at most, checkouts, new connections, idle connections
+    pinged and found dead, timeouts, and how long checkouts waited
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.checkouts = 0
+        self.connects = 0
+        self.pings = 0
+        self.dead = 0
+        self.timeouts = 0
+        self.wait = Histogram(TIME_BUCKETS)
+
+    def count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def checkout(self):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+
+    def checkin(self):
+        with self._lock:
+            self.checked_out = max(0, self.checked_out - 1)
+
+    def waited(self, seconds, timed_out=False):
+        with self._lock:
+            self.wait.add(seconds * 1000)
+            if timed_out:
+                self.timeouts += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'checked_out': self.checked_out,
+                'peak_checked_out': self.peak_checked_out,
+                'checkouts': self.checkouts,
+                'connects': self.connects,
+                'pings': self.pings,
+                'dead': self.dead,
+                'timeouts': self.timeouts,
+                'wait_ms': self.wait.as_dict(),
+            }
+
+
+class MeteredQueuePool(QueuePool):
+    """
+    A QueuePool timing how long each checkout waits for a connection,
+    opening it if need be, into its `stats`
+    """
+
+    stats = None
+
+    def _do_get(self):
+        started = time.time()
+        try:
+            connection = super(MeteredQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            if self.stats is not None:
+                self.stats.waited(time.time() - started, timed_out=True)
+            raise
+        if self.stats is not None:
+            self.stats.waited(time.time() - started)
+        return connection
+
+    def recreate(self):
+        # disposing of the engine swaps its pool for a new one
+        pool = super(MeteredQueuePool, self).recreate()
+        pool.stats = self.stats
+        return pool
+
+
+def read_only(view):
+    """
+    Mark a view as only reading, so that its GET requests may be answered
+    from a read replica
+    """
+    view.read_only = True
+    return view
+
+
+class ReplicaSet(object):
+    """
+    An app's read replicas, taken in turn. Each is health checked at most
+    every `check_interval` seconds, and one that fails the check, or whose
+    connection drops, is skipped until it passes again.
+    """
+
+    def __init__(self, check_interval=10, clock=time.time):
+        self.check_interval = check_interval
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._turn = 0
+        # engine: (time of the last check, whether it passed)
+        self._health = weakref.WeakKeyDictionary()
+
+    def pick(self, engines):
+        """
+        The next healthy engine of `engines`, or None when none is
+        """
+        if not engines:
+            return None
+        with self._lock:
+            start = self._turn
+            self._turn = (self._turn + 1) % len(engines)
+        for n in range(len(engines)):
+            engine = engines[(start + n) % len(engines)]
+            if self.healthy(engine):
+                return engine
+        return None
+
+    def healthy(self, engine):
+        now = self.clock()
+        with self._lock:
+            if engine not in self._health:
+                event.listen(engine, 'handle_error', self._failed)
+                self._health[engine] = (None, True)
+            checked, healthy = self._health[engine]
+        if checked is not None and now - checked < self.check_interval:
+            return healthy
+        passed = self.check(engine)
+        with self._lock:
+            self._health[engine] = (now, passed)
+        return passed
+
+    def check(self, engine):
+        try:
+            connection = engine.raw_connection()
+        except exc.DBAPIError:
+            return False
+        try:
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+        except engine.dialect.dbapi.Error:
+            connection.invalidate()
+            return False
+        finally:
+            connection.close()
+        return True
+
+    def _failed(self, context):
+        if context.is_disconnect:
+            with self._lock:
+                self._health[context.engine] = (self.clock(), False)
+
+
+class RoutingSession(SignallingSession):
+    """
+    A session that reads from the replica picked for the request, if any,
+    and writes to the primary. SELECT ... FOR UPDATE and anything but a
+    SELECT goes to the primary, and so does every statement after the
+    first write, so a request reads its own writes.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_request_context():
+            replica = g.get('_db_replica')
+            if isinstance(clause, (Select, CompoundSelect)):
+                if replica is not None and getattr(clause, '_for_update_arg', None) is None:
+                    return replica
+            elif clause is None or isinstance(clause, UpdateBase):
+                # a flush, or an INSERT, UPDATE or DELETE
+                g._db_replica = None
+                g._db_wrote = True
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class _Connector(_EngineConnector):
+    """
+    An engine connector that also knows the read replicas, as ('replica', n)
+    binds
+    """
+
+    def get_uri(self):
+        if isinstance(self._bind, tuple):
+            return self._app.config['DATABASE_REPLICA_URIS'][self._bind[1]]
+        return super(_Connector, self).get_uri()
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    """
+    Flask-SQLAlchemy with the engine settings of the app configuration
+
+    Besides Flask-SQLAlchemy's SQLALCHEMY_POOL_SIZE, SQLALCHEMY_MAX_OVERFLOW,
+    SQLALCHEMY_POOL_TIMEOUT and SQLALCHEMY_POOL_RECYCLE, a connection idle
+    for more than DATABASE_PRE_PING seconds is pinged when checked out and
+    replaced if the server has dropped it, and DATABASE_STATEMENT_TIMEOUT
+    milliseconds, when set, limits each statement on MySQL and PostgreSQL.
+    The engines of DATABASE_REPLICA_URIS are set up the same way. Each
+    engine's pool is metered, see pool_stats().
+
+    GET requests to views marked read_only read from a replica, picked in
+    turn among those passing a health check every DATABASE_REPLICA_CHECK
+    seconds, or from the primary when none does. After an employee writes,
+    their requests read from the primary for DATABASE_REPLICA_PIN seconds,
+    to outlast the replication lag.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SQLAlchemy, self).__init__(*args, **kwargs)
+        self._pool_stats = weakref.WeakKeyDictionary()
+        self._metering = threading.Lock()
+
+    def init_app(self, app):
+        super(SQLAlchemy, self).init_app(app)
+        app.extensions['replicas'] = ReplicaSet(app.config.get('DATABASE_REPLICA_CHECK', 10))
+        app.before_request(self._route_request)
+        app.after_request(self._pin_writer)
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def _route_request(self):
+        g._db_replica = None
+        g._db_wrote = False
+        if request.method not in ('GET', 'HEAD') or \
+                not current_app.config.get('DATABASE_REPLICA_URIS'):
+            return
+        if not getattr(current_app.view_functions.get(request.endpoint), 'read_only', False):
+            return
+        if session.get('db_primary_until', 0) > time.time():
+            return
+        g._db_replica = current_app.extensions['replicas'].pick(self.replica_engines())
+
+    def _pin_writer(self, response):
+        if g.get('_db_wrote') and current_app.config.get('DATABASE_REPLICA_URIS'):
+            session['db_primary_until'] = time.time() + \
+                current_app.config.get('DATABASE_REPLICA_PIN', 10)
+        return response
+
+    @contextmanager
+    def primary(self):
+        """
+        Read from the primary within the block, for reads that must see the
+        latest writes, such as those filling a cache
+        """
+        if not has_request_context():
+            yield
+            return
+        replica, g._db_replica = g.get('_db_replica'), None
+        try:
+            yield
+        finally:
+            if not g.get('_db_wrote'):
+                g._db_replica = replica
+
+    def make_connector(self, app, bind=None):
+        return _Connector(self, app, bind)
+
+    def apply_driver_hacks(self, app, info, options):
+        super(SQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if info.drivername.startswith('sqlite'):
+            for option in QUEUE_OPTIONS:
+                options.pop(option, None)
+        elif 'poolclass' not in options:
+            options['poolclass'] = MeteredQueuePool
+
+    def get_engine(self, app, bind=None):
+        engine = super(SQLAlchemy, self).get_engine(app, bind)
+        if engine not in self._pool_stats:
+            with self._metering:
+                if engine not in self._pool_stats:
+                    self._pool_stats[engine] = self._meter(engine, app.config)
+        return engine
+
+    def replica_engines(self, app=None):
+        """
+        The engine of each of DATABASE_REPLICA_URIS
+        """
+        app = self.get_app(app)
+        return [self.get_engine(app, ('replica', n))
+                for n in range(len(app.config.get('DATABASE_REPLICA_URIS') or ()))]
+
+    def _meter(self, engine, config):
+        stats = PoolStats()
+        if isinstance(engine.pool, MeteredQueuePool):
+            engine.pool.stats = stats
+        idle = config.get('DATABASE_PRE_PING')
+        timeout = config.get('DATABASE_STATEMENT_TIMEOUT')
+        dialect = engine.dialect.name
+        dbapi_error = engine.dialect.dbapi.Error
+
+        def connect(dbapi_connection, connection_record):
+            stats.count('connects')
+            if timeout and dialect in ('mysql', 'postgresql'):
+                cursor = dbapi_connection.cursor()
+                if dialect == 'mysql':
+                    # limits SELECTs only, from MySQL 5.7.8
+                    cursor.execute('SET SESSION max_execution_time = %d' % timeout)
+                else:
+                    cursor.execute('SET statement_timeout = %d' % timeout)
+                cursor.close()
+
+        def checkout(dbapi_connection, connection_record, connection_proxy):
+            checked_in = connection_record.info.pop('checked_in', None)
+            if idle is not None and checked_in is not None and time.time() - checked_in > idle:
+                stats.count('pings')
+                cursor = dbapi_connection.cursor()
+                try:
+                    cursor.execute('SELECT 1')
+                except dbapi_error:
+                    stats.count('dead')
+                    # the pool opens a new connection in its place
+                    raise exc.DisconnectionError()
+                finally:
+                    cursor.close()
+            stats.checkout()
+
+        def checkin(dbapi_connection, connection_record):
+            connection_record.info['checked_in'] = time.time()
+            stats.checkin()
+
+        event.listen(engine, 'connect', connect)
+        event.listen(engine, 'checkout', checkout)
+        event.listen(engine, 'checkin', checkin)
+        return stats
+
+    def pool_stats(self, app=None):
+        """
+        The pool of the primary and of each replica: its configured and
+        current size, connections checked out and in use beyond the pool
+        size, utilisation of the most it may open, and its PoolStats
+        """
+        app = self.get_app(app)
+        engines = [('primary', self.get_engine(app))]
+        engines += [('replica {}'.format(n), engine)
+                    for n, engine in enumerate(self.replica_engines(app))]
+        result = []
+        for name, engine in engines:
+            pool = engine.pool
+            stats = self._pool_stats[engine].as_dict()
+            stats.update(name=name, url=repr(engine.url), pool=type(pool).__name__)
+            if isinstance(pool, QueuePool):
+                # a negative max_overflow lets the pool open any number
+                capacity = pool.size() + pool._max_overflow if pool._max_overflow >= 0 else None
+                stats.update(size=pool.size(), max_overflow=pool._max_overflow,
+                             checked_in=pool.checkedin(), overflow=max(pool.overflow(), 0),
+                             timeout=pool._timeout,
+                             utilisation=float(pool.checkedout()) / capacity if capacity else None)
+            result.append(stats)
+        return result
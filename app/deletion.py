@@ -0,0 +1,92 @@
+from . import choice_cache, dashboard_snapshot, db, price_cache, search_index
+from .models import Contact, Customer, Opportunity, Product, Quotation, Quotation_Detail
+from .pipeline import FIELDS, apply_changes
+
+
+def _existing(pk, ids):
+    ids = list(set(ids))
+    if not ids:
+        return []
+    return [value for value, in db.session.query(pk).filter(pk.in_(ids))]
+
+
+def _delete_quotation_rows(q_ids):
+    # Delete quotations with their details and opportunities, one DELETE per
+    # table, taking the opportunities off the pipeline rollups on the way.
+    # Returns the ids of the opportunities deleted.
+    columns = [Opportunity.o_id] + [getattr(Opportunity, field) for field in FIELDS]
+    opportunities = db.session.query(*columns).filter(Opportunity.q_id.in_(q_ids)).all()
+    if opportunities:
+        apply_changes(db.session.connection(),
+                      removed=[dict(zip(FIELDS, row[1:])) for row in opportunities])
+        Opportunity.query.filter(Opportunity.q_id.in_(q_ids)).delete(synchronize_session=False)
+    Quotation_Detail.query.filter(Quotation_Detail.q_id.in_(q_ids)).delete(synchronize_session=False)
+    Quotation.query.filter(Quotation.q_id.in_(q_ids)).delete(synchronize_session=False)
+    return [row[0] for row in opportunities]
+
+
+def _forget(deleted):
+    # The deletes bypassed the session, so its events did not see them
+    for model, pks in deleted.items():
+        search_index.remove(model, pks)
+    choice_cache.invalidate(*[model for model, pks in deleted.items() if pks])
+    dashboard_snapshot.invalidate()
+
+
+def delete_quotations(ids):
+    """
+    Delete the quotations with the given ids, with their details and
+    opportunities, in one transaction. Ids that do not exist are skipped.
+    Returns the number of quotations deleted.
+    """
+    q_ids = _existing(Quotation.q_id, ids)
+    if not q_ids:
+        return 0
+    o_ids = _delete_quotation_rows(q_ids)
+    db.session.commit()
+    _forget({Quotation: q_ids, Opportunity: o_ids})
+    return len(q_ids)
+
+
+def delete_customers(ids):
+    """
+    Delete the customers with the given ids, with their contacts and their
+    quotations, details and opportunities included, in one transaction.
+    Returns the number of customers deleted.
+    """
+    c_ids = _existing(Customer.c_id, ids)
+    if not c_ids:
+        return 0
+    q_ids = [q_id for q_id, in db.session.query(Quotation.q_id).filter(Quotation.c_id.in_(c_ids))]
+    contact_ids = [contact_id for contact_id, in
+                   db.session.query(Contact.contact_id).filter(Contact.c_id.in_(c_ids))]
+    o_ids = _delete_quotation_rows(q_ids) if q_ids else []
+    Contact.query.filter(Contact.c_id.in_(c_ids)).delete(synchronize_session=False)
+    Customer.query.filter(Customer.c_id.in_(c_ids)).delete(synchronize_session=False)
+    db.session.commit()
+    _forget({Customer: c_ids, Contact: contact_ids, Quotation: q_ids, Opportunity: o_ids})
+    return len(c_ids)
+
+
+def delete_products(ids):
+    """
+    Delete the products with the given ids in one statement, except those
+    still quoted on a quotation line. Returns the number deleted and the
+    part numbers of the ones kept.
+    """
+    products = db.session.query(Product.p_id, Product.p_number) \
+        .filter(Product.p_id.in_(list(set(ids)))).all() if ids else []
+    if not products:
+        return 0, []
+    quoted = set(p_id for p_id, in db.session.query(Quotation_Detail.p_id).distinct()
+                 .filter(Quotation_Detail.p_id.in_([p_id for p_id, p_number in products])))
+    kept = [p_number for p_id, p_number in products if p_id in quoted]
+    deleted = [(p_id, p_number) for p_id, p_number in products if p_id not in quoted]
+    if deleted:
+        Product.query.filter(Product.p_id.in_([p_id for p_id, p_number in deleted])) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+        for p_id, p_number in deleted:
+            price_cache.invalidate(p_id, p_number)
+        _forget({Product: [p_id for p_id, p_number in deleted]})
+    return len(deleted), kept
@@ -0,0 +1,87 @@
+from sqlalchemy.orm import joinedload
+
+from . import db
+from .models import Contact, Customer, Product, Quotation, Quotation_Detail
+from .totals import line_totals
+
+
+class QuotationDocument(object):
+    """
+    A quotation with its customer, contact, lines and their products all
+    loaded up front, plus its totals, ready to be rendered or exported
+    """
+
+    def __init__(self, quotation, details):
+        self.quotation = quotation
+        self.customer = quotation.customer
+        self.contact = quotation.contact
+        self.details = details
+        self.required = [detail for detail in details if not detail.option]
+        self.optional = [detail for detail in details if detail.option]
+
+        # the PDF has always totalled every line, optional ones included
+        subtotal = total = optional = 0
+        for detail in details:
+            gross = (detail.quantity or 0) * (detail.q_price or 0)
+            subtotal += gross
+            total += gross * (1 - (detail.discount or 0))
+            optional += line_totals(detail.quantity, detail.q_price, detail.discount,
+                                    detail.option)[2]
+        self.subtotal = subtotal
+        self.total = total
+        self.optional_total = optional
+
+    def context(self):
+        """
+        Template variables for the quotation views and the PDF
+        """
+        return dict(quotation=self.quotation,
+                    customer=self.customer,
+                    contact=self.contact,
+                    quote_details=self.details,
+                    subtotal=self.subtotal,
+                    total=self.total,
+                    optional_total=self.optional_total)
+
+
+def load_quotation_document(q_id):
+    """
+    Build the document for quotation `q_id` in two queries, one for the
+    quotation with its customer and contact and one for its lines with
+    their products. Returns None if there is no such quotation.
+    """
+    quotation = Quotation.query \
+        .options(joinedload(Quotation.customer), joinedload(Quotation.contact)) \
+        .filter_by(q_id=q_id).first()
+    if quotation is None:
+        return None
+
+    details = Quotation_Detail.query \
+        .options(joinedload(Quotation_Detail.product)) \
+        .filter_by(q_id=q_id) \
+        .order_by(Quotation_Detail.quote_detail_id).all()
+    return QuotationDocument(quotation, details)
+
+
+def document_fingerprint(q_id):
+    """
+    What the document of quotation `q_id` is built from, without loading
+    it: the row versions of the quotation and its customer, the contact's
+    name, and each line's id and version with its product's number and
+    name, in two narrow queries. It changes whenever the document would.
+    Returns None if there is no such quotation.
+    """
+    header = db.session.query(Quotation.version, Customer.version,
+                              Contact.f_name, Contact.l_name) \
+        .outerjoin(Customer, Customer.c_id == Quotation.c_id) \
+        .outerjoin(Contact, Contact.contact_id == Quotation.contact_id) \
+        .filter(Quotation.q_id == q_id).first()
+    if header is None:
+        return None
+
+    lines = db.session.query(Quotation_Detail.quote_detail_id, Quotation_Detail.version,
+                             Product.p_number, Product.p_name) \
+        .outerjoin(Product, Product.p_id == Quotation_Detail.p_id) \
+        .filter(Quotation_Detail.q_id == q_id) \
+        .order_by(Quotation_Detail.quote_detail_id).all()
+    return q_id, tuple(header), tuple(tuple(line) for line in lines)
@@ -0,0 +1,128 @@
+import csv
+import io
+import os
+import tempfile
+
+import six
+from flask import Response, current_app, stream_with_context
+from sqlalchemy.inspection import inspect
+
+# Bytes of the file sent at a time
+CHUNK_SIZE = 64 * 1024
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+def export_columns(model):
+    """
+    (heading, column attribute) for every column of `model`, headed by its
+    name in the database, which is the readable one in this schema
+    """
+    mapper = inspect(model)
+    return [(prop.columns[0].name, getattr(model, prop.key)) for prop in mapper.column_attrs]
+
+
+def export_rows(query, model, batch_size=None):
+    """
+    Yield the rows of `query` as tuples of the export_columns of `model`,
+    in primary key order, fetched `batch_size` at a time from a server
+    side cursor where the driver has one, so memory use does not grow with
+    the number of rows
+    """
+    batch_size = batch_size or current_app.config.get('EXPORT_BATCH_SIZE', 1000)
+    columns = [attr for heading, attr in export_columns(model)]
+    primary_key = inspect(model).primary_key
+    query = query.with_entities(*columns).order_by(*primary_key) \
+        .enable_eagerloads(False) \
+        .execution_options(stream_results=True) \
+        .yield_per(batch_size)
+    for row in query:
+        yield tuple(row)
+
+
+def _text(value):
+    if value is None:
+        return u''
+    if isinstance(value, bool):
+        return u'Y' if value else u'N'
+    return six.text_type(value)
+
+
+def csv_chunks(header, rows):
+    """
+    Yield a CSV file, UTF-8 with a byte order mark so Excel reads it as
+    such, in chunks of about CHUNK_SIZE bytes
+    """
+    buffer = io.BytesIO() if six.PY2 else io.StringIO()
+    buffer.write(u'\ufeff'.encode('utf-8') if six.PY2 else u'\ufeff')
+    writer = csv.writer(buffer)
+    for row in _with_header(header, rows):
+        cells = [_text(value) for value in row]
+        if six.PY2:
+            cells = [cell.encode('utf-8') for cell in cells]
+        writer.writerow(cells)
+        if buffer.tell() >= CHUNK_SIZE:
+            yield _drain(buffer)
+    yield _drain(buffer)
+
+
+def _drain(buffer):
+    chunk = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return chunk if six.PY2 else chunk.encode('utf-8')
+
+
+def xlsx_chunks(header, rows, title='Export'):
+    """
+    Yield an xlsx workbook in chunks. A write-only workbook keeps the rows
+    in a temporary file rather than in memory; the zipped workbook is then
+    written to another one and read back, since xlsx cannot be produced
+    front to back.
+    """
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title)
+    for row in _with_header(header, rows):
+        sheet.append(list(row))
+
+    handle, path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(handle)
+    try:
+        workbook.save(path)
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        os.remove(path)
+
+
+def _with_header(header, rows):
+    yield header
+    for row in rows:
+        yield row
+
+
+WRITERS = {
+    'csv': csv_chunks,
+    'xlsx': xlsx_chunks,
+}
+
+
+def export_response(query, model, name, fmt):
+    """
+    A streamed download of `query` in format `fmt`, 'csv' or 'xlsx'. It has
+    no Content-Length, so it goes out with chunked transfer encoding, and
+    the rows are read as the response is sent.
+    """
+    header = [heading for heading, attr in export_columns(model)]
+    chunks = WRITERS[fmt](header, export_rows(query, model))
+    response = Response(stream_with_context(chunks), content_type=CONTENT_TYPES[fmt])
+    response.headers['Content-Disposition'] = 'attachment; filename={}.{}'.format(name, fmt)
+    return response
@@ -2,6 +2,8 @@ from flask import abort, render_template
 from flask_login import current_user, login_required
 
 from . import home
+from .. import dashboard_snapshot
+from ..database import read_only
 
 
 @home.route('/')
@@ -14,18 +16,22 @@ def homepage():
 
 @home.route('/dashboard')
 @login_required
+@read_only
 def dashboard():
     """
     Render the dashboard template on the /dashboard route
     """
-    return render_template('home/dashboard.html', title="Dashboard")
+    return render_template('home/dashboard.html', snapshot=dashboard_snapshot.get(),
+                           title="Dashboard")
 
 
 @home.route('/admin/dashboard')
 @login_required
+@read_only
 def admin_dashboard():
     # prevent non-admins from accessing the page
     if not current_user.is_admin:
         abort(403)
 
-    return render_template('home/admin_dashboard.html', title="Dashboard")
+    return render_template('home/admin_dashboard.html', snapshot=dashboard_snapshot.get(),
+                           title="Dashboard")
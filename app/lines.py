@@ -0,0 +1,152 @@
+import csv
+
+import six
+
+from . import dashboard_snapshot, db, price_cache
+from .models import Quotation, Quotation_Detail
+from .totals import add_to_totals, line_totals
+
+# Columns of a pasted or uploaded line, in order; only the first two are required
+COLUMNS = ('p_number', 'quantity', 'discount', 'q_price', 'option')
+TRUE = (u'y', u'yes', u'true', u'1', u'x', u'o')
+FALSE = (u'', u'n', u'no', u'false', u'0')
+
+
+class LineErrors(Exception):
+    """
+    Raised with every problem found in a batch of lines, as a list of
+    (line number, message), when any line is invalid
+    """
+
+    def __init__(self, errors):
+        super(LineErrors, self).__init__(u'; '.join(u'line {}: {}'.format(*error) for error in errors))
+        self.errors = errors
+
+
+def parse_lines(text):
+    """
+    Rows of COLUMNS from text pasted from a spreadsheet (tab separated) or
+    CSV, as (line number, dict) pairs. Blank lines are skipped, and so is
+    a first line whose quantity is not a number, taken to be a header.
+    """
+    if isinstance(text, six.binary_type):
+        text = text.decode('utf-8-sig')
+    text = text.lstrip(u'\ufeff')
+    delimiter = '\t' if u'\t' in text else ','
+    lines = text.splitlines()
+    if six.PY2:
+        lines = [line.encode('utf-8') for line in lines]
+    rows = []
+    for number, cells in enumerate(csv.reader(lines, delimiter=delimiter), 1):
+        if six.PY2:
+            cells = [cell.decode('utf-8') for cell in cells]
+        cells = [cell.strip() for cell in cells]
+        if not any(cells):
+            continue
+        row = dict(zip(COLUMNS, cells))
+        if not rows and number == 1 and _number(row.get('quantity')) is None:
+            continue
+        rows.append((number, row))
+    return rows
+
+
+def _number(value):
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = value.strip().replace(u',', u'')
+    percent = value.endswith(u'%')
+    try:
+        number = float(value.rstrip(u'%'))
+    except ValueError:
+        return None
+    return number / 100 if percent else number
+
+
+def _flag(value):
+    if isinstance(value, bool):
+        return value
+    value = six.text_type(value if value is not None else u'').strip().lower()
+    if value in TRUE:
+        return True
+    if value in FALSE:
+        return False
+    return None
+
+
+def validate_lines(rows):
+    """
+    Check every row at once, resolving all their part numbers with a single
+    query, and return Quotation_Detail values without the quotation keys.
+    Raises LineErrors listing every problem found.
+    """
+    rows = [(number, dict(row, p_number=six.text_type(row.get('p_number') or u'').strip()))
+            for number, row in rows]
+    products = price_cache.by_numbers([row['p_number'] for number, row in rows])
+    errors, lines = [], []
+    for number, row in rows:
+        p_number = row['p_number']
+        product = products.get(p_number)
+        quantity = _number(row.get('quantity'))
+        discount = _number(row.get('discount') or 0)
+        blank_price = row.get('q_price') in (None, u'')
+        q_price = None if blank_price else _number(row.get('q_price'))
+        option = _flag(row.get('option'))
+
+        if not p_number:
+            errors.append((number, u'missing part number'))
+        elif product is None:
+            errors.append((number, u'unknown part number {}'.format(p_number)))
+        if quantity is None or quantity <= 0:
+            errors.append((number, u'quantity must be a positive number'))
+        if discount is None or not 0 <= discount <= 1:
+            errors.append((number, u'discount must be between 0 and 1, or 0% and 100%'))
+        if not blank_price and (q_price is None or q_price < 0):
+            errors.append((number, u'price must be a number'))
+        if option is None:
+            errors.append((number, u'optional must be Y or N'))
+        if product is None or errors and errors[-1][0] == number:
+            continue
+
+        lines.append({'p_id': product['p_id'],
+                      'p_num': product['p_number'],
+                      'p_name': product['p_name'],
+                      'quantity': quantity,
+                      'discount': discount,
+                      'q_price': product['unit_price'] if blank_price else q_price,
+                      'option': option})
+    if errors:
+        raise LineErrors(errors)
+    return lines
+
+
+def add_lines(q_id, rows):
+    """
+    Add lines, as returned by parse_lines or as dicts of COLUMNS, to a
+    quotation in one transaction: validated together, inserted in bulk and
+    added to the quotation's totals with one UPDATE. Nothing is written if
+    any line is invalid. Returns the number of lines added.
+    """
+    quotation = db.session.query(Quotation.q_id, Quotation.q_num) \
+        .filter(Quotation.q_id == q_id).first()
+    if quotation is None:
+        raise LineErrors([(0, u'unknown quotation {}'.format(q_id))])
+    rows = [row if isinstance(row, tuple) else (number, row)
+            for number, row in enumerate(rows, 1)]
+    lines = validate_lines(rows)
+    if not lines:
+        return 0
+
+    totals = [0, 0, 0]
+    for line in lines:
+        line.update(q_id=quotation.q_id, q_num=quotation.q_num)
+        for i, value in enumerate(line_totals(line['quantity'], line['q_price'],
+                                              line['discount'], line['option'])):
+            totals[i] += value
+    db.session.bulk_insert_mappings(Quotation_Detail, lines)
+    add_to_totals(quotation.q_id, *totals)
+    db.session.commit()
+    # bulk inserts bypass the session events
+    dashboard_snapshot.invalidate()
+    return len(lines)
@@ -0,0 +1,189 @@
+import base64
+import json
+
+from flask import current_app
+from sqlalchemy import and_, or_
+from sqlalchemy.inspection import inspect
+
+
+def encode_cursor(values):
+    """
+    Turn a row's sort key into an opaque, url-safe cursor string
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Inverse of encode_cursor, returns None for a missing or mangled cursor
+    """
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(values, list) or len(values) != 2:
+        return None
+    return values
+
+
+class Page(object):
+    """
+    One page of a keyset paginated list
+
+    Iterating over a page yields its rows, so list templates can keep
+    using `{% for row in rows %}` and `{% if rows %}`.
+    """
+
+    def __init__(self, items, page, per_page, has_next, has_prev,
+                 next_cursor=None, prev_cursor=None, sort=None):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.has_next = has_next
+        self.has_prev = has_prev
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.sort = sort
+
+    @property
+    def next_num(self):
+        return self.page + 1
+
+    @property
+    def prev_num(self):
+        return max(self.page - 1, 1)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __nonzero__(self):
+        return bool(self.items)
+
+    __bool__ = __nonzero__
+
+
+class ListEngine(object):
+    """
+    Keyset (seek) pagination over a model for the admin list views
+
+    Only the columns named in `columns` are selected, rows come back as
+    lightweight named tuples rather than hydrated models, and one extra
+    row is fetched to work out `has_next` instead of running a COUNT(*).
+    """
+
+    def __init__(self, model, columns, sortable=(), per_page=None):
+        mapper = inspect(model)
+        self.model = model
+        self.pk_attr = getattr(model, mapper.get_property_by_column(mapper.primary_key[0]).key)
+        self.columns = [getattr(model, name) for name in columns]
+        self.sortable = tuple(sortable)
+        self.per_page = per_page
+
+    def sort_attr(self, sort):
+        if sort in self.sortable:
+            return getattr(self.model, sort)
+        return None
+
+    def page(self, query, page_num=1, after=None, before=None, sort=None):
+        """
+        Return the page of `query` following the `after` cursor, or
+        preceding the `before` cursor. Without a cursor, `page_num` is
+        used to seek by offset so that bookmarked page links still work.
+        """
+        per_page = self._per_page()
+        page_num = max(page_num or 1, 1)
+        sort_attr = self.sort_attr(sort)
+        if sort_attr is None:
+            sort = None
+            sort_attr = self.pk_attr
+
+        query = query.with_entities(*self._columns(sort_attr))
+
+        after, before = decode_cursor(after), decode_cursor(before)
+        backwards = before is not None and after is None
+        cursor = before if backwards else after
+
+        if backwards:
+            query = query.order_by(sort_attr.desc(), self.pk_attr.desc())
+        else:
+            query = query.order_by(sort_attr.asc(), self.pk_attr.asc())
+
+        if cursor is not None:
+            query = query.filter(self._seek(sort_attr, cursor, backwards))
+        elif page_num > 1:
+            query = query.offset((page_num - 1) * per_page)
+
+        rows = query.limit(per_page + 1).all()
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+
+        if backwards:
+            rows.reverse()
+            has_next, has_prev = True, more
+        else:
+            has_next, has_prev = more, cursor is not None or page_num > 1
+
+        sort_key = sort_attr.key
+        pk_key = self.pk_attr.key
+        next_cursor = prev_cursor = None
+        if rows:
+            first, last = rows[0], rows[-1]
+            if has_next:
+                next_cursor = encode_cursor([getattr(last, sort_key), getattr(last, pk_key)])
+            if has_prev:
+                prev_cursor = encode_cursor([getattr(first, sort_key), getattr(first, pk_key)])
+
+        return Page(rows, page_num, per_page, has_next, has_prev,
+                    next_cursor=next_cursor, prev_cursor=prev_cursor, sort=sort)
+
+    def ranked(self, query, ids, page_num=1):
+        """
+        Page `page_num` of the rows of `query` whose keys are in `ids`, kept
+        in the order of `ids`, as returned by a search. Only the keys of
+        the page are looked up, so `ids` can hold every match.
+        """
+        per_page = self._per_page()
+        page_num = max(page_num or 1, 1)
+        start = (page_num - 1) * per_page
+        page_ids = ids[start:start + per_page]
+        rows = []
+        if page_ids:
+            pk_key = self.pk_attr.key
+            query = query.with_entities(*self._columns()).filter(self.pk_attr.in_(page_ids))
+            found = dict((getattr(row, pk_key), row) for row in query)
+            rows = [found[pk] for pk in page_ids if pk in found]
+        return Page(rows, page_num, per_page, len(ids) > start + per_page, page_num > 1)
+
+    def _per_page(self):
+        return self.per_page or current_app.config.get('LIST_PER_PAGE', 50)
+
+    def _columns(self, sort_attr=None):
+        columns = list(self.columns)
+        selected = set(column.key for column in columns)
+        for attr in (sort_attr, self.pk_attr):
+            if attr is not None and attr.key not in selected:
+                columns.append(attr)
+                selected.add(attr.key)
+        return columns
+
+    def _seek(self, sort_attr, cursor, backwards):
+        # NULLs sort before every value, as MySQL and SQLite order them, and
+        # never compare equal, so they are sought with IS NULL
+        value, pk = cursor
+        if sort_attr is self.pk_attr:
+            return self.pk_attr < pk if backwards else self.pk_attr > pk
+        if value is None:
+            if backwards:
+                return and_(sort_attr.is_(None), self.pk_attr < pk)
+            return or_(sort_attr.isnot(None), and_(sort_attr.is_(None), self.pk_attr > pk))
+        if backwards:
+            seek = or_(sort_attr < value, and_(sort_attr == value, self.pk_attr < pk))
+            if sort_attr.property.columns[0].nullable:
+                seek = or_(seek, sort_attr.is_(None))
+            return seek
+        return or_(sort_attr > value, and_(sort_attr == value, self.pk_attr > pk))
@@ -0,0 +1,87 @@
+from sqlalchemy import or_
+
+from . import price_cache
+from .models import Contact, Customer
+
+# The fields the quotation form fills in, as (key, Customer/Contact attribute)
+ADDRESS_FIELDS = (('title', 'cont_title'), ('f_name', 'f_name'), ('l_name', 'l_name'),
+                  ('address', 'b_address'), ('city', 'city'), ('state', 'state_province'),
+                  ('country', 'count_region'), ('zip', 'post_code'), ('tel', 'phone'))
+
+
+def customer_info(customer):
+    return dict((key, getattr(customer, attr)) for key, attr in ADDRESS_FIELDS)
+
+
+def contact_info(contact, customer=None):
+    """
+    A contact's address fields, falling back to its customer's for the
+    ones the contact leaves empty
+    """
+    info = {}
+    for key, attr in ADDRESS_FIELDS:
+        value = getattr(contact, attr)
+        if not value and customer is not None:
+            value = getattr(customer, attr)
+        info[key] = value
+    return info
+
+
+def contact_name(contact):
+    return u' '.join(name for name in (contact.f_name, contact.l_name) if name)
+
+
+def product_info(product):
+    """
+    Price and name of a product as returned by price_cache
+    """
+    return {'price': product['unit_price'], 'name': product['p_name']}
+
+
+def lookup(acc_codes=(), contact_ids=(), part_numbers=()):
+    """
+    Resolve the keys the quotation forms ask about in one go, with at most
+    one IN query per table:
+
+    - customers by account code, with the (id, name) list of their contacts
+    - contacts by id, plus every contact of the customers asked for, with
+      the customer's details filling in the blanks
+    - products by part number, from price_cache
+
+    Keys that do not exist are left out of the result.
+    """
+    result = {'customers': {}, 'contacts': {}, 'products': {}}
+    acc_codes, contact_ids, part_numbers = set(acc_codes), set(contact_ids), set(part_numbers)
+
+    customers = {}
+    if acc_codes:
+        customers = dict((customer.c_id, customer) for customer in
+                         Customer.query.filter(Customer.acc_code.in_(acc_codes)))
+
+    contacts = []
+    conditions = []
+    if customers:
+        conditions.append(Contact.c_id.in_(list(customers)))
+    if contact_ids:
+        conditions.append(Contact.contact_id.in_(contact_ids))
+    if conditions:
+        contacts = Contact.query.filter(or_(*conditions)) \
+            .order_by(Contact.contact_id).all()
+
+    missing = set(contact.c_id for contact in contacts) - set(customers)
+    if missing:
+        customers.update((customer.c_id, customer) for customer in
+                         Customer.query.filter(Customer.c_id.in_(missing)))
+
+    for customer in customers.values():
+        if customer.acc_code in acc_codes:
+            info = customer_info(customer)
+            info['contacts'] = [(contact.contact_id, contact_name(contact))
+                                for contact in contacts if contact.c_id == customer.c_id]
+            result['customers'][customer.acc_code] = info
+    for contact in contacts:
+        result['contacts'][str(contact.contact_id)] = contact_info(contact, customers.get(contact.c_id))
+
+    for p_number, product in price_cache.by_numbers(part_numbers).items():
+        result['products'][p_number] = product_info(product)
+    return result
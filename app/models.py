@@ -1,7 +1,7 @@
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from app import db, login_manager
+from app import db, login_manager, principal_cache
 
 
 class Customer(UserMixin, db.Model):
@@ -9,8 +9,10 @@ class Customer(UserMixin, db.Model):
     Create a Customer table
     """
     __tablename__ = 'customers'
+    __table_args__ = (db.Index('ix_customers_company_name', 'CompanyName', 'CustomerID'),)
 
     __searchable__ = ['acc_code', 'f_name', 'l_name', 'comp_name', 'email']
+    __searchable_codes__ = ['acc_code']
 
 
     c_id = db.Column('CustomerID', db.Integer, primary_key=True)
@@ -32,6 +34,9 @@ class Customer(UserMixin, db.Model):
     state = db.Column('State', db.String(50))
     status = db.Column('Status', db.String(50))
     rating = db.Column('Rating', db.String(50))
+    # Bumped by every ORM update, which fails if someone else bumped it first
+    version = db.Column('Version', db.Integer, nullable=False, default=1, server_default='1')
+    __mapper_args__ = {'version_id_col': version}
 
     quotations = db.relationship('Quotation', backref='customer',
                                 lazy='dynamic')
@@ -50,7 +55,13 @@ class Contact(UserMixin, db.Model):
     """
     Create a Contact table
     """
-    __tablename__ = 'contacts'  
+    __tablename__ = 'contacts'
+    __table_args__ = (db.Index('ix_contacts_customer', 'CustomerID'),
+                      db.Index('ix_contacts_account_code', 'Account Code', 'ContactID'))
+
+    __searchable__ = ['acc_code', 'f_name', 'l_name', 'email', 'phone', 'city']
+    __searchable_codes__ = ['acc_code']
+
     contact_id = db.Column('ContactID', db.Integer, primary_key=True)
     c_id = db.Column('CustomerID', db.Integer, db.ForeignKey('customers.CustomerID'), nullable=False)   
     acc_code = db.Column('Account Code', db.String(20), nullable=False)
@@ -80,6 +91,11 @@ class Quotation(UserMixin, db.Model):
     Create a Quotation table
     """
     __tablename__ = 'quotations'
+    __table_args__ = (db.Index('ix_quotations_customer', 'CustomerID', 'Quotation Number'),
+                      db.Index('ix_quotations_account_code', 'Account Code', 'QuotationID'))
+
+    __searchable__ = ['q_num', 'acc_code', 'q_title', 'f_name', 'l_name', 'e_id']
+    __searchable_codes__ = ['q_num', 'acc_code']
 
     q_id = db.Column('QuotationID', db.Integer, primary_key=True)  # FOREIGN KEY PARENT OF QUOTATION DETAILS AND OPPORTUNITIES
     c_id = db.Column('CustomerID', db.Integer, db.ForeignKey('customers.CustomerID'), nullable=False)                           # FOREIGN KEY CHILD OF CUSTOMERS: CustomerID
@@ -104,6 +120,15 @@ class Quotation(UserMixin, db.Model):
     q_title = db.Column('Quotation title', db.String(50))
     q_note = db.Column('Quotation Note', db.String(50))
     q_amount = db.Column('Quote Amount', db.Integer)
+    # Kept up to date by app.totals as lines are added, edited and removed
+    q_subtotal = db.Column('Quote Subtotal', db.Float, default=0)
+    q_discount = db.Column('Quote Discount', db.Float, default=0)
+    q_optional = db.Column('Optional Amount', db.Float, default=0)
+    # Bumped by every ORM update, which fails if someone else bumped it
+    # first. The totals above are moved with relative UPDATEs that leave it
+    # alone, so adding lines does not conflict with editing the quotation.
+    version = db.Column('Version', db.Integer, nullable=False, default=1, server_default='1')
+    __mapper_args__ = {'version_id_col': version}
 
     opportunities = db.relationship('Opportunity', backref='quotation',
                                 lazy='dynamic')
@@ -111,6 +136,10 @@ class Quotation(UserMixin, db.Model):
     quote_details = db.relationship('Quotation_Detail', backref='quotation',
                                 lazy='dynamic')
 
+    # contact_id has no foreign key in the schema, so spell out the join
+    contact = db.relationship('Contact', viewonly=True,
+                              primaryjoin='foreign(Quotation.contact_id) == Contact.contact_id')
+
     def __repr__(self):
         return '<Quotation: {}>'.format(self.q_id)
 
@@ -123,6 +152,10 @@ class Product(UserMixin, db.Model):
     Create a Quotation table
     """
     __tablename__ = 'products'
+    __table_args__ = (db.Index('ix_products_supplier', 'Supplier'),)
+
+    __searchable__ = ['p_number', 'p_name', 'japanese_p_name', 'supplier', 'p_category']
+    __searchable_codes__ = ['p_number']
 
     p_id = db.Column('ProductID', db.Integer, primary_key=True) 
     p_number = db.Column('Part Number', db.String(50), unique=True, nullable=False)                    
@@ -156,6 +189,13 @@ class Opportunity(UserMixin, db.Model):
     Create an Opportunity table
     """
     __tablename__ = 'opportunities'
+    __table_args__ = (db.Index('ix_opportunities_quotation', 'QuotationID'),
+                      db.Index('ix_opportunities_quotation_number', 'Quotation Number', 'OpportunityID'),
+                      db.Index('ix_opportunities_close_date', 'Close Date'))
+
+    __searchable__ = ['q_num', 'integrator', 'source_of_lead', 'application',
+                      'family', 'region']
+    __searchable_codes__ = ['q_num']
 
     o_id = db.Column('OpportunityID', db.Integer, primary_key=True)  
     q_id = db.Column('QuotationID', db.Integer, db.ForeignKey('quotations.QuotationID'), nullable=False) 
@@ -176,6 +216,8 @@ class Opportunity(UserMixin, db.Model):
     revenue = db.Column('Revenue $', db.Float)
     integrator = db.Column('Integrator', db.String(50))
     region = db.Column('Region', db.String(50))
+    version = db.Column('Version', db.Integer, nullable=False, default=1, server_default='1')
+    __mapper_args__ = {'version_id_col': version}
 
 
     def __repr__(self):
@@ -190,6 +232,12 @@ class Quotation_Detail(UserMixin, db.Model):
     Create an Opportunity table
     """
     __tablename__ = 'quotation_details'
+    __table_args__ = (db.Index('ix_quotation_details_quotation', 'QuotationID', 'QuotationDetailID'),
+                      db.Index('ix_quotation_details_product', 'ProductID'),
+                      db.Index('ix_quotation_details_quotation_number', 'Quotation Number',
+                               'QuotationDetailID'),
+                      db.Index('ix_quotation_details_product_number', 'Product Number',
+                               'QuotationDetailID'))
 
     quote_detail_id = db.Column('QuotationDetailID', db.Integer, primary_key=True)  
     q_id = db.Column('QuotationID', db.Integer, db.ForeignKey('quotations.QuotationID'), nullable=False)                 
@@ -201,6 +249,8 @@ class Quotation_Detail(UserMixin, db.Model):
     discount = db.Column('Discount', db.Float)
     q_price = db.Column('Quote Price', db.Float)       
     option = db.Column('Active (Y/N)', db.Boolean, default=False)
+    version = db.Column('Version', db.Integer, nullable=False, default=1, server_default='1')
+    __mapper_args__ = {'version_id_col': version}
     
     def __repr__(self):
         return '<Quotation Detail: {}>'.format(self.quote_detail_id)
@@ -257,7 +307,7 @@ class Employee(UserMixin, db.Model):
 # Set up user_loader
 @login_manager.user_loader
 def load_user(user_id):
-    return Employee.query.get(int(user_id))
+    return principal_cache.load(user_id)
 
 
 class Department(db.Model):
@@ -293,3 +343,34 @@ class Role(db.Model):
 
     def __repr__(self):
         return '<Role: {}>'.format(self.name)
+
+
+class PipelineRollup(db.Model):
+    """
+    Create a Pipeline Rollup table: opportunity totals by close month,
+    region, family, revenue category and sales stage, kept up to date by
+    app.pipeline. Missing values are stored as '' and -1 (see there).
+    """
+
+    __tablename__ = 'pipeline_rollups'
+    __table_args__ = (db.UniqueConstraint('close_year', 'close_month', 'region', 'family',
+                                          'rev_category', 'sales_stage'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    close_year = db.Column(db.Integer, nullable=False)
+    close_month = db.Column(db.Integer, nullable=False)
+    region = db.Column(db.String(50), nullable=False)
+    family = db.Column(db.String(50), nullable=False)
+    rev_category = db.Column(db.String(50), nullable=False)
+    sales_stage = db.Column(db.Integer, nullable=False)
+    opportunities = db.Column(db.Integer, nullable=False, default=0)
+    won = db.Column(db.Integer, nullable=False, default=0)
+    lost = db.Column(db.Integer, nullable=False, default=0)
+    potential = db.Column(db.Float, nullable=False, default=0)
+    weighted = db.Column(db.Float, nullable=False, default=0)
+    probable = db.Column(db.Float, nullable=False, default=0)
+    actual = db.Column(db.Float, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<Pipeline Rollup: {}>'.format(self.id)
@@ -0,0 +1,221 @@
+import atexit
+import errno
+import hashlib
+import multiprocessing
+import os
+import re
+import time
+
+import six
+from flask import current_app
+
+KEY = re.compile(r'^[0-9a-f]{64}$')
+# The templates a quotation PDF is rendered from, hashed into every key so
+# that changing them makes new PDFs
+TEMPLATES = ('admin/quotations/pdf.html', 'admin/quotations/detail_table.html')
+# Seconds between two evictions from the cache by the same process
+EVICT_INTERVAL = 60
+
+
+def render_wkhtmltopdf(html, css):
+    """
+    Render with wkhtmltopdf, through pdfkit
+    """
+    import pdfkit
+    return pdfkit.from_string(html, False, css=css, options={'quiet': ''})
+
+
+def render_stub(html, css):
+    """
+    Stand-in renderer for machines without wkhtmltopdf, such as the tests
+    """
+    return b'%PDF-1.4\n% stub rendering of ' + str(len(html)).encode('ascii') + b' bytes\n%%EOF\n'
+
+
+RENDERERS = {
+    'wkhtmltopdf': render_wkhtmltopdf,
+    'stub': render_stub,
+}
+
+
+def render_to_file(renderer, html, css, directory, key):
+    """
+    Render one document into the cache, run in a pool worker process.
+    The PDF is written under a temporary name and renamed into place so a
+    half written file is never served. A failure leaves a .error file.
+    """
+    base = os.path.join(directory, key)
+    try:
+        pdf = RENDERERS[renderer](html, css)
+        tmp = '{}.{}.tmp'.format(base, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(pdf)
+        os.rename(tmp, base + '.pdf')
+    except Exception as e:
+        with open(base + '.error', 'w') as f:
+            f.write(str(e))
+    finally:
+        if os.path.exists(base + '.pending'):
+            os.remove(base + '.pending')
+
+
+class PdfQueue(object):
+    """
+    Renders quotation PDFs off the request path
+
+    Rendered HTML is handed to a pool of PDF_WORKERS processes, or rendered
+    inline when PDF_WORKERS is 0. Files are cached in PDF_CACHE_DIR under
+    a key made from what the document is built from, see key(), so a
+    quotation that has not changed since its last rendering is served
+    straight from disk without rendering its HTML. Job state lives in
+    marker files next to the PDFs, so every app worker sees it. PDFs older
+    than PDF_CACHE_MAX_AGE seconds, and the oldest beyond
+    PDF_CACHE_MAX_FILES, are evicted as new ones are queued.
+    """
+
+    def __init__(self, app=None):
+        self._pools = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        directory = app.config.get('PDF_CACHE_DIR') or os.path.join(app.instance_path, 'pdf_cache')
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        css = os.path.join(app.static_folder, 'css', 'pdf.css')
+        style = hashlib.sha256()
+        with open(css, 'rb') as f:
+            style.update(f.read())
+        for name in TEMPLATES:
+            source = app.jinja_loader.get_source(app.jinja_env, name)[0]
+            style.update(source.encode('utf-8'))
+
+        app.extensions['pdf'] = {
+            'directory': directory,
+            'css': css,
+            'style_hash': style.hexdigest(),
+            'renderer': app.config.get('PDF_RENDERER', 'wkhtmltopdf'),
+            'workers': app.config.get('PDF_WORKERS', 2),
+            'timeout': app.config.get('PDF_TIMEOUT', 120),
+            'max_age': app.config.get('PDF_CACHE_MAX_AGE', 7 * 24 * 60 * 60),
+            'max_files': app.config.get('PDF_CACHE_MAX_FILES', 1000),
+            'evicted_at': 0,
+        }
+
+    def _state(self):
+        return current_app.extensions['pdf']
+
+    def key(self, *parts):
+        """
+        Cache key of a document given what it is rendered from, such as a
+        quotation's row versions (see documents.document_fingerprint) or
+        its HTML, hashed with the stylesheet and templates
+        """
+        digest = hashlib.sha256(self._state()['style_hash'].encode('ascii'))
+        for part in parts:
+            if not isinstance(part, bytes):
+                part = six.text_type(part).encode('utf-8')
+            digest.update(part + b'\0')
+        return digest.hexdigest()
+
+    def path(self, key, suffix='.pdf'):
+        if not KEY.match(key):
+            raise ValueError('Not a PDF cache key: {}'.format(key))
+        return os.path.join(self._state()['directory'], key + suffix)
+
+    def submit(self, key, render):
+        """
+        Queue the document under `key` for rendering unless it is cached or
+        already queued, and return the key for polling with status().
+        `render` is called for the document's HTML only when it is queued.
+        Its exceptions propagate, leaving the document 'missing'.
+        """
+        state = self._state()
+        if self.status(key) in ('ready', 'pending'):
+            return key
+
+        # before the marker goes down, so a failing render leaves none behind
+        html = render()
+        if os.path.exists(self.path(key, '.error')):
+            os.remove(self.path(key, '.error'))
+        open(self.path(key, '.pending'), 'w').close()
+        if time.time() - state['evicted_at'] > EVICT_INTERVAL:
+            self.evict()
+
+        args = (state['renderer'], html, state['css'], state['directory'], key)
+        if state['workers']:
+            self._pool(state).apply_async(render_to_file, args)
+        else:
+            render_to_file(*args)
+        return key
+
+    def status(self, key):
+        """
+        One of 'ready', 'pending', 'failed' or 'missing'. A job pending
+        for longer than PDF_TIMEOUT is taken to have died with its worker.
+        """
+        if os.path.exists(self.path(key)):
+            return 'ready'
+        pending = self.path(key, '.pending')
+        if os.path.exists(pending):
+            if time.time() - os.path.getmtime(pending) < self._state()['timeout']:
+                return 'pending'
+        if os.path.exists(self.path(key, '.error')):
+            return 'failed'
+        return 'missing'
+
+    def error(self, key):
+        with open(self.path(key, '.error')) as f:
+            return f.read()
+
+    def evict(self):
+        """
+        Remove the PDFs and failures older than PDF_CACHE_MAX_AGE, the
+        oldest of them beyond PDF_CACHE_MAX_FILES, and the markers and
+        partial files of jobs that died. Returns how many files went.
+        """
+        state = self._state()
+        state['evicted_at'] = now = time.time()
+        documents = []
+        removed = 0
+        for name in os.listdir(state['directory']):
+            path = os.path.join(state['directory'], name)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            if name.endswith(('.pdf', '.error')):
+                documents.append((mtime, path))
+            elif now - mtime > state['timeout'] and self._remove(path):
+                removed += 1
+        documents.sort(reverse=True)
+        for n, (mtime, path) in enumerate(documents):
+            if (n >= state['max_files'] or now - mtime > state['max_age']) and self._remove(path):
+                removed += 1
+        return removed
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def _pool(self, state):
+        # Started on first use, so each forked app worker gets its own pool
+        pid = os.getpid()
+        if pid not in self._pools:
+            self._pools[pid] = multiprocessing.Pool(state['workers'])
+            atexit.register(self.close)
+        return self._pools[pid]
+
+    def close(self):
+        """
+        Stop this process's rendering pool, if it started one
+        """
+        pool = self._pools.pop(os.getpid(), None)
+        if pool is not None:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,243 @@
+import pandas as pd
+from sqlalchemy import and_, case, event, extract, func, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.inspection import inspect
+
+from . import db
+from .models import Opportunity, PipelineRollup
+
+# The columns opportunities are rolled up by, with what a missing value is
+# stored as, since they make up a unique key
+GROUPS = (('close_year', 0), ('close_month', 0), ('region', u''), ('family', u''),
+          ('rev_category', u''), ('sales_stage', -1))
+GROUP_NAMES = tuple(name for name, missing in GROUPS)
+MEASURES = ('opportunities', 'won', 'lost', 'potential', 'weighted', 'probable',
+            'actual', 'revenue')
+
+# The Opportunity fields the rollups are computed from
+FIELDS = ('close_date', 'region', 'family', 'rev_category', 'sales_stage', 'probability',
+          'potential_money', 'probable_money', 'actual_money', 'revenue')
+
+
+def _keep_history(target, value, oldvalue, initiator):
+    pass
+
+
+def probability(value):
+    """
+    A probability entered either as a fraction or as a percentage, as a fraction
+    """
+    if value is None:
+        return 0
+    return value / 100.0 if value > 1 else value
+
+
+def contribution(values):
+    """
+    What one opportunity, given as a dict of FIELDS, adds to the rollups,
+    as a tuple of (group key, measures)
+
+    An opportunity is won once it has an actual amount, and lost when its
+    probability is set to 0 without one. Only open opportunities, neither
+    won nor lost, count towards the weighted pipeline.
+    """
+    close_date = values['close_date']
+    key = (close_date.year if close_date else 0,
+           close_date.month if close_date else 0,
+           values['region'] or u'',
+           values['family'] or u'',
+           values['rev_category'] or u'',
+           -1 if values['sales_stage'] is None else values['sales_stage'])
+    potential = values['potential_money'] or 0
+    won = (values['actual_money'] or 0) > 0
+    lost = not won and values['probability'] == 0
+    weighted = 0 if won or lost else potential * probability(values['probability'])
+    return key, (1, int(won), int(lost), potential, weighted, values['probable_money'] or 0,
+                 values['actual_money'] or 0, values['revenue'] or 0)
+
+
+def apply_change(connection, before=None, after=None):
+    """
+    Move the rollups from the `before` values of an opportunity to its
+    `after` values. Pass None for `before` when it is added and for `after`
+    when it is deleted.
+
+    Each group touched is updated relative to its stored totals with one
+    UPDATE, inserted if it does not exist yet and deleted once it has no
+    opportunities left, on `connection` so that the change is committed
+    with the opportunity. When another transaction inserts the same group
+    first, the UPDATE is retried against its row.
+    """
+    apply_changes(connection, removed=[] if before is None else [before],
+                  added=[] if after is None else [after])
+
+
+def apply_changes(connection, removed=(), added=()):
+    """
+    apply_change for many opportunities at once, given as lists of the
+    values of those `removed` and `added`, with one UPDATE per group
+    touched however many of them fall in it
+    """
+    deltas = {}
+    for rows, sign in ((removed, -1), (added, 1)):
+        for values in rows:
+            key, measures = contribution(values)
+            current = deltas.setdefault(key, [0] * len(MEASURES))
+            for i, value in enumerate(measures):
+                current[i] += sign * value
+
+    table = PipelineRollup.__table__
+    for key, measures in deltas.items():
+        if not any(measures):
+            continue
+        where = and_(*[table.c[name] == value for name, value in zip(GROUP_NAMES, key)])
+        update = table.update().where(where).values(
+            dict((name, table.c[name] + delta) for name, delta in zip(MEASURES, measures)))
+        if connection.execute(update).rowcount == 0:
+            row = dict(zip(GROUP_NAMES, key))
+            row.update(zip(MEASURES, measures))
+            try:
+                connection.execute(table.insert().values(row))
+            except IntegrityError:
+                # MySQL and SQLite only undo the failed statement, so the
+                # transaction can go on to update the row inserted meanwhile
+                connection.execute(update)
+        elif measures[0] < 0:
+            connection.execute(table.delete().where(and_(where, table.c.opportunities <= 0)))
+
+
+def _values(target, previous=False):
+    # The FIELDS of an opportunity, as they are or as they were before the
+    # changes being flushed
+    values = {}
+    attrs = inspect(target).attrs
+    for field in FIELDS:
+        value = getattr(target, field)
+        if previous:
+            deleted = attrs[field].history.deleted
+            if deleted:
+                value = deleted[0]
+        values[field] = value
+    return values
+
+
+class PipelineRollups(object):
+    """
+    Keeps the pipeline_rollups table in step with every opportunity added,
+    changed or deleted through the session. Bulk statements that bypass
+    it should call rebuild() afterwards.
+    """
+
+    def __init__(self, app=None):
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not self._listening:
+            event.listen(Opportunity, 'after_insert', self._inserted)
+            event.listen(Opportunity, 'after_update', self._updated)
+            event.listen(Opportunity, 'after_delete', self._deleted)
+            # Have the old values loaded when they are changed, so that
+            # _updated can find them in the attribute history
+            for field in FIELDS:
+                event.listen(getattr(Opportunity, field), 'set', _keep_history,
+                             active_history=True)
+            self._listening = True
+
+    def _inserted(self, mapper, connection, target):
+        apply_change(connection, after=_values(target))
+
+    def _updated(self, mapper, connection, target):
+        before, after = _values(target, previous=True), _values(target)
+        if before != after:
+            apply_change(connection, before, after)
+
+    def _deleted(self, mapper, connection, target):
+        apply_change(connection, before=_values(target))
+
+
+pipeline_rollups = PipelineRollups()
+
+
+def rollup_query():
+    """
+    Query of the rollups computed from scratch with one GROUP BY over the
+    opportunities, in GROUP_NAMES + MEASURES order
+    """
+    o = Opportunity
+    potential = func.coalesce(o.potential_money, 0)
+    won = func.coalesce(o.actual_money, 0) > 0
+    lost = and_(~won, o.probability == 0)
+    fraction = case([(o.probability > 1, o.probability / 100.0)],
+                    else_=func.coalesce(o.probability, 0))
+    keys = [func.coalesce(extract('year', o.close_date), 0),
+            func.coalesce(extract('month', o.close_date), 0)]
+    keys += [func.coalesce(getattr(o, name), missing) for name, missing in GROUPS[2:]]
+    measures = [func.count(),
+                func.sum(case([(won, 1)], else_=0)),
+                func.sum(case([(lost, 1)], else_=0)),
+                func.sum(potential),
+                func.sum(case([(or_(won, lost), 0)], else_=potential * fraction)),
+                func.sum(func.coalesce(o.probable_money, 0)),
+                func.sum(func.coalesce(o.actual_money, 0)),
+                func.sum(func.coalesce(o.revenue, 0))]
+    return select(keys + measures).group_by(*keys)
+
+
+def rebuild():
+    """
+    Replace the rollups with ones computed from the opportunities in SQL,
+    in one transaction. Returns the number of groups.
+    """
+    table = PipelineRollup.__table__
+    db.session.execute(table.delete())
+    db.session.execute(table.insert().from_select(GROUP_NAMES + MEASURES, rollup_query()))
+    db.session.commit()
+    return db.session.query(func.count(PipelineRollup.id)).scalar()
+
+
+def rollup_frame(**filters):
+    """
+    The rollups as a DataFrame, optionally only the groups whose columns
+    equal the given values, e.g. rollup_frame(region=u'Asia')
+    """
+    query = db.session.query(*[getattr(PipelineRollup, name) for name in GROUP_NAMES + MEASURES])
+    for name, value in filters.items():
+        if name not in GROUP_NAMES:
+            raise ValueError('Unknown pipeline group: {}'.format(name))
+        query = query.filter(getattr(PipelineRollup, name) == value)
+    return pd.DataFrame(query.all(), columns=GROUP_NAMES + MEASURES)
+
+
+def weighted_pipeline(frame, by=('sales_stage',)):
+    """
+    Count, potential and weighted value of the pipeline by the given columns
+    """
+    return frame.groupby(list(by), as_index=False)[['opportunities', 'potential', 'weighted']].sum()
+
+
+def forecast(frame):
+    """
+    Expected revenue by close month: the weighted value of what is still
+    open plus the actual amount of what was won. Opportunities without a
+    close date are left out.
+    """
+    dated = frame[frame.close_year > 0]
+    if dated.empty:
+        # grouping nothing by two columns loses the columns
+        return pd.DataFrame(columns=['close_year', 'close_month', 'weighted', 'actual', 'expected'])
+    months = dated.groupby(['close_year', 'close_month'], as_index=False)[['weighted', 'actual']].sum()
+    months['expected'] = months.weighted + months.actual
+    return months.sort_values(['close_year', 'close_month'])
+
+
+def win_rates(frame, by=('region',)):
+    """
+    Won, lost and the share of closed opportunities won by the given
+    columns; the rate is NaN where nothing has closed
+    """
+    rates = frame.groupby(list(by), as_index=False)[['opportunities', 'won', 'lost']].sum()
+    closed = rates.won + rates.lost
+    rates['win_rate'] = rates.won / closed.where(closed > 0)
+    return rates
@@ -0,0 +1,361 @@
+import os
+
+import pandas as pd
+import six
+from flask import current_app
+from sqlalchemy import Date, Float, String
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.inspection import inspect
+
+from . import choice_cache, db, price_cache, search_index
+from .models import Product
+
+# Sheet headings that differ from the products table column names
+SHEET_ALIASES = {
+    'Product Note to show - Japanese': 'Japanese Note to show',
+}
+
+KEY = 'p_number'
+
+REPEATED = 'Part Number repeated further down'
+
+# Fields compared by a dry run, and how far apart two prices must be to differ
+DIFF_FIELDS = ('unit_price', 'unit_cost', 'exchange_rate', 'p_status')
+NUMERIC_DIFF_FIELDS = ('unit_price', 'unit_cost', 'exchange_rate')
+PRICE_TOLERANCE = 1e-6
+
+
+def product_columns():
+    """
+    Map each products table column name, which is also the heading used in
+    the pricebook sheet, to its Product attribute. The primary key is left
+    out: products are matched on their part number.
+    """
+    columns = {}
+    for prop in inspect(Product).column_attrs:
+        column = prop.columns[0]
+        if not column.primary_key:
+            columns[column.name] = (prop.key, column.type)
+    return columns
+
+
+def read_chunks(path, chunk_size, columns=None):
+    """
+    Yield the rows of a pricebook as DataFrames of up to `chunk_size` rows,
+    optionally of only the given `columns`. CSV and xlsx files are
+    streamed. Old style xls files cannot be, so they are read whole and
+    then split.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.csv':
+        for chunk in pd.read_csv(path, chunksize=chunk_size, encoding='utf-8', usecols=columns,
+                                 dtype={'Part Number': object}):
+            yield chunk
+    elif ext in ('.xlsx', '.xlsm'):
+        from openpyxl import load_workbook
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+
+        def frame(chunk):
+            frame = pd.DataFrame(chunk, columns=header)
+            return frame if columns is None else frame[columns]
+
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield frame(chunk)
+                chunk = []
+        if chunk:
+            yield frame(chunk)
+    else:
+        sheet = pd.read_excel(path, usecols=columns, dtype={'Part Number': object})
+        for start in range(0, len(sheet.index), chunk_size):
+            yield sheet.iloc[start:start + chunk_size]
+
+
+def last_rows(path, chunk_size):
+    """
+    Map each part number of a pricebook to the last row it is on. The Part
+    Number column is read ahead of the rest, so that a part number repeated
+    in a later chunk is known before an earlier chunk is written.
+    """
+    last = {}
+    first_row = 2
+    for chunk in read_chunks(path, chunk_size, columns=['Part Number']):
+        numbers = chunk['Part Number']
+        numbers.index = pd.RangeIndex(first_row, first_row + len(numbers.index))
+        first_row += len(numbers.index)
+        numbers = numbers.dropna().astype(six.text_type).str.strip()
+        last.update(zip(numbers, (int(row) for row in numbers.index)))
+    return last
+
+
+def clean(frame, first_row=2, last=None):
+    """
+    Validate and convert a chunk of the sheet in one vectorized pass,
+    renaming its columns to Product attributes. Returns (frame, rejected)
+    where rejected holds (row, part number, reason) tuples; rows are
+    numbered as in the spreadsheet, starting at `first_row`. A row whose
+    part number is repeated further down, within the chunk or on a later
+    row in `last` (see last_rows()), is rejected in favour of that row.
+    """
+    columns = product_columns()
+    frame = frame.rename(columns=SHEET_ALIASES)
+    if 'Part Number' not in frame.columns:
+        raise ValueError('The pricebook has no Part Number column')
+
+    present = [name for name in frame.columns if name in columns]
+    frame = frame[present].rename(columns=dict((name, columns[name][0]) for name in present))
+    frame.index = pd.RangeIndex(first_row, first_row + len(frame.index))
+    reasons = pd.Series(None, index=frame.index, dtype=object)
+
+    def reject(mask, reason):
+        reasons[mask & reasons.isnull()] = reason
+
+    numbers = frame[KEY]
+    frame[KEY] = numbers.where(numbers.isnull(), numbers.astype(six.text_type).str.strip())
+    reject(frame[KEY].isnull() | (frame[KEY] == u''), 'missing Part Number')
+
+    for name in present:
+        attr, type_ = columns[name]
+        values = frame[attr]
+        if isinstance(type_, Float):
+            converted = pd.to_numeric(values, errors='coerce')
+        elif isinstance(type_, Date):
+            converted = pd.to_datetime(values, errors='coerce').dt.date
+        else:
+            converted = values
+            if isinstance(type_, String) and type_.length:
+                reject(values.notnull() & (values.astype(six.text_type).str.len() > type_.length),
+                       '{} is longer than {} characters'.format(name, type_.length))
+            continue
+        reject(values.notnull() & converted.isnull(), 'bad {}: not a {}'.format(
+            name, 'number' if isinstance(type_, Float) else 'date'))
+        frame[attr] = converted
+
+    repeated = frame[KEY].duplicated(keep='last')
+    if last is not None:
+        repeated |= frame[KEY].map(last) > pd.Series(frame.index, index=frame.index)
+    reject(repeated, REPEATED)
+
+    bad = reasons.notnull()
+    rejected = list(zip(frame.index[bad], frame[KEY][bad], reasons[bad]))
+    return frame[~bad], rejected
+
+
+def to_records(frame, first_row=2, last=None):
+    """
+    Convert a chunk of the sheet into (row, Product mapping) pairs, see
+    clean(). Returns (pairs, rejected).
+    """
+    good, rejected = clean(frame, first_row, last)
+    rows = [int(row) for row in good.index]
+    good = good.astype(object)
+    good = good.where(good.notnull(), None)
+    return list(zip(rows, good.to_dict('records'))), rejected
+
+
+class ImportSummary(object):
+    """
+    Counts of what an import did, plus the rejected rows with reasons
+    """
+
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.rejected = []
+        # Part numbers of the rows inserted or updated
+        self.written = []
+
+    def __str__(self):
+        return '{} inserted, {} updated, {} rejected'.format(
+            self.inserted, self.updated, len(self.rejected))
+
+
+def upsert(records, summary, batch_size):
+    """
+    Insert new products and update existing ones, matched on part number,
+    in batches of `batch_size` (row, mapping) pairs with one transaction
+    per batch. The rows of a batch the database refuses are written one
+    at a time, so that only the ones at fault are rejected.
+    """
+    for start in range(0, len(records), batch_size):
+        batch = records[start:start + batch_size]
+        try:
+            _write(batch, summary)
+        except SQLAlchemyError:
+            db.session.rollback()
+            for row, record in batch:
+                try:
+                    _write([(row, record)], summary)
+                except SQLAlchemyError as e:
+                    db.session.rollback()
+                    summary.rejected.append((row, record[KEY],
+                                             str(e.orig if hasattr(e, 'orig') else e)))
+
+
+def _write(batch, summary):
+    # One transaction inserting and updating the products of `batch`. The
+    # blank cells of a row are left out of its update, so that a sheet of
+    # only some columns, or with gaps, keeps what the products already hold.
+    numbers = [record[KEY] for row, record in batch]
+    existing = dict(db.session.query(Product.p_number, Product.p_id)
+                    .filter(Product.p_number.in_(numbers)))
+
+    inserts, updates = [], []
+    for row, record in batch:
+        if record[KEY] in existing:
+            update = dict((key, value) for key, value in record.items() if value is not None)
+            update['p_id'] = existing[record[KEY]]
+            updates.append(update)
+        else:
+            inserts.append(record)
+
+    db.session.bulk_insert_mappings(Product, inserts)
+    db.session.bulk_update_mappings(Product, updates)
+    db.session.commit()
+
+    summary.inserted += len(inserts)
+    summary.updated += len(updates)
+    summary.written.extend(numbers)
+
+
+def products(numbers, batch_size):
+    """
+    Yield the products with the given part numbers, `batch_size` at a time
+    """
+    for start in range(0, len(numbers), batch_size):
+        for product in Product.query.filter(Product.p_number.in_(numbers[start:start + batch_size])):
+            yield product
+
+
+def import_pricebook(path, batch_size=None, chunk_size=None):
+    """
+    Load a pricebook (xlsx, xls or csv) into the products table, adding new
+    part numbers and updating the ones already there. Returns an
+    ImportSummary.
+    """
+    batch_size = batch_size or current_app.config.get('PRICEBOOK_BATCH_SIZE', 1000)
+    chunk_size = chunk_size or current_app.config.get('PRICEBOOK_CHUNK_SIZE', 5000)
+    summary = ImportSummary()
+    last = last_rows(path, chunk_size)
+    first_row = 2
+    for chunk in read_chunks(path, chunk_size):
+        records, rejected = to_records(chunk, first_row, last)
+        first_row += len(chunk.index)
+        summary.rejected.extend(rejected)
+        upsert(records, summary, batch_size)
+    summary.rejected.sort(key=lambda rejected: rejected[0])
+
+    # Bulk statements bypass the session events that keep search current,
+    # so index everything written in one go
+    search_index.update(Product, products(summary.written, batch_size))
+    if summary.inserted:
+        choice_cache.invalidate(Product)
+    if summary.updated:
+        price_cache.clear()
+    return summary
+
+
+def _value(value):
+    return None if pd.isnull(value) else value
+
+
+class ChangeReport(object):
+    """
+    What importing a pricebook would do to the products table: the part
+    numbers it would add, the per-field changes to existing products and
+    a count of the rows that would stay as they are
+    """
+
+    columns = ['Part Number', 'Change', 'Field', 'Current', 'New', 'Delta']
+
+    def __init__(self):
+        self.inserts = []
+        # (part number, {field: (current, new)}) pairs
+        self.updates = []
+        self.unchanged = 0
+        self.rejected = []
+
+    def __str__(self):
+        return '{} to insert, {} to update, {} unchanged, {} rejected'.format(
+            len(self.inserts), len(self.updates), self.unchanged, len(self.rejected))
+
+    def rows(self):
+        """
+        One row per new part number and per changed field, as in columns
+        """
+        for p_number in self.inserts:
+            yield (p_number, 'insert', None, None, None, None)
+        for p_number, changes in self.updates:
+            for field in DIFF_FIELDS:
+                if field in changes:
+                    current, new = changes[field]
+                    delta = None
+                    if field in NUMERIC_DIFF_FIELDS and current is not None and new is not None:
+                        delta = new - current
+                    yield (p_number, 'update', field, current, new, delta)
+
+    def write_csv(self, path):
+        pd.DataFrame(list(self.rows()), columns=self.columns).to_csv(
+            path, index=False, encoding='utf-8')
+
+
+def current_products(fields):
+    """
+    The `fields` of every product in one query, as a DataFrame indexed by
+    part number
+    """
+    query = db.session.query(Product.p_number, *[getattr(Product, field) for field in fields])
+    frame = pd.DataFrame.from_records(list(query.yield_per(10000)), columns=[KEY] + list(fields))
+    for field in fields:
+        if field in NUMERIC_DIFF_FIELDS:
+            frame[field] = frame[field].astype(float)
+    return frame.set_index(KEY)
+
+
+def _changed(current, new, numeric):
+    # a blank cell leaves the field as it is, see _write()
+    same = (current - new).abs() <= PRICE_TOLERANCE if numeric else current == new
+    return ~(same | new.isnull())
+
+
+def diff_pricebook(path, chunk_size=None):
+    """
+    Compare a pricebook with the products table without writing anything.
+    The table is read once and each chunk of the sheet is compared with it
+    column by column. Returns a ChangeReport.
+    """
+    chunk_size = chunk_size or current_app.config.get('PRICEBOOK_CHUNK_SIZE', 5000)
+    report = ChangeReport()
+    current = None
+    last = last_rows(path, chunk_size)
+    first_row = 2
+    for chunk in read_chunks(path, chunk_size):
+        good, rejected = clean(chunk, first_row, last)
+        first_row += len(chunk.index)
+        report.rejected.extend(rejected)
+
+        fields = [field for field in DIFF_FIELDS if field in good.columns]
+        if current is None:
+            current = current_products(DIFF_FIELDS)
+
+        known = good[KEY].isin(current.index)
+        report.inserts.extend(good[KEY][~known])
+        incoming = good[known]
+        before = current.loc[incoming[KEY].values, fields]
+        before.index = incoming.index
+
+        changes = pd.DataFrame(dict((field, _changed(before[field], incoming[field],
+                                                     field in NUMERIC_DIFF_FIELDS))
+                                    for field in fields),
+                               index=incoming.index, columns=fields)
+        changed = changes.any(axis=1)
+        report.unchanged += int((~changed).sum())
+        for row in incoming.index[changed]:
+            report.updates.append((incoming.at[row, KEY], dict(
+                (field, (_value(before.at[row, field]), _value(incoming.at[row, field])))
+                for field in fields if changes.at[row, field])))
+    return report
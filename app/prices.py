@@ -0,0 +1,128 @@
+from flask import current_app
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import object_session
+
+FIELDS = ('p_id', 'p_number', 'p_name', 'unit_price')
+NAMESPACE = 'prices'
+
+
+def _keep_history(target, value, oldvalue, initiator):
+    pass
+
+
+class PriceCache(object):
+    """
+    Product prices and names by part number and by id, for the quotation
+    forms, kept for PRICE_CACHE_TTL seconds in the shared cache (see
+    app.cache), so every worker using the same backend shares them.
+
+    Updating or deleting a product through the session drops its entries
+    at flush time and again once the transaction commits, so a reader in
+    between cannot put the old price back. Bulk writes that bypass the
+    session should call invalidate() or clear().
+    """
+
+    def __init__(self, app=None, db=None, cache=None):
+        self._listening = False
+        if app is not None:
+            self.init_app(app, db, cache)
+
+    def init_app(self, app, db, cache):
+        from .models import Product
+        app.extensions['prices'] = {'db': db, 'model': Product, 'cache': cache,
+                                    'ttl': app.config.get('PRICE_CACHE_TTL', 300)}
+
+        if not self._listening:
+            event.listen(Product, 'after_update', self._changed)
+            event.listen(Product, 'after_delete', self._changed)
+            # Have the old part number loaded when it is changed, so that
+            # _changed can find it in the attribute history
+            event.listen(Product.p_number, 'set', _keep_history, active_history=True)
+            event.listen(SignallingSession, 'after_commit', self._after_commit)
+            event.listen(SignallingSession, 'after_rollback', self._after_rollback)
+            self._listening = True
+
+    def _state(self, app=None):
+        return (app or current_app).extensions['prices']
+
+    @property
+    def cache(self):
+        return self._state()['cache']
+
+    def by_number(self, p_number):
+        """
+        {'p_id', 'p_number', 'p_name', 'unit_price'} of a product, or None
+        """
+        return self.by_numbers([p_number]).get(p_number)
+
+    def by_numbers(self, p_numbers):
+        """
+        The products with the given part numbers, by part number, fetching
+        the ones not cached with a single query
+        """
+        found, missing = {}, []
+        for p_number in set(p_numbers):
+            product = self.cache.get(NAMESPACE, u'number:{}'.format(p_number))
+            if product is None:
+                missing.append(p_number)
+            else:
+                found[p_number] = product
+        if missing:
+            state = self._state()
+            with state['db'].primary():
+                for row in self._query().filter(state['model'].p_number.in_(missing)):
+                    found[row.p_number] = self._store(row)
+        return found
+
+    def by_id(self, p_id):
+        product = self.cache.get(NAMESPACE, u'id:{}'.format(p_id))
+        if product is None:
+            state = self._state()
+            with state['db'].primary():
+                row = self._query().filter(state['model'].p_id == p_id).first()
+            if row is not None:
+                product = self._store(row)
+        return product
+
+    def invalidate(self, p_id=None, p_number=None, app=None):
+        cache = self._state(app)['cache']
+        if p_id is not None:
+            cache.delete(NAMESPACE, u'id:{}'.format(p_id), app)
+        if p_number is not None:
+            cache.delete(NAMESPACE, u'number:{}'.format(p_number), app)
+
+    def clear(self):
+        self.cache.bump(NAMESPACE)
+
+    def stats(self):
+        return self.cache.stats(NAMESPACE)
+
+    def _query(self):
+        state = self._state()
+        return state['db'].session.query(*[getattr(state['model'], field) for field in FIELDS])
+
+    def _store(self, row):
+        product = dict(zip(FIELDS, row))
+        ttl = self._state()['ttl']
+        self.cache.set(NAMESPACE, u'number:{}'.format(product['p_number']), product, ttl)
+        self.cache.set(NAMESPACE, u'id:{}'.format(product['p_id']), product, ttl)
+        return product
+
+    def _changed(self, mapper, connection, target):
+        # The part number itself may be what changed, so drop the old one too
+        history = inspect(target).attrs.p_number.history
+        keys = [(target.p_id, number) for number in [target.p_number] + list(history.deleted or ())]
+        for p_id, p_number in keys:
+            self.invalidate(p_id, p_number)
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault('prices_stale', []).extend(keys)
+
+    def _after_commit(self, session):
+        for p_id, p_number in session.info.pop('prices_stale', ()):
+            self.invalidate(p_id, p_number, app=session.app)
+
+    def _after_rollback(self, session):
+        session.info.pop('prices_stale', None)
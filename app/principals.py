@@ -0,0 +1,118 @@
+from collections import namedtuple
+
+import six
+from flask import current_app
+from flask_login import UserMixin
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import object_session
+
+NAMESPACE = 'principals'
+FIELDS = ('id', 'username', 'is_admin', 'language', 'department', 'role')
+
+
+class Principal(namedtuple('Principal', FIELDS), UserMixin):
+    """
+    What a request needs to know about the logged in employee: their id,
+    username, whether they are an admin, their language and the names of
+    their department and role. Immutable; change the Employee instead.
+    """
+    __slots__ = ()
+
+    def get_id(self):
+        return six.text_type(self.id)
+
+
+class PrincipalCache(object):
+    """
+    Principals of the logged in employees, read with their department and
+    role in one query and kept for PRINCIPAL_CACHE_TTL seconds in the
+    shared cache (see app.cache), so most requests load their user without
+    touching the database.
+
+    Updating or deleting an employee drops their principal at flush time
+    and again once the transaction commits. Renaming or deleting a
+    department or role drops every principal.
+    """
+
+    def __init__(self, app=None, db=None, cache=None):
+        self._listening = False
+        if app is not None:
+            self.init_app(app, db, cache)
+
+    def init_app(self, app, db, cache):
+        from .models import Department, Employee, Role
+        app.extensions['principals'] = {
+            'db': db, 'cache': cache, 'models': (Employee, Department, Role),
+            'ttl': app.config.get('PRINCIPAL_CACHE_TTL', 60),
+        }
+
+        if not self._listening:
+            event.listen(Employee, 'after_update', self._employee_changed)
+            event.listen(Employee, 'after_delete', self._employee_changed)
+            for model in (Department, Role):
+                event.listen(model, 'after_update', self._group_renamed)
+                event.listen(model, 'after_delete', self._group_changed)
+            event.listen(SignallingSession, 'after_commit', self._after_commit)
+            event.listen(SignallingSession, 'after_rollback', self._after_rollback)
+            self._listening = True
+
+    def _state(self, app=None):
+        return (app or current_app).extensions['principals']
+
+    def load(self, user_id):
+        """
+        The Principal of the employee with id `user_id`, or None
+        """
+        state = self._state()
+        user_id = int(user_id)
+        fields = state['cache'].get(NAMESPACE, user_id)
+        if fields is None:
+            employee, department, role = state['models']
+            with state['db'].primary():
+                fields = state['db'].session.query(
+                    employee.id, employee.username, employee.is_admin, employee.language,
+                    department.name, role.name) \
+                    .outerjoin(department, employee.department_id == department.id) \
+                    .outerjoin(role, employee.role_id == role.id) \
+                    .filter(employee.id == user_id).first()
+            if fields is None:
+                return None
+            # Stored as a plain tuple so any backend can pickle it
+            fields = tuple(fields)
+            state['cache'].set(NAMESPACE, user_id, fields, state['ttl'])
+        return Principal(*fields)
+
+    def invalidate(self, user_id, app=None):
+        self._state(app)['cache'].delete(NAMESPACE, int(user_id), app)
+
+    def clear(self, app=None):
+        self._state(app)['cache'].bump(NAMESPACE, app)
+
+    def _employee_changed(self, mapper, connection, target):
+        self.invalidate(target.id)
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault('principals_stale', set()).add(target.id)
+
+    def _group_renamed(self, mapper, connection, target):
+        # Also called when only the group's employees changed
+        if inspect(target).attrs.name.history.has_changes():
+            self._group_changed(mapper, connection, target)
+
+    def _group_changed(self, mapper, connection, target):
+        self.clear()
+        session = object_session(target)
+        if session is not None:
+            session.info['principals_cleared'] = True
+
+    def _after_commit(self, session):
+        for user_id in session.info.pop('principals_stale', ()):
+            self.invalidate(user_id, app=session.app)
+        if session.info.pop('principals_cleared', False):
+            self.clear(app=session.app)
+
+    def _after_rollback(self, session):
+        session.info.pop('principals_stale', None)
+        session.info.pop('principals_cleared', None)
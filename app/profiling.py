@@ -0,0 +1,275 @@
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter
+
+from flask import (before_render_template, current_app, g, has_request_context, request,
+                   template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Mapper
+
+logger = logging.getLogger('app.profiling')
+logger.addHandler(logging.NullHandler())
+
+# Upper bounds of the histogram buckets, in milliseconds and in statements;
+# anything larger lands in a last, open ended bucket
+TIME_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# A parenthesised list of placeholders, in any DBAPI's paramstyle, so
+# IN (?, ?) and IN (?, ?, ?) count as the same statement
+PLACEHOLDER = r'\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*'
+PLACEHOLDER_LIST = re.compile(r'\((?:{0},)+{0}\)'.format(PLACEHOLDER))
+WHITESPACE = re.compile(r'\s+')
+
+
+def statement_shape(statement):
+    """
+    `statement` with its whitespace and IN lists collapsed, so repeats of
+    one query with different values compare equal
+    """
+    return WHITESPACE.sub(' ', PLACEHOLDER_LIST.sub('(?)', statement)).strip()
+
+
+class Histogram(object):
+    """
+    Counts of values in fixed buckets, with their total and maximum, from
+    which percentiles are estimated as bucket upper bounds
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        bucket = 0
+        while bucket < len(self.bounds) and value > self.bounds[bucket]:
+            bucket += 1
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= fraction * self.count:
+                return self.bounds[bucket] if bucket < len(self.bounds) else self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / float(self.count) if self.count else 0,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'buckets': [(bound, count) for bound, count in
+                        zip(list(self.bounds) + [None], self.counts)],
+        }
+
+
+class RequestProfile(object):
+    """
+    What one request did: statements run and the time spent in them, model
+    instances loaded, time spent rendering templates, and how often each
+    statement shape came up
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.statements = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.render_time = 0.0
+        self.shapes = Counter()
+        self.timings = {}
+        self._query_starts = []
+        self._render_starts = []
+
+
+class EndpointStats(object):
+
+    def __init__(self):
+        self.duration = Histogram(TIME_BUCKETS)
+        self.db_time = Histogram(TIME_BUCKETS)
+        self.render_time = Histogram(TIME_BUCKETS)
+        self.statements = Histogram(COUNT_BUCKETS)
+        self.rows = Histogram(COUNT_BUCKETS)
+        # statement shape: most times it was run within one request
+        self.repeated = {}
+
+    def as_dict(self):
+        return {
+            'duration_ms': self.duration.as_dict(),
+            'db_ms': self.db_time.as_dict(),
+            'render_ms': self.render_time.as_dict(),
+            'statements': self.statements.as_dict(),
+            'rows': self.rows.as_dict(),
+            'repeated': sorted(self.repeated.items(), key=lambda item: -item[1]),
+        }
+
+
+class QueryProfiler(object):
+    """
+    Per request instrumentation of the SQL run and the templates rendered
+
+    With PROFILE_REQUESTS on, each request records its endpoint, number of
+    statements, time spent in the database and rendering, and model
+    instances loaded. A statement shape run PROFILE_REPEATED_STATEMENTS
+    times or more in one request is reported as a likely N+1 query. Every
+    request is logged as one JSON line on the 'app.profiling' logger, at
+    WARNING when it is slower than PROFILE_SLOW_REQUEST milliseconds or
+    repeats a statement, and the aggregates of this process are shown at
+    /admin/profiling. With it off no listener is installed.
+    """
+
+    def __init__(self, app=None):
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config.get('PROFILE_REQUESTS', False):
+            return
+        app.extensions['profiling'] = {
+            'lock': threading.Lock(),
+            'endpoints': {},
+            'statements': {},
+            'slow': app.config.get('PROFILE_SLOW_REQUEST', 500),
+            'repeated': app.config.get('PROFILE_REPEATED_STATEMENTS', 5),
+            'max_statements': app.config.get('PROFILE_MAX_STATEMENTS', 500),
+        }
+        app.before_request(self._start)
+        app.teardown_request(self._finish)
+
+        if not self._listening:
+            event.listen(Engine, 'before_cursor_execute', self._before_execute)
+            event.listen(Engine, 'after_cursor_execute', self._after_execute)
+            event.listen(Mapper, 'load', self._load)
+            before_render_template.connect(self._before_render, weak=False)
+            template_rendered.connect(self._rendered, weak=False)
+            self._listening = True
+
+    def enabled(self, app):
+        return 'profiling' in app.extensions
+
+    def _profile(self):
+        if has_request_context():
+            return getattr(g, '_profile', None)
+        return None
+
+    def _start(self):
+        g._profile = RequestProfile()
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        profile = self._profile()
+        if profile is not None:
+            profile._query_starts.append(time.time())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        profile = self._profile()
+        if profile is None or not profile._query_starts:
+            return
+        elapsed = time.time() - profile._query_starts.pop()
+        shape = statement_shape(statement)
+        profile.statements += 1
+        profile.db_time += elapsed
+        profile.shapes[shape] += 1
+        profile.timings[shape] = profile.timings.get(shape, 0) + elapsed
+
+    def _load(self, target, context):
+        profile = self._profile()
+        if profile is not None:
+            profile.rows += 1
+
+    def _before_render(self, sender, template, context, **extra):
+        profile = self._profile()
+        if profile is not None:
+            profile._render_starts.append(time.time())
+
+    def _rendered(self, sender, template, context, **extra):
+        profile = self._profile()
+        if profile is not None and profile._render_starts:
+            profile.render_time += time.time() - profile._render_starts.pop()
+
+    def _finish(self, exc=None):
+        profile = g.pop('_profile', None)
+        if profile is None:
+            return
+        state = current_app.extensions['profiling']
+        endpoint = request.endpoint or '(unmatched)'
+        duration = (time.time() - profile.started) * 1000
+        repeated = dict((shape, count) for shape, count in profile.shapes.items()
+                        if count >= state['repeated'])
+
+        with state['lock']:
+            stats = state['endpoints'].get(endpoint)
+            if stats is None:
+                stats = state['endpoints'][endpoint] = EndpointStats()
+            stats.duration.add(duration)
+            stats.db_time.add(profile.db_time * 1000)
+            stats.render_time.add(profile.render_time * 1000)
+            stats.statements.add(profile.statements)
+            stats.rows.add(profile.rows)
+            for shape, count in repeated.items():
+                stats.repeated[shape] = max(count, stats.repeated.get(shape, 0))
+
+            statements = state['statements']
+            for shape, count in profile.shapes.items():
+                totals = statements.get(shape)
+                if totals is None:
+                    if len(statements) >= state['max_statements']:
+                        continue
+                    totals = statements[shape] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+                elapsed = profile.timings[shape] * 1000
+                totals['count'] += count
+                totals['total_ms'] += elapsed
+                totals['max_ms'] = max(totals['max_ms'], elapsed / count)
+
+        record = {
+            'endpoint': endpoint,
+            'method': request.method,
+            'path': request.path,
+            'duration_ms': round(duration, 3),
+            'statements': profile.statements,
+            'db_ms': round(profile.db_time * 1000, 3),
+            'rows': profile.rows,
+            'render_ms': round(profile.render_time * 1000, 3),
+            'repeated': repeated,
+            'error': exc is not None,
+        }
+        level = logging.WARNING if repeated or duration > state['slow'] else logging.INFO
+        logger.log(level, json.dumps(record, sort_keys=True))
+
+    def report(self, app=None, top=20):
+        """
+        The aggregates of this process: histograms by endpoint, and the
+        `top` statement shapes by total time spent in them
+        """
+        state = (app or current_app).extensions['profiling']
+        with state['lock']:
+            endpoints = dict((endpoint, stats.as_dict())
+                             for endpoint, stats in state['endpoints'].items())
+            statements = sorted(({'statement': shape, 'count': totals['count'],
+                                  'total_ms': totals['total_ms'], 'max_ms': totals['max_ms']}
+                                 for shape, totals in state['statements'].items()),
+                                key=lambda row: -row['total_ms'])[:top]
+        return {'endpoints': endpoints, 'statements': statements}
+
+    def reset(self, app=None):
+        """
+        Forget the aggregates collected so far
+        """
+        state = (app or current_app).extensions['profiling']
+        with state['lock']:
+            state['endpoints'].clear()
+            state['statements'].clear()
@@ -0,0 +1,99 @@
+import re
+from collections import OrderedDict
+from datetime import date
+
+import six
+
+from . import db
+
+# The tables a plan reads in full, by dialect
+SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\S+)(.*)$')
+POSTGRESQL_SCAN = re.compile(r'Seq Scan on (\S+)')
+
+EXPLAIN = {
+    'sqlite': 'EXPLAIN QUERY PLAN',
+    'mysql': 'EXPLAIN',
+    'postgresql': 'EXPLAIN',
+}
+
+
+def explain(statement, bind=None):
+    """
+    The plan the database makes for `statement`, a query or a select, as
+    the rows its EXPLAIN returns
+    """
+    bind = bind or db.session.connection()
+    statement = getattr(statement, 'statement', statement)
+    compiled = statement.compile(dialect=bind.dialect)
+    params = compiled.construct_params()
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    sql = u'{} {}'.format(EXPLAIN[bind.dialect.name], six.text_type(compiled))
+    return bind.execute(sql, params).fetchall()
+
+
+def full_scans(statement, bind=None):
+    """
+    The tables `statement` reads from end to end rather than through an
+    index, or None for a database whose plans are not understood here
+    """
+    bind = bind or db.session.connection()
+    dialect = bind.dialect.name
+    if dialect not in EXPLAIN:
+        return None
+    tables = []
+    for row in explain(statement, bind):
+        if dialect == 'sqlite':
+            match = SQLITE_SCAN.match(row[-1])
+            # "SCAN t USING INDEX i" walks an index in order, e.g. for a
+            # LIMITed ORDER BY, which is what the index is there for
+            if match and 'INDEX' not in match.group(2):
+                tables.append(match.group(1))
+        elif dialect == 'mysql':
+            row = dict(row.items())
+            if row.get('type') == 'ALL':
+                tables.append(row['table'])
+        else:
+            tables.extend(POSTGRESQL_SCAN.findall(row[0]))
+    return sorted(set(tables))
+
+
+def index_checks():
+    """
+    The lookups the admin views and the bulk operations make over and
+    over, as queries with placeholder values, by description. Each should
+    be answered through an index.
+    """
+    from .admin.views import (contact_list, customer_list, opportunity_list, product_list,
+                              quotation_detail_list, quotation_list)
+    from .models import Contact, Opportunity, Product, Quotation, Quotation_Detail
+
+    checks = OrderedDict([
+        ('contacts of an account code', Contact.query.filter(Contact.acc_code == u'')),
+        ('contacts of customers', Contact.query.filter(Contact.c_id.in_([0, 1]))),
+        ('quotations of a customer', Quotation.query.filter(Quotation.c_id == 0)
+            .order_by(Quotation.q_num)),
+        ('lines of a quotation', Quotation_Detail.query.filter(Quotation_Detail.q_id == 0)
+            .order_by(Quotation_Detail.quote_detail_id)),
+        ('lines of quotations', Quotation_Detail.query.filter(Quotation_Detail.q_id.in_([0, 1]))),
+        ('lines quoting products', Quotation_Detail.query.filter(Quotation_Detail.p_id.in_([0, 1]))),
+        ('opportunities of quotations', Opportunity.query.filter(Opportunity.q_id.in_([0, 1]))),
+        ('opportunities closing in a month', Opportunity.query.filter(
+            Opportunity.close_date.between(date(2000, 1, 1), date(2000, 1, 31)))),
+        ('products of a supplier', Product.query.filter(Product.supplier == u'')),
+    ])
+    for engine in (customer_list, contact_list, product_list, quotation_list,
+                   opportunity_list, quotation_detail_list):
+        for sort in engine.sortable:
+            checks['{} list by {}'.format(engine.model.__tablename__, sort)] = \
+                engine.model.query.order_by(engine.sort_attr(sort), engine.pk_attr).limit(50)
+    return checks
+
+
+def check_indexes(bind=None):
+    """
+    (description, tables read in full) for every index_checks query, the
+    tables being None where the database is not supported
+    """
+    return [(description, full_scans(query, bind))
+            for description, query in index_checks().items()]
@@ -0,0 +1,265 @@
+import os
+import re
+
+import six
+from flask import current_app
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+from sqlalchemy.inspection import inspect
+from whoosh import fields, query
+from whoosh.analysis import Filter, LowercaseFilter, Token, Tokenizer
+from whoosh.filedb.filestore import FileStorage, RamStorage
+from whoosh.writing import AsyncWriter
+
+# Hiragana, katakana, CJK ideographs and half width katakana
+CJK = u'\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff66-\uff9f'
+WORD = re.compile(u'[%s]+|[^\\W%s]+(?:\\.[^\\W%s]+)*' % (CJK, CJK, CJK), re.UNICODE)
+CJK_RUN = re.compile(u'[%s]' % CJK, re.UNICODE)
+
+
+class CJKTokenizer(Tokenizer):
+    """
+    Split latin text into words and runs of Japanese/Chinese text into
+    overlapping bigrams, since CJK text has no spaces between words.
+
+    Single characters are indexed as well so one character searches work,
+    but a query only uses them when it is a single character itself.
+    """
+
+    def __call__(self, value, positions=False, chars=False, keeporiginal=False,
+                 removestops=True, start_pos=0, start_char=0, tokenize=True,
+                 mode='', **kwargs):
+        t = Token(positions, chars, removestops=removestops, mode=mode, **kwargs)
+        pos = start_pos
+        for match in WORD.finditer(value):
+            word = match.group(0)
+            if CJK_RUN.match(word):
+                grams = [(i, word[i:i + 2]) for i in range(len(word) - 1)]
+                if len(word) == 1 or mode != 'query':
+                    grams.extend((i, c) for i, c in enumerate(word))
+            else:
+                grams = [(0, word)]
+
+            for offset, gram in grams:
+                t.text = gram
+                t.boost = 1.0
+                t.stopped = False
+                if keeporiginal:
+                    t.original = gram
+                if positions:
+                    t.pos = pos
+                    pos += 1
+                if chars:
+                    t.startchar = start_char + match.start() + offset
+                    t.endchar = t.startchar + len(gram)
+                yield t
+
+
+class SuffixFilter(Filter):
+    """
+    Index every suffix of each latin word as well, so that the prefix
+    queries of a search match anywhere in a code: '002' finds 'EX002'
+    """
+
+    def __call__(self, tokens):
+        for t in tokens:
+            if t.mode == 'query' or CJK_RUN.match(t.text):
+                yield t
+                continue
+            word = t.text
+            for i in range(len(word)):
+                t.text = word[i:]
+                yield t
+
+
+def CJKAnalyzer():
+    return CJKTokenizer() | LowercaseFilter()
+
+
+def CodeAnalyzer():
+    return CJKTokenizer() | LowercaseFilter() | SuffixFilter()
+
+
+def searchable_models(db):
+    """
+    Every model that declares `__searchable__` fields
+    """
+    return [model for model in db.Model._decl_class_registry.values()
+            if isinstance(model, type) and hasattr(model, '__searchable__')]
+
+
+def _pk(obj):
+    return inspect(obj).mapper.primary_key_from_instance(obj)[0]
+
+
+def _text(value):
+    if isinstance(value, six.binary_type):
+        return value.decode('utf-8', 'replace')
+    return six.text_type(value)
+
+
+class SearchIndex(object):
+    """
+    Inverted index over the `__searchable__` fields of the models
+
+    Each model gets its own Whoosh index in WHOOSH_BASE (or in memory when
+    it is ':memory:'). Inserts, updates and deletes are picked up from the
+    session at flush time and written to the index once the transaction
+    commits, so the index never sees rows that were rolled back.
+    """
+
+    def __init__(self, app=None, db=None):
+        self._listening = False
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        base = app.config.get('WHOOSH_BASE') or os.path.join(app.instance_path, 'whoosh_index')
+        if base == ':memory:':
+            storage = RamStorage()
+        else:
+            if not os.path.exists(base):
+                os.makedirs(base)
+            storage = FileStorage(base)
+
+        models = dict((model.__name__, model) for model in searchable_models(db))
+        app.extensions['search'] = {'storage': storage, 'models': models, 'indexes': {}}
+
+        if not self._listening:
+            event.listen(SignallingSession, 'after_flush', self._after_flush)
+            event.listen(SignallingSession, 'after_commit', self._after_commit)
+            event.listen(SignallingSession, 'after_rollback', self._after_rollback)
+            self._listening = True
+
+    def _state(self, app=None):
+        return (app or current_app).extensions['search']
+
+    def schema(self, model):
+        """
+        A primary key ID plus one CJK-aware text field per searchable field.
+        The fields also listed in `__searchable_codes__` match on any part
+        of a word, as account codes and part numbers are searched.
+        """
+        schema = fields.Schema(pk=fields.ID(stored=True, unique=True))
+        codes = getattr(model, '__searchable_codes__', ())
+        for name in model.__searchable__:
+            analyzer = CodeAnalyzer() if name in codes else CJKAnalyzer()
+            schema.add(name, fields.TEXT(analyzer=analyzer))
+        return schema
+
+    def index(self, model, app=None):
+        state = self._state(app)
+        name = model.__name__
+        if name not in state['indexes']:
+            storage = state['storage']
+            if storage.index_exists(indexname=name):
+                state['indexes'][name] = storage.open_index(indexname=name)
+            else:
+                state['indexes'][name] = storage.create_index(self.schema(model), indexname=name)
+        return state['indexes'][name]
+
+    def document(self, obj):
+        doc = {'pk': _text(_pk(obj))}
+        for name in obj.__searchable__:
+            value = getattr(obj, name)
+            if value is not None:
+                doc[name] = _text(value)
+        return doc
+
+    def search(self, model, text, limit=None):
+        """
+        Return up to `limit` primary keys of `model` matching every word in
+        `text`, best match first, or all of them when `limit` is 0. Words
+        match by prefix, exact matches rank higher.
+        """
+        if limit is None:
+            limit = current_app.config.get('SEARCH_LIMIT', 100)
+        ix = self.index(model)
+        terms = []
+        for token in CJKAnalyzer()(_text(text), mode='query'):
+            word = token.text
+            matches = []
+            for name in model.__searchable__:
+                matches.append(query.Term(name, word, boost=2.0))
+                if not CJK_RUN.match(word):
+                    matches.append(query.Prefix(name, word))
+            terms.append(query.Or(matches))
+        if not terms:
+            return []
+
+        with ix.searcher() as searcher:
+            hits = searcher.search(query.And(terms), limit=limit or None)
+            pk_type = inspect(model).primary_key[0].type.python_type
+            return [pk_type(hit['pk']) for hit in hits]
+
+    def update(self, model, objs, app=None):
+        """
+        Add or replace the documents for `objs` in one writer. The old
+        documents are removed with a single query, as update_document opens
+        a searcher per document which is slow for bulk loads.
+        """
+        docs = [self.document(obj) for obj in objs]
+        if not docs:
+            return
+        with AsyncWriter(self.index(model, app)) as writer:
+            writer.delete_by_query(query.Or([query.Term('pk', doc['pk']) for doc in docs]))
+            for doc in docs:
+                writer.add_document(**doc)
+
+    def remove(self, model, pks, app=None):
+        """
+        Drop the documents of `model` with the given primary keys, for rows
+        deleted by bulk statements
+        """
+        terms = [query.Term('pk', _text(pk)) for pk in pks]
+        if not terms:
+            return
+        with AsyncWriter(self.index(model, app)) as writer:
+            writer.delete_by_query(query.Or(terms))
+
+    def rebuild(self, model, batch_size=1000):
+        """
+        Recreate the index for `model` from the database, used for the
+        first build and after bulk statements that bypass the session
+        """
+        state = self._state()
+        name = model.__name__
+        state['indexes'][name] = state['storage'].create_index(self.schema(model), indexname=name)
+        writer = state['indexes'][name].writer()
+        count = 0
+        for obj in model.query.yield_per(batch_size):
+            writer.add_document(**self.document(obj))
+            count += 1
+        writer.commit()
+        return count
+
+    def _after_flush(self, session, flush_context):
+        pending = session.info.setdefault('search_pending', {})
+        changed = [obj for obj in session.dirty if session.is_modified(obj)]
+        for obj in list(session.new) + changed:
+            if hasattr(obj, '__searchable__'):
+                pending[(type(obj).__name__, _pk(obj))] = self.document(obj)
+        for obj in session.deleted:
+            if hasattr(obj, '__searchable__'):
+                pending[(type(obj).__name__, _pk(obj))] = None
+
+    def _after_commit(self, session):
+        pending = session.info.pop('search_pending', None)
+        if not pending:
+            return
+        state = self._state(session.app)
+        bymodel = {}
+        for (name, pk), doc in pending.items():
+            if name in state['models']:
+                bymodel.setdefault(name, []).append((_text(pk), doc))
+
+        for name, docs in bymodel.items():
+            with AsyncWriter(self.index(state['models'][name], session.app)) as writer:
+                for pk, doc in docs:
+                    if doc is None:
+                        writer.delete_by_term('pk', pk)
+                    else:
+                        writer.update_document(**doc)
+
+    def _after_rollback(self, session):
+        session.info.pop('search_pending', None)
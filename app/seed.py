@@ -0,0 +1,202 @@
+import random
+from collections import OrderedDict
+from datetime import date, timedelta
+
+from . import choice_cache, dashboard_snapshot, db, price_cache, search_index
+from .models import Contact, Customer, Opportunity, Product, Quotation, Quotation_Detail
+from .pipeline import rebuild as rebuild_pipeline
+from .search import searchable_models
+from .totals import line_totals
+
+# Rows generated at scale 1, the size of a busy installation
+VOLUMES = OrderedDict([
+    ('customers', 10000),
+    ('contacts', 30000),
+    ('products', 50000),
+    ('quotations', 20000),
+    ('quotation_details', 500000),
+    ('opportunities', 20000),
+])
+
+FIRST_NAMES = ('Aiko', 'Ben', 'Carla', 'Daisuke', 'Emma', 'Farid', 'Grace', 'Hiro',
+               'Ines', 'Jun', 'Kate', 'Liam', 'Mei', 'Noah', 'Olga', 'Priya')
+LAST_NAMES = ('Abe', 'Brown', 'Chen', 'Diaz', 'Endo', 'Fischer', 'Garcia', 'Honda',
+              'Ito', 'Jones', 'Kato', 'Lopez', 'Mori', 'Nagai', 'Ota', 'Smith')
+CITIES = ('Tokyo', 'Osaka', 'Nagoya', 'San Jose', 'Austin', 'Boston', 'Munich', 'Lyon',
+          'Taipei', 'Seoul', 'Singapore', 'Toronto')
+COMPANY_WORDS = ('Acme', 'Apex', 'Blue', 'Delta', 'Global', 'Nova', 'Orbit', 'Prime',
+                 'Summit', 'Vertex')
+SUPPLIERS = tuple('Supplier {:02d}'.format(n) for n in range(1, 41))
+CATEGORIES = ('Camera', 'Lens', 'Lighting', 'Cable', 'Controller', 'Software', 'Sensor',
+              'Mount', 'Service', 'Accessory')
+REGIONS = ('Asia', 'Europe', 'North America', 'South America', 'Oceania')
+FAMILIES = ('Vision', 'Motion', 'Inspection', 'Measurement')
+REVENUE_CATEGORIES = ('New', 'Upgrade', 'Service')
+START = date(2015, 1, 1)
+
+
+def volumes(scale=1.0):
+    """
+    VOLUMES times `scale`, at least one row each
+    """
+    return OrderedDict((table, max(1, int(round(count * scale))))
+                       for table, count in VOLUMES.items())
+
+
+def _insert(model, rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            db.session.bulk_insert_mappings(model, batch)
+            batch = []
+    if batch:
+        db.session.bulk_insert_mappings(model, batch)
+
+
+def _name(rnd):
+    return rnd.choice(FIRST_NAMES), rnd.choice(LAST_NAMES)
+
+
+def _customers(rnd, count):
+    for c_id in range(1, count + 1):
+        f_name, l_name = _name(rnd)
+        yield {'c_id': c_id,
+               'acc_code': u'C{:06d}'.format(c_id),
+               'comp_name': u'{} {} {}'.format(rnd.choice(COMPANY_WORDS), l_name, c_id)[:20],
+               'f_name': f_name, 'l_name': l_name,
+               'city': rnd.choice(CITIES),
+               'phone': u'555-{:07d}'.format(c_id),
+               'email': u'c{}@example.com'.format(c_id)}
+
+
+def _contacts(rnd, count, customers, contacts_of):
+    for contact_id in range(1, count + 1):
+        # every customer gets one before any gets a second
+        c_id = contact_id if contact_id <= customers else rnd.randint(1, customers)
+        contacts_of.setdefault(c_id, []).append(contact_id)
+        f_name, l_name = _name(rnd)
+        yield {'contact_id': contact_id, 'c_id': c_id,
+               'acc_code': u'C{:06d}'.format(c_id),
+               'f_name': f_name, 'l_name': l_name,
+               'city': rnd.choice(CITIES),
+               'phone': u'555-{:07d}'.format(contact_id),
+               'email': u'p{}@example.com'.format(contact_id)}
+
+
+def _products(rnd, count, prices):
+    for p_id in range(1, count + 1):
+        cost = round(rnd.uniform(5, 5000), 2)
+        price = round(cost * rnd.uniform(1.1, 1.8), 2)
+        prices.append(price)
+        category = rnd.choice(CATEGORIES)
+        yield {'p_id': p_id,
+               'p_number': u'P{:07d}'.format(p_id),
+               'p_name': u'{} {}'.format(category, p_id),
+               'unit_price': price, 'unit_cost': cost,
+               'cost_native': cost, 'exchange_rate': 1.0,
+               'supplier': rnd.choice(SUPPLIERS),
+               'p_category': category,
+               'p_status': u'Active' if rnd.random() < 0.9 else u'Discontinued',
+               'date_created': START + timedelta(days=rnd.randint(0, 3000))}
+
+
+def _quotations(rnd, count, lines, customers, contacts_of, prices, details):
+    # The lines are spread evenly, the first quotations taking the rest
+    per_quotation, extra = divmod(lines, count)
+    detail_id = 0
+    for q_id in range(1, count + 1):
+        q_num = 100000 + q_id
+        totals = [0, 0, 0]
+        for n in range(per_quotation + (1 if q_id <= extra else 0)):
+            detail_id += 1
+            p_id = rnd.randint(1, len(prices))
+            line = {'quote_detail_id': detail_id, 'q_id': q_id, 'q_num': q_num,
+                    'p_id': p_id, 'p_num': u'P{:07d}'.format(p_id),
+                    'p_name': u'Product {}'.format(p_id),
+                    'quantity': float(rnd.randint(1, 20)),
+                    'discount': rnd.choice((0, 0, 0, 0.05, 0.1)),
+                    'q_price': prices[p_id - 1],
+                    'option': rnd.random() < 0.1}
+            for i, value in enumerate(line_totals(line['quantity'], line['q_price'],
+                                                  line['discount'], line['option'])):
+                totals[i] += value
+            details.append(line)
+
+        c_id = rnd.randint(1, customers)
+        contact_id = rnd.choice(contacts_of.get(c_id) or [None])
+        f_name, l_name = _name(rnd)
+        subtotal, discount, optional = totals
+        yield {'q_id': q_id, 'c_id': c_id, 'q_num': q_num,
+               'acc_code': u'C{:06d}'.format(c_id),
+               'contact_id': contact_id,
+               'e_id': u'E{:03d}'.format(rnd.randint(1, 50)),
+               'date': START + timedelta(days=rnd.randint(0, 3000)),
+               'q_title': u'Quotation {}'.format(q_num),
+               'f_name': f_name, 'l_name': l_name,
+               'city': rnd.choice(CITIES),
+               'q_amount': int(round(subtotal - discount)),
+               'q_subtotal': subtotal, 'q_discount': discount, 'q_optional': optional}
+
+
+def _opportunities(rnd, count, quotations):
+    for o_id in range(1, count + 1):
+        q_id = o_id if o_id <= quotations else rnd.randint(1, quotations)
+        potential = round(rnd.uniform(1000, 200000), 2)
+        stage = rnd.randint(1, 6)
+        won = stage == 6 and rnd.random() < 0.6
+        yield {'o_id': o_id, 'q_id': q_id, 'q_num': 100000 + q_id,
+               'sales_stage': stage,
+               'close_date': START + timedelta(days=rnd.randint(0, 3300)),
+               'probability': 1.0 if won else round(rnd.uniform(0, 0.9), 2),
+               'region': rnd.choice(REGIONS),
+               'family': rnd.choice(FAMILIES),
+               'rev_category': rnd.choice(REVENUE_CATEGORIES),
+               'potential_money': potential,
+               'probable_money': round(potential * 0.5, 2),
+               'actual_money': potential if won else 0.0,
+               'revenue': potential if won else 0.0}
+
+
+def seed(scale=1.0, random_seed=0, batch_size=5000, reindex=True):
+    """
+    Fill an empty database with generated customers, contacts, products,
+    quotations with their lines, and opportunities: VOLUMES times `scale`,
+    the same rows every time for the same `random_seed`. The rows are bulk
+    inserted, so the pipeline rollups, caches and, with `reindex`, the
+    search indexes are rebuilt afterwards. Returns the rows per table.
+    """
+    rnd = random.Random(random_seed)
+    counts = volumes(scale)
+    contacts_of = {}
+    prices = []
+
+    _insert(Customer, _customers(rnd, counts['customers']), batch_size)
+    _insert(Contact, _contacts(rnd, counts['contacts'], counts['customers'], contacts_of),
+            batch_size)
+    _insert(Product, _products(rnd, counts['products'], prices), batch_size)
+    details = []
+    quotations = _quotations(rnd, counts['quotations'], counts['quotation_details'],
+                             counts['customers'], contacts_of, prices, details)
+    # Each quotation is inserted ahead of its lines, a batch at a time
+    batch = []
+    for quotation in quotations:
+        batch.append(quotation)
+        if len(batch) == batch_size or len(details) >= batch_size:
+            db.session.bulk_insert_mappings(Quotation, batch)
+            _insert(Quotation_Detail, details, batch_size)
+            batch, details[:] = [], []
+    db.session.bulk_insert_mappings(Quotation, batch)
+    _insert(Quotation_Detail, details, batch_size)
+    _insert(Opportunity, _opportunities(rnd, counts['opportunities'], counts['quotations']),
+            batch_size)
+    db.session.commit()
+
+    rebuild_pipeline()
+    if reindex:
+        for model in searchable_models(db):
+            search_index.rebuild(model)
+    choice_cache.invalidate(Customer, Contact, Product, Quotation, Opportunity)
+    price_cache.clear()
+    dashboard_snapshot.invalidate()
+    return counts
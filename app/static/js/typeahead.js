@@ -0,0 +1,48 @@
+// Typeahead for the select boxes rendered by TypeaheadSelectField. The
+// server only renders the selected option, so a search box is put in front
+// of each select and the options matching what is typed are fetched from
+// the url in its data-typeahead attribute.
+(function() {
+    function attach(select) {
+        var search = document.createElement('input');
+        search.type = 'search';
+        search.className = 'form-control';
+        search.placeholder = 'Type to search';
+        select.parentNode.insertBefore(search, select);
+
+        var timer = null;
+        var latest = 0;
+        search.addEventListener('input', function() {
+            clearTimeout(timer);
+            timer = setTimeout(function() {
+                var request = ++latest;
+                var xhr = new XMLHttpRequest();
+                xhr.open('GET', select.getAttribute('data-typeahead') + '?q=' + encodeURIComponent(search.value));
+                xhr.onload = function() {
+                    // ignore answers to searches that have since been replaced
+                    if (request !== latest || xhr.status !== 200) {
+                        return;
+                    }
+                    var results = JSON.parse(xhr.responseText).results;
+                    select.options.length = 0;
+                    results.forEach(function(item) {
+                        select.options.add(new Option(item[1], item[0]));
+                    });
+                    if (results.length) {
+                        var changed = document.createEvent('HTMLEvents');
+                        changed.initEvent('change', true, false);
+                        select.dispatchEvent(changed);
+                    }
+                };
+                xhr.send();
+            }, 200);
+        });
+    }
+
+    document.addEventListener('DOMContentLoaded', function() {
+        var selects = document.querySelectorAll('select[data-typeahead]');
+        for (var i = 0; i < selects.length; i++) {
+            attach(selects[i]);
+        }
+    });
+})();
@@ -0,0 +1,163 @@
+from sqlalchemy import bindparam, case, func
+from sqlalchemy.orm.util import identity_key
+
+from . import dashboard_snapshot, db
+from .models import Quotation, Quotation_Detail
+
+# Totals that differ by less than this are not worth rewriting
+TOLERANCE = 0.005
+
+
+def line_totals(quantity, q_price, discount, option):
+    """
+    What one quotation line contributes to its quotation, as a tuple of
+    (subtotal, discount, optional). Optional lines only count towards the
+    optional amount, net of their discount. A line whose option was never
+    set counts towards nothing, as the quote amount always left it out.
+    """
+    if option is None:
+        return 0, 0, 0
+    gross = (quantity or 0) * (q_price or 0)
+    off = gross * (discount or 0)
+    if option:
+        return 0, 0, gross - off
+    return gross, off, 0
+
+
+def line_snapshot(detail):
+    """
+    The (q_id, totals) of a line as it stands, taken before editing it so
+    the old contribution can be backed out afterwards
+    """
+    return detail.q_id, line_totals(detail.quantity, detail.q_price,
+                                    detail.discount, detail.option)
+
+
+def apply_line_change(before=None, after=None):
+    """
+    Move the quotation totals from the `before` snapshot of a line to its
+    `after` snapshot. Pass None for `before` when a line is added and for
+    `after` when it is deleted. A line moved to another quotation is taken
+    off the old one and added to the new one.
+
+    Runs inside the caller's transaction, so the line change and the new
+    totals are committed together.
+    """
+    deltas = {}
+    for snapshot, sign in ((before, -1), (after, 1)):
+        if snapshot is None:
+            continue
+        q_id, totals = snapshot
+        current = deltas.setdefault(q_id, [0, 0, 0])
+        for i, value in enumerate(totals):
+            current[i] += sign * value
+
+    for q_id, (subtotal, discount, optional) in deltas.items():
+        if subtotal or discount or optional:
+            add_to_totals(q_id, subtotal, discount, optional)
+
+
+def add_to_totals(q_id, subtotal=0, discount=0, optional=0):
+    """
+    Add deltas to a quotation's totals with a single UPDATE, relative to
+    the stored values so that concurrent edits do not overwrite each other
+    """
+    old_subtotal = func.coalesce(Quotation.q_subtotal, 0)
+    old_discount = func.coalesce(Quotation.q_discount, 0)
+    old_optional = func.coalesce(Quotation.q_optional, 0)
+
+    # q_amount goes first: MySQL evaluates assignments left to right and
+    # would otherwise see the already updated subtotal and discount
+    values = [(Quotation.q_amount, func.round(old_subtotal + subtotal - old_discount - discount)),
+              (Quotation.q_subtotal, old_subtotal + subtotal),
+              (Quotation.q_discount, old_discount + discount),
+              (Quotation.q_optional, old_optional + optional)]
+    Quotation.query.filter(Quotation.q_id == q_id).update(
+        values, synchronize_session=False,
+        update_args={'preserve_parameter_order': True})
+    _expire_totals(q_id)
+
+
+def detail_sums():
+    """
+    Query of (q_id, subtotal, discount, optional) summed over the details
+    of each quotation in SQL
+    """
+    gross = func.coalesce(Quotation_Detail.quantity, 0) * func.coalesce(Quotation_Detail.q_price, 0)
+    off = gross * func.coalesce(Quotation_Detail.discount, 0)
+    # a NULL option matches neither, see line_totals
+    required = Quotation_Detail.option == False
+    optional = Quotation_Detail.option == True
+    return db.session.query(Quotation_Detail.q_id,
+                            func.sum(case([(required, gross)], else_=0)),
+                            func.sum(case([(required, off)], else_=0)),
+                            func.sum(case([(optional, gross - off)], else_=0))) \
+        .group_by(Quotation_Detail.q_id)
+
+
+def recompute(q_id):
+    """
+    Recompute one quotation's totals from its details with one SUM query
+    """
+    sums = detail_sums().filter(Quotation_Detail.q_id == q_id).first()
+    subtotal, discount, optional = [value or 0 for value in sums[1:]] if sums else (0, 0, 0)
+    Quotation.query.filter(Quotation.q_id == q_id).update(
+        {Quotation.q_amount: round(subtotal - discount),
+         Quotation.q_subtotal: subtotal,
+         Quotation.q_discount: discount,
+         Quotation.q_optional: optional},
+        synchronize_session=False)
+    _expire_totals(q_id)
+
+
+def drifted(batch_size=1000):
+    """
+    The quotations whose stored totals differ from those of their details,
+    as mappings of the totals they should have, without changing anything
+    """
+    sums = dict((q_id, (subtotal or 0, discount or 0, optional or 0))
+                for q_id, subtotal, discount, optional in detail_sums())
+
+    stored = db.session.query(Quotation.q_id, Quotation.q_amount, Quotation.q_subtotal,
+                              Quotation.q_discount, Quotation.q_optional)
+    repairs = []
+    for q_id, amount, subtotal, discount, optional in stored.yield_per(batch_size):
+        expected = sums.get(q_id, (0, 0, 0))
+        if amount is None or abs(amount - round(expected[0] - expected[1])) >= 1 or \
+                any(value is None or abs(value - want) > TOLERANCE
+                    for value, want in zip((subtotal, discount, optional), expected)):
+            repairs.append({'q_id': q_id,
+                            'q_amount': round(expected[0] - expected[1]),
+                            'q_subtotal': expected[0],
+                            'q_discount': expected[1],
+                            'q_optional': expected[2]})
+    return repairs
+
+
+def reconcile(batch_size=1000):
+    """
+    Recompute the totals of every quotation from its details in bulk and
+    rewrite the ones that have drifted. Returns the number repaired.
+    """
+    repairs = drifted(batch_size)
+    # A Core UPDATE, like add_to_totals, so the quotations' versions are
+    # left alone and nobody editing one gets a conflict from the repair
+    columns = Quotation.__mapper__.c
+    update = Quotation.__table__.update() \
+        .where(columns.q_id == bindparam('q_id')) \
+        .values(dict((columns[key], bindparam(key)) for key in
+                     ('q_amount', 'q_subtotal', 'q_discount', 'q_optional')))
+    for start in range(0, len(repairs), batch_size):
+        db.session.execute(update, repairs[start:start + batch_size])
+    db.session.commit()
+    if repairs:
+        # the UPDATE bypasses the session events
+        dashboard_snapshot.invalidate()
+    return len(repairs)
+
+
+def _expire_totals(q_id):
+    # The UPDATE bypasses the session, so drop any stale copy it holds
+    quotation = db.session.identity_map.get(identity_key(Quotation, q_id))
+    if quotation is not None:
+        db.session.expire(quotation, ['q_amount', 'q_subtotal', 'q_discount', 'q_optional'])
@@ -1,3 +1,7 @@
+import os
+import tempfile
+
+
 class Config(object):
     """
     Common configurations
@@ -5,6 +9,69 @@ class Config(object):
 
     DEBUG = True
     SQLALCHEMY_TRACK_MODIFICATIONS = True
+    # Rows per page in the admin list views
+    LIST_PER_PAGE = 50
+    # Most results a full-text search returns
+    SEARCH_LIMIT = 100
+    # Options a typeahead select box fetches at a time, by default and at most
+    TYPEAHEAD_LIMIT = 20
+    TYPEAHEAD_MAX_LIMIT = 100
+    # Batched form lookups: most keys per request, and how long browsers keep them
+    LOOKUP_MAX_KEYS = 200
+    LOOKUP_MAX_AGE = 60
+    # Shared cache: 'memory' (this process only), 'file' (CACHE_DIR, shared
+    # by the workers of a host) or 'redis' (CACHE_REDIS_URL)
+    CACHE_BACKEND = 'memory'
+    CACHE_DEFAULT_TTL = 300
+    CACHE_MEMORY_SIZE = 10000
+    CACHE_KEY_PREFIX = 'dreamteam:'
+    # One in this many writes to the file cache also sweeps out expired files
+    CACHE_FILE_SWEEP_EVERY = 1000
+    # Seconds product prices stay in the shared cache
+    PRICE_CACHE_TTL = 300
+    # Seconds the logged in employee's id, role and language stay cached
+    PRINCIPAL_CACHE_TTL = 60
+    # Dashboard KPIs: rows in the top lists, seconds before a snapshot is
+    # refreshed even without writes, and whether to refresh off the request
+    DASHBOARD_TOP = 10
+    DASHBOARD_MAX_AGE = 300
+    DASHBOARD_BACKGROUND = True
+    # Quotation PDFs: 'wkhtmltopdf' or 'stub', and how many processes render
+    PDF_RENDERER = 'wkhtmltopdf'
+    PDF_WORKERS = 2
+    # Seconds a rendered PDF is kept, and the most kept at once
+    PDF_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+    PDF_CACHE_MAX_FILES = 1000
+    # Rows an export fetches from the database at a time
+    EXPORT_BATCH_SIZE = 1000
+    # Pricebook imports: rows written per transaction and read per chunk
+    PRICEBOOK_BATCH_SIZE = 1000
+    PRICEBOOK_CHUNK_SIZE = 5000
+    # Per request SQL and template timings (see app.profiling): on or off,
+    # milliseconds above which a request is logged as slow, and how often
+    # one statement may run in a request before it is reported as an N+1
+    PROFILE_REQUESTS = False
+    PROFILE_SLOW_REQUEST = 500
+    PROFILE_REPEATED_STATEMENTS = 5
+    # Distinct statements whose timings are kept
+    PROFILE_MAX_STATEMENTS = 500
+    # Database connections (see app.database): kept open per worker, opened
+    # beyond those under load, seconds a request waits for one, and seconds
+    # before one is replaced, below the server's wait_timeout
+    SQLALCHEMY_POOL_SIZE = 10
+    SQLALCHEMY_MAX_OVERFLOW = 10
+    SQLALCHEMY_POOL_TIMEOUT = 10
+    SQLALCHEMY_POOL_RECYCLE = 1800
+    # Seconds idle after which a connection is pinged before use, None never
+    DATABASE_PRE_PING = 10
+    # Milliseconds a statement may run on MySQL or PostgreSQL, None no limit
+    DATABASE_STATEMENT_TIMEOUT = None
+    # Read replicas, each with a pool like the primary's, answering the GET
+    # requests of read_only views; seconds between health checks of each, and
+    # seconds an employee's reads stay on the primary after they wrote
+    DATABASE_REPLICA_URIS = ()
+    DATABASE_REPLICA_CHECK = 10
+    DATABASE_REPLICA_PIN = 10
 
 class DevelopmentConfig(Config):
     """
@@ -12,6 +79,7 @@ class DevelopmentConfig(Config):
     """
 
     SQLALCHEMY_ECHO = True
+    PROFILE_REQUESTS = True
 
 
 class ProductionConfig(Config):
@@ -20,6 +88,19 @@ class ProductionConfig(Config):
     """
 
     DEBUG = False
+    CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'file')
+    CACHE_DIR = os.getenv('CACHE_DIR')
+    CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL')
+    PROFILE_REQUESTS = os.getenv('PROFILE_REQUESTS', '').lower() in ('1', 'true', 'yes', 'on')
+    SQLALCHEMY_POOL_SIZE = int(os.getenv('SQLALCHEMY_POOL_SIZE', 10))
+    SQLALCHEMY_MAX_OVERFLOW = int(os.getenv('SQLALCHEMY_MAX_OVERFLOW', 10))
+    SQLALCHEMY_POOL_TIMEOUT = int(os.getenv('SQLALCHEMY_POOL_TIMEOUT', 10))
+    SQLALCHEMY_POOL_RECYCLE = int(os.getenv('SQLALCHEMY_POOL_RECYCLE', 1800))
+    DATABASE_PRE_PING = int(os.getenv('DATABASE_PRE_PING', 10))
+    DATABASE_STATEMENT_TIMEOUT = int(os.getenv('DATABASE_STATEMENT_TIMEOUT', 0)) or None
+    DATABASE_REPLICA_URIS = os.getenv('DATABASE_REPLICA_URIS', '').split()
+    DATABASE_REPLICA_CHECK = int(os.getenv('DATABASE_REPLICA_CHECK', 10))
+    DATABASE_REPLICA_PIN = int(os.getenv('DATABASE_REPLICA_PIN', 10))
 
 
 class TestingConfig(Config):
@@ -28,6 +109,14 @@ class TestingConfig(Config):
     """
 
     TESTING = True
+    WHOOSH_BASE = ':memory:'
+    PDF_RENDERER = 'stub'
+    PDF_WORKERS = 0
+    DASHBOARD_BACKGROUND = False
+    PROFILE_REQUESTS = True
+    # a cache of this run's own, so no PDF is served from an earlier one
+    PDF_CACHE_DIR = os.path.join(tempfile.gettempdir(),
+                                 'dreamteam_pdf_cache_{}'.format(os.getpid()))
 
 app_config = {
     'development': DevelopmentConfig,
@@ -1,68 +1,54 @@
-import pandas as pd
-from app.models import Product
-from app import db
+"""
+Load a supplier pricebook into the products table
 
-def import_pb():
-	# open the file
-	try:
-		# xlsx = pd.ExcelFile('pricebook.xlsx')
-		pricebook_nan = pd.read_excel('pricebook.xlsx')
-	except:
-		print("didn't open the file, make sure correct name")
-		exit(1)
+    python import_pricebook.py [pricebook.xlsx] [--batch-size N] [--chunk-size N]
+    python import_pricebook.py [pricebook.xlsx] --dry-run [--report changes.csv]
 
-	# convert nans to Nones for mysql
-	pricebook = pricebook_nan.where((pd.notnull(pricebook_nan)), None)
-	length = len(pricebook.index)
-	# length = 1
-	for row in range(0, length):
-		p_id = pricebook['ProductID'][row]	
-		p_number = pricebook['Part Number'][row]	         
-		p_name = pricebook['ProductName'][row]	
-		unit_price = pricebook['UnitPrice'][row]	
-		p_note = pricebook['Product Note to show'][row]	
-		cost_native = pricebook['Cost Native'][row]	
-		exchange_rate = pricebook['Exchange Rate used'][row]	
-		unit_cost = pricebook['Unit Cost'][row]	
-		supplier = pricebook['Supplier'][row]	
-		p_category = pricebook['Product Category'][row]	
-		p_status = pricebook['Product Status'][row]	
-		date_created = pricebook['Date Created'][row]	
-		# person_created = pricebook['Person Created'][row]	
-		remarks = pricebook['Remarks'][row]	
-		# THE RAW JAPANESE NAME FROM THE EXCEL IS ENCODED IN UTF-8
-		japanese_p_name = pricebook['Japanese ProductName'][row]#.decode("utf-8")	
-		japanese_unit_price = pricebook['Japanese UnitPrice'][row]
-		japanese_note = pricebook['Product Note to show - Japanese'][row]	
+New part numbers are added and existing ones updated. Rows that cannot be
+loaded are listed at the end with the reason. A dry run changes nothing and
+lists the new part numbers and the price and status changes instead.
+"""
+import argparse
+import os
 
-		product = Product(p_number=p_number,
-							p_name=p_name,
-							unit_price=unit_price,
-							p_note=p_note,
-							cost_native=cost_native,
-							exchange_rate=exchange_rate,
-							unit_cost=unit_cost,
-							supplier=supplier,
-							p_category=p_category,
-							p_status=p_status,
-							date_created=date_created,
-							remarks=remarks,
-							japanese_p_name=japanese_p_name,
-							japanese_unit_price=japanese_unit_price,
-							japanese_note=japanese_note)
+from app import create_app
+from app.pricebook import diff_pricebook, import_pricebook
 
-		try:
-			db.session.add(product)
-			db.session.commit()
-			print 'added row ' + str(row)
-		except Exception as e:
-			print(e)
-			print 'skipping ' + str(row)
-			db.session.rollback()
-			continue
-	print 'done'
 
+def main():
+    parser = argparse.ArgumentParser(description='Import a pricebook (xlsx, xls or csv)')
+    parser.add_argument('path', nargs='?', default='pricebook.xlsx')
+    parser.add_argument('--batch-size', type=int, help='rows written per transaction')
+    parser.add_argument('--chunk-size', type=int, help='rows read from the file at a time')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='report what would change without writing anything')
+    parser.add_argument('--report', help='with --dry-run, write the changes to this csv file')
+    args = parser.parse_args()
 
-if __name__ == '__main__':
-	import_pb()
+    if not os.path.exists(args.path):
+        parser.error("didn't find {}, make sure the name is correct".format(args.path))
+
+    app = create_app(os.getenv('FLASK_CONFIG'))
+    with app.app_context():
+        if args.dry_run:
+            summary = diff_pricebook(args.path, args.chunk_size)
+        else:
+            summary = import_pricebook(args.path, args.batch_size, args.chunk_size)
+
+    if args.dry_run:
+        if args.report:
+            summary.write_csv(args.report)
+        else:
+            for p_number, change, field, current, new, delta in summary.rows():
+                if change == 'insert':
+                    print('new {}'.format(p_number))
+                else:
+                    print('{} {}: {} -> {}'.format(p_number, field, current, new))
 
+    for row, p_number, reason in summary.rejected:
+        print('rejected row {} ({}): {}'.format(row, p_number, reason))
+    print(summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""quotation subtotal, discount and optional totals
+
+Revision ID: 9b2e61d4c7a3
+Revises: 4ac3c4e05668
+Create Date: 2026-10-18 10:12:41.518230
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b2e61d4c7a3'
+down_revision = '4ac3c4e05668'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the quotations table predates the migrations on existing installs
+    if 'quotations' not in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.add_column('quotations', sa.Column('Quote Subtotal', sa.Float(), nullable=True))
+    op.add_column('quotations', sa.Column('Quote Discount', sa.Float(), nullable=True))
+    op.add_column('quotations', sa.Column('Optional Amount', sa.Float(), nullable=True))
+
+    # fill them in from the details, as app.totals.detail_sums() does,
+    # since line edits only add to the stored totals from now on
+    quotations = sa.table('quotations',
+                          sa.column('QuotationID'),
+                          sa.column('Quote Amount'),
+                          sa.column('Quote Subtotal'),
+                          sa.column('Quote Discount'),
+                          sa.column('Optional Amount'))
+    details = sa.table('quotation_details',
+                       sa.column('QuotationID'),
+                       sa.column('Quantity'),
+                       sa.column('Quote Price'),
+                       sa.column('Discount'),
+                       sa.column('Active (Y/N)'))
+    gross = sa.func.coalesce(details.c['Quantity'], 0) * sa.func.coalesce(details.c['Quote Price'], 0)
+    off = gross * sa.func.coalesce(details.c['Discount'], 0)
+    option = details.c['Active (Y/N)']
+
+    def total(condition, value):
+        return sa.select([sa.func.coalesce(sa.func.sum(sa.case([(condition, value)], else_=0)), 0)]) \
+            .where(details.c['QuotationID'] == quotations.c['QuotationID']).as_scalar()
+
+    subtotal = total(option == sa.false(), gross)
+    discount = total(option == sa.false(), off)
+    optional = total(option == sa.true(), gross - off)
+    # the amount goes first: MySQL evaluates assignments left to right
+    op.execute(quotations.update(preserve_parameter_order=True).values([
+        (quotations.c['Quote Amount'], sa.func.round(subtotal - discount)),
+        (quotations.c['Quote Subtotal'], subtotal),
+        (quotations.c['Quote Discount'], discount),
+        (quotations.c['Optional Amount'], optional)]))
+
+
+def downgrade():
+    if 'quotations' not in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.drop_column('quotations', 'Optional Amount')
+    op.drop_column('quotations', 'Quote Discount')
+    op.drop_column('quotations', 'Quote Subtotal')
@@ -0,0 +1,80 @@
+"""pipeline rollups
+
+Revision ID: c41f7a2d9e10
+Revises: 9b2e61d4c7a3
+Create Date: 2026-10-18 14:02:17.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41f7a2d9e10'
+down_revision = '9b2e61d4c7a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('pipeline_rollups',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('close_year', sa.Integer(), nullable=False),
+    sa.Column('close_month', sa.Integer(), nullable=False),
+    sa.Column('region', sa.String(length=50), nullable=False),
+    sa.Column('family', sa.String(length=50), nullable=False),
+    sa.Column('rev_category', sa.String(length=50), nullable=False),
+    sa.Column('sales_stage', sa.Integer(), nullable=False),
+    sa.Column('opportunities', sa.Integer(), nullable=False),
+    sa.Column('won', sa.Integer(), nullable=False),
+    sa.Column('lost', sa.Integer(), nullable=False),
+    sa.Column('potential', sa.Float(), nullable=False),
+    sa.Column('weighted', sa.Float(), nullable=False),
+    sa.Column('probable', sa.Float(), nullable=False),
+    sa.Column('actual', sa.Float(), nullable=False),
+    sa.Column('revenue', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('close_year', 'close_month', 'region', 'family', 'rev_category', 'sales_stage')
+    )
+
+    # fill it in from the opportunities, as app.pipeline.rebuild() does
+    if 'opportunities' not in sa.inspect(op.get_bind()).get_table_names():
+        return
+    opportunities = sa.table('opportunities',
+                             sa.column('Close Date'),
+                             sa.column('Region'),
+                             sa.column('Family'),
+                             sa.column('Revenue Category'),
+                             sa.column('Sales Stage'),
+                             sa.column('Probability'),
+                             sa.column('Potential $'),
+                             sa.column('Probable $'),
+                             sa.column('Actual $'),
+                             sa.column('Revenue $'))
+    o = opportunities.c
+    potential = sa.func.coalesce(o['Potential $'], 0)
+    won = sa.func.coalesce(o['Actual $'], 0) > 0
+    lost = sa.and_(~won, o['Probability'] == 0)
+    fraction = sa.case([(o['Probability'] > 1, o['Probability'] / 100.0)],
+                       else_=sa.func.coalesce(o['Probability'], 0))
+    keys = [sa.func.coalesce(sa.extract('year', o['Close Date']), 0),
+            sa.func.coalesce(sa.extract('month', o['Close Date']), 0),
+            sa.func.coalesce(o['Region'], u''),
+            sa.func.coalesce(o['Family'], u''),
+            sa.func.coalesce(o['Revenue Category'], u''),
+            sa.func.coalesce(o['Sales Stage'], -1)]
+    measures = [sa.func.count(),
+                sa.func.sum(sa.case([(won, 1)], else_=0)),
+                sa.func.sum(sa.case([(lost, 1)], else_=0)),
+                sa.func.sum(potential),
+                sa.func.sum(sa.case([(sa.or_(won, lost), 0)], else_=potential * fraction)),
+                sa.func.sum(sa.func.coalesce(o['Probable $'], 0)),
+                sa.func.sum(sa.func.coalesce(o['Actual $'], 0)),
+                sa.func.sum(sa.func.coalesce(o['Revenue $'], 0))]
+    names = ['close_year', 'close_month', 'region', 'family', 'rev_category', 'sales_stage',
+             'opportunities', 'won', 'lost', 'potential', 'weighted', 'probable', 'actual', 'revenue']
+    rollups = sa.table('pipeline_rollups', *[sa.column(name) for name in names])
+    op.execute(rollups.insert().from_select(names, sa.select(keys + measures).group_by(*keys)))
+
+def downgrade():
+    op.drop_table('pipeline_rollups')
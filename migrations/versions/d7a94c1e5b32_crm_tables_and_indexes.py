@@ -0,0 +1,190 @@
+"""crm tables and their lookup indexes
+
+Revision ID: d7a94c1e5b32
+Revises: c41f7a2d9e10
+Create Date: 2026-10-18 16:40:09.381204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7a94c1e5b32'
+down_revision = 'c41f7a2d9e10'
+branch_labels = None
+depends_on = None
+
+
+# (table, index name, columns), matching the __table_args__ of app.models
+INDEXES = [
+    ('customers', 'ix_customers_company_name', ['CompanyName', 'CustomerID']),
+    ('contacts', 'ix_contacts_customer', ['CustomerID']),
+    ('contacts', 'ix_contacts_account_code', ['Account Code', 'ContactID']),
+    ('quotations', 'ix_quotations_customer', ['CustomerID', 'Quotation Number']),
+    ('quotations', 'ix_quotations_account_code', ['Account Code', 'QuotationID']),
+    ('products', 'ix_products_supplier', ['Supplier']),
+    ('opportunities', 'ix_opportunities_quotation', ['QuotationID']),
+    ('opportunities', 'ix_opportunities_quotation_number', ['Quotation Number', 'OpportunityID']),
+    ('opportunities', 'ix_opportunities_close_date', ['Close Date']),
+    ('quotation_details', 'ix_quotation_details_quotation', ['QuotationID', 'QuotationDetailID']),
+    ('quotation_details', 'ix_quotation_details_product', ['ProductID']),
+    ('quotation_details', 'ix_quotation_details_quotation_number', ['Quotation Number', 'QuotationDetailID']),
+    ('quotation_details', 'ix_quotation_details_product_number', ['Product Number', 'QuotationDetailID']),
+]
+
+
+def _address_columns():
+    return [
+        sa.Column('ContactFirstName', sa.String(length=20), nullable=True),
+        sa.Column('ContactLastName', sa.String(length=20), nullable=True),
+        sa.Column('BillingAddress', sa.String(length=40), nullable=True),
+        sa.Column('City', sa.String(length=20), nullable=True),
+        sa.Column('StateOrProvince', sa.String(length=20), nullable=True),
+        sa.Column('PostalCode', sa.String(length=10), nullable=True),
+        sa.Column('Country/Region', sa.String(length=20), nullable=True),
+        sa.Column('ContactTitle', sa.String(length=30), nullable=True),
+        sa.Column('PhoneNumber', sa.String(length=20), nullable=True),
+        sa.Column('FaxNumber', sa.String(length=20), nullable=True),
+        sa.Column('EmailAddress', sa.String(length=20), nullable=True),
+        sa.Column('Notes', sa.String(length=100), nullable=True),
+    ]
+
+
+def _create_tables(existing):
+    # Installs made with db.create_all() already have these; fresh ones
+    # get them here, as the models define them today
+    if 'customers' not in existing:
+        op.create_table('customers',
+        sa.Column('CustomerID', sa.Integer(), nullable=False),
+        sa.Column('Account Code', sa.String(length=20), nullable=False),
+        sa.Column('CompanyName', sa.String(length=20), nullable=True),
+        *(_address_columns() + [
+        sa.Column('Order', sa.String(length=50), nullable=True),
+        sa.Column('State', sa.String(length=50), nullable=True),
+        sa.Column('Status', sa.String(length=50), nullable=True),
+        sa.Column('Rating', sa.String(length=50), nullable=True),
+        sa.PrimaryKeyConstraint('CustomerID'),
+        sa.UniqueConstraint('Account Code')
+        ]))
+    if 'contacts' not in existing:
+        op.create_table('contacts',
+        sa.Column('ContactID', sa.Integer(), nullable=False),
+        sa.Column('CustomerID', sa.Integer(), nullable=False),
+        sa.Column('Account Code', sa.String(length=20), nullable=False),
+        *(_address_columns() + [
+        sa.ForeignKeyConstraint(['CustomerID'], ['customers.CustomerID'], ),
+        sa.PrimaryKeyConstraint('ContactID')
+        ]))
+    if 'products' not in existing:
+        op.create_table('products',
+        sa.Column('ProductID', sa.Integer(), nullable=False),
+        sa.Column('Part Number', sa.String(length=50), nullable=False),
+        sa.Column('ProductName', sa.String(length=50), nullable=True),
+        sa.Column('UnitPrice', sa.Float(), nullable=True),
+        sa.Column('Product Note to show', sa.String(length=200), nullable=True),
+        sa.Column('Cost Native', sa.Float(), nullable=True),
+        sa.Column('Exchange Rate used', sa.Float(), nullable=True),
+        sa.Column('Unit Cost', sa.Float(), nullable=True),
+        sa.Column('Supplier', sa.String(length=50), nullable=True),
+        sa.Column('Product Category', sa.String(length=50), nullable=True),
+        sa.Column('Product Status', sa.String(length=50), nullable=True),
+        sa.Column('Date Created', sa.Date(), nullable=True),
+        sa.Column('Person Created', sa.String(length=50), nullable=True),
+        sa.Column('Remarks', sa.String(length=50), nullable=True),
+        sa.Column('Japanese ProductName', sa.Unicode(length=200, collation='utf8_bin'), nullable=True),
+        sa.Column('Japanese UnitPrice', sa.Float(), nullable=True),
+        sa.Column('Japanese Note to show', sa.Unicode(length=200, collation='utf8_bin'), nullable=True),
+        sa.PrimaryKeyConstraint('ProductID'),
+        sa.UniqueConstraint('Part Number')
+        )
+    if 'quotations' not in existing:
+        op.create_table('quotations',
+        sa.Column('QuotationID', sa.Integer(), nullable=False),
+        sa.Column('CustomerID', sa.Integer(), nullable=False),
+        sa.Column('EmployeeID', sa.String(length=20), nullable=True),
+        sa.Column('Quotaton Date', sa.Date(), nullable=True),
+        sa.Column('Account Code', sa.String(length=20), nullable=False),
+        sa.Column('Contact', sa.Integer(), nullable=True),
+        sa.Column('Quotation Number', sa.Integer(), nullable=False),
+        sa.Column('Revision', sa.String(length=50), nullable=True),
+        sa.Column('Payment Terms', sa.String(length=50), nullable=True),
+        sa.Column('Title', sa.String(length=50), nullable=True),
+        sa.Column('FirstName', sa.String(length=50), nullable=True),
+        sa.Column('LastName', sa.String(length=50), nullable=True),
+        sa.Column('Address', sa.String(length=50), nullable=True),
+        sa.Column('City', sa.String(length=50), nullable=True),
+        sa.Column('State', sa.String(length=50), nullable=True),
+        sa.Column('Country', sa.String(length=50), nullable=True),
+        sa.Column('Zip', sa.String(length=50), nullable=True),
+        sa.Column('TEL', sa.String(length=50), nullable=True),
+        sa.Column('Ship Schedule', sa.String(length=50), nullable=True),
+        sa.Column('Shipment Term', sa.String(length=50), nullable=True),
+        sa.Column('Quotation title', sa.String(length=50), nullable=True),
+        sa.Column('Quotation Note', sa.String(length=50), nullable=True),
+        sa.Column('Quote Amount', sa.Integer(), nullable=True),
+        sa.Column('Quote Subtotal', sa.Float(), nullable=True),
+        sa.Column('Quote Discount', sa.Float(), nullable=True),
+        sa.Column('Optional Amount', sa.Float(), nullable=True),
+        sa.ForeignKeyConstraint(['CustomerID'], ['customers.CustomerID'], ),
+        sa.PrimaryKeyConstraint('QuotationID'),
+        sa.UniqueConstraint('Quotation Number')
+        )
+    if 'opportunities' not in existing:
+        op.create_table('opportunities',
+        sa.Column('OpportunityID', sa.Integer(), nullable=False),
+        sa.Column('QuotationID', sa.Integer(), nullable=False),
+        sa.Column('Quotation Number', sa.Integer(), nullable=False),
+        sa.Column('Source of Lead', sa.String(length=50), nullable=True),
+        sa.Column('Sales referal Fee', sa.Float(), nullable=True),
+        sa.Column('Competitors', sa.Integer(), nullable=True),
+        sa.Column('Sales Stage', sa.Integer(), nullable=True),
+        sa.Column('Close Date', sa.Date(), nullable=True),
+        sa.Column('Probability', sa.Float(), nullable=True),
+        sa.Column('Revenue Category', sa.String(length=50), nullable=True),
+        sa.Column('Project Note', sa.String(length=100), nullable=True),
+        sa.Column('Application', sa.String(length=50), nullable=True),
+        sa.Column('Family', sa.String(length=50), nullable=True),
+        sa.Column('Potential $', sa.Float(), nullable=True),
+        sa.Column('Probable $', sa.Float(), nullable=True),
+        sa.Column('Actual $', sa.Float(), nullable=True),
+        sa.Column('Revenue $', sa.Float(), nullable=True),
+        sa.Column('Integrator', sa.String(length=50), nullable=True),
+        sa.Column('Region', sa.String(length=50), nullable=True),
+        sa.ForeignKeyConstraint(['QuotationID'], ['quotations.QuotationID'], ),
+        sa.PrimaryKeyConstraint('OpportunityID')
+        )
+    if 'quotation_details' not in existing:
+        op.create_table('quotation_details',
+        sa.Column('QuotationDetailID', sa.Integer(), nullable=False),
+        sa.Column('QuotationID', sa.Integer(), nullable=False),
+        sa.Column('ProductID', sa.Integer(), nullable=False),
+        sa.Column('Quotation Number', sa.Integer(), nullable=False),
+        sa.Column('Product Number', sa.String(length=50), nullable=False),
+        sa.Column('Product Name', sa.String(length=50), nullable=True),
+        sa.Column('Quantity', sa.Float(), nullable=True),
+        sa.Column('Discount', sa.Float(), nullable=True),
+        sa.Column('Quote Price', sa.Float(), nullable=True),
+        sa.Column('Active (Y/N)', sa.Boolean(), nullable=True),
+        sa.ForeignKeyConstraint(['ProductID'], ['products.ProductID'], ),
+        sa.ForeignKeyConstraint(['QuotationID'], ['quotations.QuotationID'], ),
+        sa.PrimaryKeyConstraint('QuotationDetailID')
+        )
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    existing = inspector.get_table_names()
+    _create_tables(existing)
+    for table, name, columns in INDEXES:
+        # skip the ones already there, e.g. made by a later db.create_all()
+        if table in existing and name in [index['name'] for index in inspector.get_indexes(table)]:
+            continue
+        op.create_index(name, table, columns, unique=False)
+
+
+def downgrade():
+    # The tables themselves are left alone, as they predate this revision
+    # on most installs
+    for table, name, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
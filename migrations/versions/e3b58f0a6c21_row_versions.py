@@ -0,0 +1,31 @@
+"""row versions for optimistic concurrency control
+
+Revision ID: e3b58f0a6c21
+Revises: d7a94c1e5b32
+Create Date: 2026-10-18 19:21:44.870352
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3b58f0a6c21'
+down_revision = 'd7a94c1e5b32'
+branch_labels = None
+depends_on = None
+
+
+VERSIONED = ('customers', 'quotations', 'opportunities', 'quotation_details')
+
+
+def upgrade():
+    # existing rows all start at version 1
+    for table in VERSIONED:
+        op.add_column(table, sa.Column('Version', sa.Integer(), nullable=False,
+                                       server_default='1'))
+
+
+def downgrade():
+    for table in VERSIONED:
+        op.drop_column(table, 'Version')
@@ -1,11 +1,39 @@
+# -*- coding: utf-8 -*-
+import datetime
+import io
 import os
+import sys
+import tempfile
+import time
 import unittest
 
-from flask import abort, url_for
+from flask import Flask, abort, url_for
 from flask_testing import TestCase
 
-from app import create_app, db
-from app.models import Department, Employee, Role
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import IntegrityError, TimeoutError
+from sqlalchemy.orm.exc import StaleDataError
+
+from app import (choice_cache, create_app, dashboard_snapshot, db, pdf_queue, price_cache,
+                 principal_cache, query_profiler, search_index, shared_cache)
+from app.cache import FileBackend, LRUCache, RedisBackend, SharedCache, make_backend
+from app.cloning import clone_quotation, clone_quotations
+from app.concurrency import EditConflict, check_version, retry_on_conflict
+from app.database import MeteredQueuePool, PoolStats, ReplicaSet, read_only
+from app.deletion import delete_customers, delete_products, delete_quotations
+from app.documents import document_fingerprint, load_quotation_document
+from app.export import csv_chunks, export_response, export_rows, xlsx_chunks
+from app.lines import LineErrors, add_lines, parse_lines
+from app.listing import ListEngine
+from app.lookups import lookup
+from app.pipeline import forecast, rebuild, rollup_frame, weighted_pipeline, win_rates
+from app.pricebook import diff_pricebook, import_pricebook
+from app.profiling import statement_shape
+from app.queryplan import check_indexes, full_scans
+from app.seed import seed
+from app.models import (Contact, Customer, Department, Employee, Opportunity, PipelineRollup,
+                        Product, Quotation, Quotation_Detail, Role)
+from app.totals import apply_line_change, drifted, line_snapshot, line_totals, reconcile
 
 
 class TestBase(TestCase):
@@ -46,6 +74,20 @@ class TestBase(TestCase):
         db.session.remove()
         db.drop_all()
 
+    def record_statements(self):
+        """
+        A list collecting the SQL of every statement run from now until
+        the end of the test
+        """
+        statements = []
+
+        def record(*args):
+            statements.append(args[2])
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute', record)
+        return statements
+
 
 class TestModels(TestBase):
 
@@ -166,6 +208,1375 @@ class TestViews(TestBase):
         self.assertEqual(response.status_code, 302)
         self.assertRedirects(response, redirect_url)
 
+    def test_change_language_view(self):
+        """
+        Test that the language can be changed without login
+        """
+        response = self.client.get(url_for('admin.change_language'))
+        self.assertRedirects(response, url_for('home.homepage'))
+
+
+class TestChoiceCache(TestBase):
+
+    def setUp(self):
+        super(TestChoiceCache, self).setUp()
+        db.session.add(Customer(acc_code="B200"))
+        db.session.add(Customer(acc_code="A100"))
+        db.session.add(Contact(c_id=1, acc_code="B200", f_name="Taro", l_name="Yamada"))
+        db.session.commit()
+
+    def test_choices_are_cached_until_a_change(self):
+        """
+        Test that choice lists are built once and rebuilt after changes
+        to their rows
+        """
+        statements = self.record_statements()
+        self.assertEqual(choice_cache.choices('customers'), [(2, "A100"), (1, "B200")])
+        self.assertEqual(choice_cache.label('customers', 1), "B200")
+        self.assertEqual(len(statements), 1)
+
+        Customer.query.get(1).notes = "Not part of the label"
+        db.session.commit()
+        del statements[:]
+        choice_cache.choices('customers')
+        self.assertEqual(statements, [])
+
+        Customer.query.get(1).acc_code = "C300"
+        db.session.add(Customer(acc_code="D400"))
+        db.session.commit()
+        self.assertEqual([label for value, label in choice_cache.choices('customers')],
+                         ["A100", "C300", "D400"])
+
+    def test_search(self):
+        """
+        Test that choices match on the start of the label or of a word
+        """
+        self.assertEqual(choice_cache.search('customers', 'a1', 10), [(2, "A100")])
+        self.assertEqual(choice_cache.search('contacts', 'yam', 10), [(1, "Taro Yamada")])
+        self.assertEqual(choice_cache.search('customers', '', 1), [(2, "A100")])
+        self.assertEqual(choice_cache.label('customers', 99), None)
+
+
+class TestLookup(TestBase):
+
+    def setUp(self):
+        super(TestLookup, self).setUp()
+        db.session.add(Customer(acc_code="AC1", city="Tokyo", f_name="Hanako"))
+        db.session.add(Customer(acc_code="AC2", city="Osaka"))
+        db.session.add(Contact(c_id=1, acc_code="AC1", f_name="Taro", l_name="Yamada"))
+        db.session.add(Contact(c_id=2, acc_code="AC2", f_name="Jiro", city="Kyoto"))
+        db.session.add(Product(p_number="P1", p_name="Product one", unit_price=12.5))
+        db.session.commit()
+
+    def test_lookup_resolves_all_keys_together(self):
+        """
+        Test that customers, contacts and products come back from one
+        query per table, with contacts falling back to their customer
+        """
+        statements = self.record_statements()
+        result = lookup(["AC1", "AC9"], [2], ["P1", "P9"])
+        self.assertEqual(len(statements), 4)
+
+        self.assertEqual(list(result['customers']), ["AC1"])
+        self.assertEqual(result['customers']["AC1"]['contacts'], [(1, "Taro Yamada")])
+        self.assertEqual(result['contacts']["1"]['city'], "Tokyo")
+        self.assertEqual(result['contacts']["2"]['city'], "Kyoto")
+        self.assertEqual(result['contacts']["2"]['f_name'], "Jiro")
+        self.assertEqual(result['products'], {"P1": {'price': 12.5, 'name': "Product one"}})
+
+
+class TestExport(TestBase):
+
+    def setUp(self):
+        super(TestExport, self).setUp()
+        db.session.add(Customer(acc_code="AC2", comp_name=u"株式会社"))
+        db.session.add(Customer(acc_code="AC1", comp_name="Acme, Inc."))
+        db.session.commit()
+
+    def test_csv_export(self):
+        """
+        Test that every column and row is exported in primary key order,
+        in as many chunks as it takes
+        """
+        with self.app.test_request_context():
+            response = export_response(Customer.query, Customer, 'customers', 'csv')
+            data = b''.join(response.response)
+        self.assertEqual(response.headers['Content-Disposition'], 'attachment; filename=customers.csv')
+        self.assertNotIn('Content-Length', response.headers)
+        lines = data.decode('utf-8-sig').splitlines()
+        self.assertEqual(lines[0].split(',')[:2], ['CustomerID', 'Account Code'])
+        self.assertTrue(lines[1].startswith(u'1,AC2,'))
+        self.assertIn(u'株式会社', lines[1])
+        self.assertIn(u'"Acme, Inc."', lines[2])
+
+        with self.app.test_request_context():
+            chunks = list(csv_chunks(['n'], ([i] for i in range(20000))))
+        self.assertGreater(len(chunks), 1)
+
+    def test_xlsx_export(self):
+        """
+        Test that the workbook has a header row and a row per customer
+        """
+        from openpyxl import load_workbook
+        with self.app.test_request_context():
+            data = b''.join(xlsx_chunks(['CustomerID', 'Account Code'],
+                                        export_rows(Customer.query, Customer)))
+        sheet = load_workbook(io.BytesIO(data)).active
+        rows = list(sheet.iter_rows(values_only=True))
+        self.assertEqual(rows[0][:2], ('CustomerID', 'Account Code'))
+        self.assertEqual([row[1] for row in rows[1:]], ['AC2', 'AC1'])
+
+    def test_export_requires_login(self):
+        """
+        Test that exports redirect to the login page when not logged in
+        """
+        target_url = url_for('admin.export_list', source='customers', fmt='csv')
+        redirect_url = url_for('auth.login', next=target_url)
+        response = self.client.get(target_url)
+        self.assertRedirects(response, redirect_url)
+
+
+class TestPriceCache(TestBase):
+
+    def test_lru_cache_evicts_and_expires(self):
+        """
+        Test that the least recently used entry is evicted and that
+        entries expire after their ttl
+        """
+        now = [0]
+        cache = LRUCache(maxsize=2, ttl=10, clock=lambda: now[0])
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+        now[0] = 10
+        self.assertEqual(cache.get('a'), None)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions'], stats['expired']),
+                         (3, 2, 1, 1))
+
+    def test_prices_are_cached_until_the_product_changes(self):
+        """
+        Test that a product is read once and dropped from the cache when
+        it is updated, renamed or deleted
+        """
+        db.session.add(Product(p_number="P1", p_name="Product one", unit_price=10))
+        db.session.commit()
+        statements = self.record_statements()
+        self.assertEqual(price_cache.by_number("P1")['unit_price'], 10)
+        self.assertEqual(price_cache.by_id(1)['p_name'], "Product one")
+        self.assertEqual(len(statements), 1)
+
+        product = Product.query.get(1)
+        product.unit_price = 12
+        db.session.commit()
+        self.assertEqual(price_cache.by_id(1)['unit_price'], 12)
+
+        product.p_number = "P2"
+        db.session.commit()
+        self.assertEqual(price_cache.by_number("P1"), None)
+        self.assertEqual(price_cache.by_number("P2")['unit_price'], 12)
+
+        db.session.delete(product)
+        db.session.commit()
+        self.assertEqual(price_cache.by_id(1), None)
+
+
+class FakeRedis(object):
+    """
+    The part of the redis client RedisBackend uses, ignoring expiry
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+    def incr(self, key):
+        self.values[key] = str(int(self.values.get(key) or 0) + 1)
+        return int(self.values[key])
+
+
+class TestSharedCache(TestBase):
+
+    def workers(self, backend):
+        """
+        Two apps standing in for two workers sharing one backend
+        """
+        apps = []
+        for i in range(2):
+            app = Flask(__name__)
+            SharedCache().init_app(app, backend)
+            apps.append(app)
+        return apps
+
+    def check_shared(self, backend):
+        first, second = self.workers(backend)
+        cache = SharedCache()
+        with first.app_context():
+            cache.set('prices', 'number:P1', {'unit_price': 10})
+        with second.app_context():
+            self.assertEqual(cache.get('prices', 'number:P1'), {'unit_price': 10})
+            cache.bump('prices')
+        with first.app_context():
+            self.assertEqual(cache.get('prices', 'number:P1'), None)
+            cache.set('prices', 'number:P1', {'unit_price': 12})
+            cache.delete('prices', 'number:P1')
+            self.assertEqual(cache.get('prices', 'number:P1'), None)
+            self.assertEqual(cache.stats('prices'), {'hits': 0, 'misses': 2, 'hit_rate': 0.0})
+
+    def test_file_backend_is_shared(self):
+        """
+        Test that entries and invalidations are seen by every worker
+        using the same cache directory
+        """
+        self.check_shared(FileBackend(tempfile.mkdtemp()))
+
+    def test_file_backend_sweep(self):
+        """
+        Test that a sweep removes expired entries but keeps live entries
+        and counters
+        """
+        backend = FileBackend(tempfile.mkdtemp(), sweep_every=0)
+        backend.set('old', 1, ttl=-1)
+        backend.set('new', 2)
+        backend.incr('version')
+        self.assertEqual(backend.sweep(), 1)
+        self.assertEqual(len([name for name in os.listdir(backend.directory)
+                              if not name.endswith('.lock')]), 2)
+        self.assertEqual((backend.get('new'), backend.counter('version')), (2, 1))
+
+    def test_redis_backend_is_shared(self):
+        """
+        Test that entries and invalidations are seen by every worker
+        using the same Redis
+        """
+        self.check_shared(RedisBackend(client=FakeRedis()))
+
+    def test_redis_backend_needs_redis(self):
+        """
+        Test that choosing Redis without the redis package installed fails
+        when the app is set up, with a configuration error
+        """
+        saved = sys.modules.pop('redis', None)
+        # makes `import redis` fail whether or not it is installed
+        sys.modules['redis'] = None
+        try:
+            self.assertRaises(ValueError, make_backend, {'CACHE_BACKEND': 'redis'},
+                              self.app.instance_path)
+        finally:
+            del sys.modules['redis']
+            if saved is not None:
+                sys.modules['redis'] = saved
+
+    def test_choice_lists_follow_the_shared_version(self):
+        """
+        Test that a choice list is rebuilt once another worker invalidates it
+        """
+        db.session.add(Customer(acc_code="AC1"))
+        db.session.commit()
+        self.assertEqual(choice_cache.choices('customers'), [(1, "AC1")])
+        # Written behind the cache's back, as another worker would
+        db.session.execute(Customer.__table__.insert().values({Customer.acc_code: "AC2"}))
+        self.assertEqual(choice_cache.choices('customers'), [(1, "AC1")])
+        shared_cache.bump('choices.customers')
+        self.assertEqual(choice_cache.choices('customers'), [(1, "AC1"), (2, "AC2")])
+
+
+class TestPrincipalCache(TestBase):
+
+    def test_principal_is_loaded_once_until_the_employee_changes(self):
+        """
+        Test that the logged in employee is read with their department
+        and role in one query, then from the cache until reassigned
+        """
+        department = Department(name="Sales", description="Sales")
+        role = Role(name="Manager", description="Manager")
+        employee = Employee(email="sales@test.com", username="sales", password="sales2016",
+                            department=department)
+        db.session.add_all([department, role, employee])
+        db.session.commit()
+        employee_id = employee.id
+        statements = self.record_statements()
+        principal = principal_cache.load(employee_id)
+        self.assertEqual(principal_cache.load(employee_id), principal)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual((principal.username, principal.is_admin, principal.department, principal.role),
+                         ("sales", False, "Sales", None))
+
+        employee.role = role
+        db.session.commit()
+        self.assertEqual(principal_cache.load(employee.id).role, "Manager")
+
+        role.name = "Director"
+        db.session.commit()
+        self.assertEqual(principal_cache.load(employee.id).role, "Director")
+
+        db.session.delete(employee)
+        db.session.commit()
+        self.assertEqual(principal_cache.load(employee_id), None)
+
+
+class TestListEngine(TestBase):
+
+    def setUp(self):
+        super(TestListEngine, self).setUp()
+        for i in range(5):
+            db.session.add(Customer(acc_code="AC{}".format(4 - i)))
+        db.session.commit()
+        self.engine = ListEngine(Customer, ('c_id', 'acc_code'),
+                                 sortable=('acc_code',), per_page=2)
+
+    def test_keyset_pages(self):
+        """
+        Test that following the next cursor walks every row exactly once
+        """
+        seen = []
+        page = self.engine.page(Customer.query)
+        seen.extend(row.acc_code for row in page)
+        while page.has_next:
+            page = self.engine.page(Customer.query, page.next_num,
+                                    after=page.next_cursor)
+            seen.extend(row.acc_code for row in page)
+
+        self.assertEqual(seen, ["AC4", "AC3", "AC2", "AC1", "AC0"])
+        self.assertEqual(page.page, 3)
+
+    def test_sorted_previous_page(self):
+        """
+        Test that the previous cursor returns the rows before the page
+        """
+        first = self.engine.page(Customer.query, sort='acc_code')
+        second = self.engine.page(Customer.query, 2, after=first.next_cursor,
+                                  sort='acc_code')
+        back = self.engine.page(Customer.query, 1, before=second.prev_cursor,
+                                sort='acc_code')
+
+        self.assertEqual([row.acc_code for row in second], ["AC2", "AC3"])
+        self.assertEqual([row.acc_code for row in back], ["AC0", "AC1"])
+        self.assertFalse(back.has_prev)
+
+    def test_nullable_sort_column(self):
+        """
+        Test that rows with a NULL sort value are walked once, both ways
+        """
+        for c_id, name in ((1, "Bolt"), (3, "Acme"), (4, "Crane")):
+            Customer.query.get(c_id).comp_name = name
+        db.session.commit()
+        engine = ListEngine(Customer, ('c_id', 'comp_name'), sortable=('comp_name',), per_page=2)
+
+        pages = [engine.page(Customer.query, sort='comp_name')]
+        while pages[-1].has_next:
+            pages.append(engine.page(Customer.query, len(pages) + 1,
+                                     after=pages[-1].next_cursor, sort='comp_name'))
+        self.assertEqual([[row.c_id for row in page] for page in pages], [[2, 5], [3, 1], [4]])
+
+        back = engine.page(Customer.query, 2, before=pages[2].prev_cursor, sort='comp_name')
+        self.assertEqual([row.c_id for row in back], [3, 1])
+        back = engine.page(Customer.query, 1, before=back.prev_cursor, sort='comp_name')
+        self.assertEqual([row.c_id for row in back], [2, 5])
+        self.assertFalse(back.has_prev)
+
+    def test_ranked_pages(self):
+        """
+        Test that search matches are paged in their ranked order, skipping
+        keys whose rows are gone
+        """
+        ids = [5, 99, 3, 1, 4]
+        pages = [self.engine.ranked(Customer.query, ids, page_num) for page_num in (1, 2, 3)]
+        self.assertEqual([[row.c_id for row in page] for page in pages], [[5], [3, 1], [4]])
+        self.assertEqual([(page.has_prev, page.has_next) for page in pages],
+                         [(False, True), (True, True), (True, False)])
+
+
+class TestSearch(TestBase):
+
+    def setUp(self):
+        super(TestSearch, self).setUp()
+        db.session.add(Product(p_number="EX002-ABC", p_name="Laser head",
+                               japanese_p_name=u"レーザーヘッド"))
+        db.session.add(Product(p_number="EX003", p_name="Laser body"))
+        db.session.commit()
+
+    def test_search_follows_commits(self):
+        """
+        Test that inserts, updates and deletes reach the index
+        """
+        self.assertEqual(sorted(search_index.search(Product, "ex00")), [1, 2])
+
+        Product.query.get(2).p_name = "Mirror"
+        Product.query.get(1).p_name = "Rolled back"
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(sorted(search_index.search(Product, "laser")), [1, 2])
+
+        Product.query.get(2).p_name = "Mirror"
+        db.session.delete(Product.query.get(1))
+        db.session.commit()
+        self.assertEqual(search_index.search(Product, "laser"), [])
+        self.assertEqual(search_index.search(Product, "mirror"), [2])
+
+    def test_codes_match_anywhere(self):
+        """
+        Test that part numbers match on any part, names only by prefix
+        """
+        self.assertEqual(search_index.search(Product, "002"), [1])
+        self.assertEqual(sorted(search_index.search(Product, "x00")), [1, 2])
+        self.assertEqual(search_index.search(Product, "aser"), [])
+
+    def test_search_limit(self):
+        """
+        Test that a limit of 0 returns every match
+        """
+        self.app.config['SEARCH_LIMIT'] = 1
+        self.assertEqual(len(search_index.search(Product, "laser")), 1)
+        self.assertEqual(len(search_index.search(Product, "laser", limit=0)), 2)
+
+    def test_japanese_search(self):
+        """
+        Test that Japanese names match on any part of the name
+        """
+        self.assertEqual(search_index.search(Product, u"ヘッド"), [1])
+        self.assertEqual(search_index.search(Product, u"ザ"), [1])
+        self.assertEqual(search_index.search(Product, u"ボディ"), [])
+
+
+class TestPipeline(TestBase):
+
+    def setUp(self):
+        super(TestPipeline, self).setUp()
+        db.session.add(Customer(acc_code="AC1"))
+        db.session.add(Quotation(c_id=1, acc_code="AC1", q_num=1))
+        db.session.commit()
+
+    def add(self, **values):
+        opportunity = Opportunity(q_id=1, q_num=1, **values)
+        db.session.add(opportunity)
+        db.session.commit()
+        return opportunity
+
+    def rollups(self):
+        return sorted(tuple(row) for row in rollup_frame().itertuples(index=False))
+
+    def test_rollups_follow_opportunity_changes(self):
+        """
+        Test that adding, editing and deleting opportunities keeps the
+        rollups equal to ones rebuilt from scratch
+        """
+        first = self.add(close_date=datetime.date(2018, 4, 2), region="Asia", sales_stage=2,
+                         probability=50, potential_money=1000)
+        self.add(close_date=datetime.date(2018, 4, 20), region="Asia", sales_stage=2,
+                 probability=0.25, potential_money=400)
+        won = self.add(close_date=datetime.date(2018, 5, 1), region="Europe", sales_stage=5,
+                       probability=1, potential_money=300, actual_money=250)
+        self.add(region="Europe", probability=0, potential_money=100)
+
+        first.region = "Europe"
+        first.close_date = datetime.date(2018, 5, 3)
+        db.session.commit()
+        db.session.delete(won)
+        db.session.commit()
+
+        incremental = self.rollups()
+        self.assertEqual(rebuild(), len(incremental))
+        self.assertEqual(self.rollups(), incremental)
+        self.assertEqual(PipelineRollup.query.filter_by(sales_stage=5).count(), 0)
+
+    def test_pipeline_reports(self):
+        """
+        Test the weighted pipeline, forecast and win rates
+        """
+        self.add(close_date=datetime.date(2018, 4, 2), region="Asia", sales_stage=2,
+                 probability=50, potential_money=1000)
+        self.add(close_date=datetime.date(2018, 5, 1), region="Asia", sales_stage=5,
+                 probability=1, potential_money=300, actual_money=250)
+        self.add(region="Europe", sales_stage=2, probability=0, potential_money=100)
+        frame = rollup_frame()
+
+        pipeline = weighted_pipeline(frame).set_index('sales_stage')
+        self.assertEqual(pipeline.loc[2].tolist(), [2, 1100, 500])
+        months = forecast(frame)
+        self.assertEqual(months[['close_month', 'expected']].values.tolist(), [[4, 500], [5, 250]])
+        rates = win_rates(frame).set_index('region').win_rate
+        self.assertEqual((rates['Asia'], rates['Europe']), (1.0, 0.0))
+
+        response = self.client.get(url_for('admin.opportunity_pipeline', group='region'))
+        self.assertRedirects(response, url_for('auth.login', next=url_for('admin.opportunity_pipeline', group='region')))
+
+
+class TestQuotationLines(TestBase):
+
+    def setUp(self):
+        super(TestQuotationLines, self).setUp()
+        db.session.add(Customer(acc_code="AC1"))
+        db.session.add(Product(p_number="P1", p_name="Product one", unit_price=10))
+        db.session.add(Product(p_number="P2", p_name="Product two", unit_price=5))
+        db.session.add(Quotation(c_id=1, acc_code="AC1", q_num=1))
+        db.session.commit()
+
+    def test_parse_pasted_and_csv_lines(self):
+        """
+        Test that tab separated and CSV lines parse alike, skipping a header
+        and blank lines
+        """
+        pasted = parse_lines(u"Part\tQty\tDiscount\tPrice\tOptional\nP1\t3\t10%\t\tN\n\nP2\t2\n")
+        uploaded = parse_lines(b"\xef\xbb\xbfP1,3,10%,,N\nP2,2\n")
+        self.assertEqual([row for number, row in pasted], [row for number, row in uploaded])
+        self.assertEqual([number for number, row in pasted], [2, 4])
+        self.assertEqual(pasted[0][1], {'p_number': u"P1", 'quantity': u"3", 'discount': u"10%",
+                                        'q_price': u"", 'option': u"N"})
+
+    def test_lines_are_added_in_bulk(self):
+        """
+        Test that lines are inserted together and added to the totals once
+        """
+        statements = self.record_statements()
+        rows = [{'p_number': "P1", 'quantity': 3, 'discount': "10%"},
+                {'p_number': "P2", 'quantity': 2, 'q_price': 4, 'option': "Y"}] * 50
+        self.assertEqual(add_lines(1, rows), 100)
+        updates = [statement for statement in statements if statement.startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+
+        quotation = Quotation.query.get(1)
+        self.assertEqual((quotation.q_amount, quotation.q_optional), (1350, 400))
+        line = Quotation_Detail.query.first()
+        self.assertEqual((line.p_id, line.p_name, line.q_price, line.option),
+                         (1, "Product one", 10, False))
+
+    def test_invalid_lines_add_nothing(self):
+        """
+        Test that every problem is reported and no line is added
+        """
+        with self.assertRaises(LineErrors) as raised:
+            add_lines(1, parse_lines(u"P1,1\nP9,1\nP2,0,2\n"))
+        self.assertEqual([number for number, error in raised.exception.errors], [2, 3, 3])
+        self.assertEqual(Quotation_Detail.query.count(), 0)
+        self.assertEqual(Quotation.query.get(1).q_amount, None)
+
+
+class TestDeletion(TestBase):
+
+    def setUp(self):
+        super(TestDeletion, self).setUp()
+        db.session.add(Customer(acc_code="AC1"))
+        db.session.add(Customer(acc_code="AC2"))
+        db.session.add(Contact(c_id=1, acc_code="AC1", f_name="Taro"))
+        db.session.add(Product(p_number="P1"))
+        db.session.add(Product(p_number="P2"))
+        for q_num, c_id in ((1, 1), (2, 2), (3, 2)):
+            db.session.add(Quotation(c_id=c_id, acc_code="AC{}".format(c_id), q_num=q_num))
+        db.session.commit()
+        for q_id in (1, 2, 3):
+            db.session.add(Quotation_Detail(q_id=q_id, p_id=1, q_num=q_id, p_num="P1", quantity=1))
+            db.session.add(Quotation_Detail(q_id=q_id, p_id=1, q_num=q_id, p_num="P1", quantity=2))
+            db.session.add(Opportunity(q_id=q_id, q_num=q_id, region="Asia", potential_money=10))
+        db.session.commit()
+
+    def test_quotations_are_deleted_with_set_based_statements(self):
+        """
+        Test that quotations go with their details and opportunities in
+        one DELETE per table and one transaction
+        """
+        statements = self.record_statements()
+        self.assertEqual(delete_quotations([2, 3, 99]), 2)
+        deletes = [s for s in statements if s.startswith('DELETE') and 'pipeline_rollups' not in s]
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(len([s for s in statements if s.startswith('UPDATE')]), 1)
+
+        self.assertEqual([q.q_id for q in Quotation.query], [1])
+        self.assertEqual(Quotation_Detail.query.count(), 2)
+        self.assertEqual(Opportunity.query.count(), 1)
+        self.assertEqual(PipelineRollup.query.one().opportunities, 1)
+        self.assertEqual(search_index.search(Quotation, "3"), [])
+
+    def test_customers_are_deleted_with_everything_they_own(self):
+        """
+        Test that a customer's contacts, quotations, details and
+        opportunities are deleted with it
+        """
+        self.assertEqual(delete_customers([1]), 1)
+        self.assertEqual([c.acc_code for c in Customer.query], ["AC2"])
+        self.assertEqual(Contact.query.count(), 0)
+        self.assertEqual(sorted(q.q_id for q in Quotation.query), [2, 3])
+        self.assertEqual(Quotation_Detail.query.count(), 4)
+        self.assertEqual(Opportunity.query.count(), 2)
+
+    def test_quoted_products_are_kept(self):
+        """
+        Test that products on quotation lines are not deleted
+        """
+        self.assertEqual(delete_products([1, 2]), (1, ["P1"]))
+        self.assertEqual([p.p_number for p in Product.query], ["P1"])
+
+
+class TestQueryPlan(TestBase):
+
+    def test_lookups_are_answered_through_indexes(self):
+        """
+        Test that none of the common lookups scans a whole table
+        """
+        for description, tables in check_indexes():
+            self.assertEqual(tables, [], description)
+
+    def test_full_scans_are_reported(self):
+        """
+        Test that a lookup without an index to use is reported
+        """
+        query = Contact.query.filter(Contact.acc_code == "AC1")
+        db.session.execute("DROP INDEX ix_contacts_account_code" +
+                           (" ON contacts" if db.engine.name == 'mysql' else ""))
+        self.assertEqual(full_scans(query), ["contacts"])
+
+
+class TestProfiling(TestBase):
+
+    def test_statement_shapes(self):
+        """
+        Test that statements differing only in their IN lists share a shape
+        """
+        self.assertEqual(statement_shape("SELECT a FROM t\n WHERE b IN (?, ?, ?)"),
+                         statement_shape("SELECT a FROM t WHERE b IN (?)"))
+        self.assertEqual(statement_shape("SELECT a FROM t WHERE b IN (%(b_1)s, %(b_2)s)"),
+                         "SELECT a FROM t WHERE b IN (?)")
+
+    def test_requests_are_profiled(self):
+        """
+        Test that a request's statements, rows and repeats are recorded
+        under its endpoint
+        """
+        for acc_code in ("AC1", "AC2", "AC3", "AC4", "AC5", "AC6"):
+            db.session.add(Customer(acc_code=acc_code))
+        db.session.commit()
+        db.session.remove()
+
+        def one_by_one():
+            return ",".join(Customer.query.get(c_id).acc_code for c_id in range(1, 7))
+        self.app.add_url_rule('/one_by_one', 'one_by_one', one_by_one)
+        query_profiler.reset()
+        self.assertEqual(self.client.get('/one_by_one').data, b"AC1,AC2,AC3,AC4,AC5,AC6")
+
+        stats = query_profiler.report()['endpoints']['one_by_one']
+        self.assertEqual(stats['statements']['count'], 1)
+        self.assertEqual(stats['statements']['max'], 6)
+        self.assertEqual(stats['rows']['max'], 6)
+        self.assertEqual([count for shape, count in stats['repeated']], [6])
+        self.assertIn('FROM customers', query_profiler.report()['statements'][0]['statement'])
+
+    def test_profiling_requires_login(self):
+        """
+        Test that the profiling report redirects to the login page when
+        not logged in
+        """
+        target_url = url_for('admin.profiling')
+        response = self.client.get(target_url)
+        self.assertRedirects(response, url_for('auth.login', next=target_url))
+
+
+class TestDatabase(TestBase):
+
+    def test_pool_stats(self):
+        """
+        Test that checkouts are counted for the primary and each replica,
+        and idle connections are pinged before they are used again
+        """
+        self.app.config.update(DATABASE_REPLICA_URIS=['sqlite://'], DATABASE_PRE_PING=0)
+        replica = db.replica_engines()[0]
+        for n in range(2):
+            replica.execute('SELECT 1')
+
+        primary, replica = db.pool_stats()
+        self.assertEqual((primary['name'], replica['name']), ('primary', 'replica 0'))
+        self.assertGreater(primary['checkouts'], 0)
+        self.assertEqual(replica['checkouts'], 2)
+        self.assertEqual(replica['checked_out'], 0)
+        self.assertEqual(replica['pings'], 1)
+
+    def test_metered_pool(self):
+        """
+        Test that a queue pool times its checkouts and counts timeouts
+        """
+        path = os.path.join(tempfile.mkdtemp(), 'pool.db')
+        engine = create_engine('sqlite:///' + path, poolclass=MeteredQueuePool,
+                               pool_size=1, max_overflow=0, pool_timeout=0.01)
+        engine.pool.stats = stats = PoolStats()
+        connection = engine.connect()
+        self.assertRaises(TimeoutError, engine.connect)
+        connection.close()
+        engine.dispose()
+        engine.connect().close()
+        self.assertEqual(stats.wait.count, 3)
+        self.assertEqual(stats.timeouts, 1)
+
+    def test_pools_require_login(self):
+        """
+        Test that the pool metrics redirect to the login page when not
+        logged in
+        """
+        target_url = url_for('admin.database_pools')
+        response = self.client.get(target_url)
+        self.assertRedirects(response, url_for('auth.login', next=target_url))
+
+
+class TestReplicas(TestBase):
+
+    def setUp(self):
+        super(TestReplicas, self).setUp()
+        # a SQLite file stands in for the replica, with rows of its own
+        path = os.path.join(tempfile.mkdtemp(), 'replica.db')
+        self.app.config.update(DATABASE_REPLICA_URIS=['sqlite:///' + path])
+        replica = db.replica_engines()[0]
+        Customer.__table__.create(replica)
+        replica.execute(Customer.__table__.insert().values(
+            {Customer.__mapper__.c.acc_code: u"REPLICA"}))
+        db.session.add(Customer(acc_code="PRIMARY"))
+        db.session.commit()
+
+        @read_only
+        def customers():
+            return ",".join(customer.acc_code for customer in Customer.query)
+
+        def add_customer():
+            db.session.add(Customer(acc_code="ADDED"))
+            db.session.commit()
+            return "added"
+
+        self.app.add_url_rule('/replica/customers', 'replica_customers', customers)
+        self.app.add_url_rule('/replica/customers/all', 'all_customers', lambda: customers())
+        self.app.add_url_rule('/replica/customers/add', 'add_replica_customer', add_customer,
+                              methods=['POST'])
+
+    def test_reads_go_to_replica(self):
+        """
+        Test that only GET requests to read_only views read from the replica
+        """
+        self.assertEqual(self.client.get('/replica/customers').data, b"REPLICA")
+        self.assertEqual(self.client.get('/replica/customers/all').data, b"PRIMARY")
+
+    def test_writes_pin_to_primary(self):
+        """
+        Test that an employee reads their own writes from the primary
+        """
+        self.assertEqual(self.client.post('/replica/customers/add').data, b"added")
+        self.assertEqual(self.client.get('/replica/customers').data, b"PRIMARY,ADDED")
+        self.assertEqual(self.app.test_client().get('/replica/customers').data, b"REPLICA")
+
+    def test_round_robin_and_health(self):
+        """
+        Test that replicas are taken in turn, skipping one failing its
+        health check until it is checked again
+        """
+        now = [0]
+        replicas = ReplicaSet(check_interval=10, clock=lambda: now[0])
+        directory = tempfile.mkdtemp()
+        first, second = [create_engine('sqlite:///' + os.path.join(directory, name))
+                         for name in ('first.db', 'second.db')]
+        down = create_engine('sqlite:///' + os.path.join(directory, 'missing', 'down.db'))
+        engines = [first, second, down]
+        self.assertEqual([replicas.pick(engines) for n in range(4)],
+                         [first, second, first, first])
+        self.assertIsNone(replicas.pick([down]))
+
+        os.mkdir(os.path.join(directory, 'missing'))
+        self.assertIsNone(replicas.pick([down]))
+        now[0] = 10
+        self.assertIs(replicas.pick([down]), down)
+
+
+class TestSeed(TestBase):
+
+    def test_seeded_data_is_consistent(self):
+        """
+        Test that the generated rows are scaled, reproducible and agree
+        with each other
+        """
+        counts = seed(scale=0.002)
+        self.assertEqual(counts['quotation_details'], 1000)
+        self.assertEqual(Quotation_Detail.query.count(), 1000)
+        self.assertEqual(Opportunity.query.count(), counts['opportunities'])
+        # the stored totals are those of the lines
+        self.assertEqual(reconcile(), 0)
+        mismatched = Contact.query.join(Customer, Customer.c_id == Contact.c_id) \
+            .filter(Customer.acc_code != Contact.acc_code).count()
+        self.assertEqual(mismatched, 0)
+        self.assertEqual(PipelineRollup.query.with_entities(
+            db.func.sum(PipelineRollup.opportunities)).scalar(), counts['opportunities'])
+        first = [(q.c_id, q.q_amount) for q in Quotation.query.order_by(Quotation.q_id).limit(5)]
+
+        db.drop_all()
+        db.create_all()
+        seed(scale=0.002)
+        self.assertEqual([(q.c_id, q.q_amount) for q in
+                          Quotation.query.order_by(Quotation.q_id).limit(5)], first)
+
+
+class TestDashboard(TestBase):
+
+    def setUp(self):
+        super(TestDashboard, self).setUp()
+        db.session.add(Customer(acc_code="AC1", comp_name="Acme"))
+        db.session.add(Customer(acc_code="AC2", comp_name="Bolt"))
+        db.session.add(Quotation(c_id=1, acc_code="AC1", q_num=1, q_amount=100))
+        db.session.add(Quotation(c_id=2, acc_code="AC2", q_num=2, q_amount=300))
+        db.session.add(Quotation_Detail(q_id=1, p_id=1, q_num=1, p_num="P1", quantity=5))
+        db.session.add(Quotation_Detail(q_id=2, p_id=2, q_num=2, p_num="P2", quantity=2))
+        db.session.add(Opportunity(q_id=2, q_num=2, sales_stage=5, actual_money=300))
+        db.session.commit()
+
+    def test_snapshot_is_served_until_a_write(self):
+        """
+        Test that the KPIs are computed once and recomputed after a commit
+        touching quotations
+        """
+        snapshot = dashboard_snapshot.get()
+        self.assertEqual(snapshot['open_quotations'], {'count': 1, 'value': 100})
+        self.assertEqual(snapshot['top_customers'], [("AC2", "Bolt", 300), ("AC1", "Acme", 100)])
+        self.assertEqual([row[:2] for row in snapshot['top_products']], [("P1", None), ("P2", None)])
+        self.assertEqual(snapshot['pipeline'], [(5, 1, 0.0, 0.0)])
+
+        statements = self.record_statements()
+        self.assertEqual(dashboard_snapshot.get(), snapshot)
+        self.assertEqual(statements, [])
+
+        db.session.add(Quotation(c_id=1, acc_code="AC1", q_num=3, q_amount=50))
+        db.session.commit()
+        self.assertEqual(dashboard_snapshot.get()['open_quotations'], {'count': 2, 'value': 150})
+
+    def test_only_kpi_changes_invalidate(self):
+        """
+        Test that changing what no KPI depends on keeps the snapshot
+        """
+        version = dashboard_snapshot.get()['version']
+        Customer.query.get(1).notes = "Not on the dashboard"
+        db.session.commit()
+        self.assertEqual(shared_cache.version('dashboard.writes'), version)
+        Customer.query.get(1).comp_name = "Acme Inc"
+        db.session.commit()
+        self.assertEqual(shared_cache.version('dashboard.writes'), version + 1)
+
+    def test_failed_refresh_can_be_retried(self):
+        """
+        Test that a refresh that fails does not keep others from running
+        """
+        shared_cache.set('dashboard', 'refreshing', True)
+        dashboard_snapshot.compute = lambda: 1 / 0
+        try:
+            self.assertRaises(ZeroDivisionError, dashboard_snapshot.refresh)
+        finally:
+            del dashboard_snapshot.compute
+        self.assertEqual(shared_cache.get('dashboard', 'refreshing'), None)
+
+    def test_background_refresh(self):
+        """
+        Test that with background refreshes the request does not wait for
+        the first snapshot
+        """
+        state = self.app.extensions['dashboard']
+        state['background'] = True
+        self.assertEqual(dashboard_snapshot.get(), None)
+        # the refresh thread holds the lock until it is done
+        with state['lock']:
+            self.assertEqual(dashboard_snapshot.get()['open_quotations']['count'], 1)
+
+
+class TestTotals(TestBase):
+
+    def setUp(self):
+        super(TestTotals, self).setUp()
+        db.session.add(Customer(acc_code="AC1"))
+        db.session.add(Product(p_number="P1"))
+        db.session.add(Quotation(c_id=1, acc_code="AC1", q_num=1))
+        db.session.commit()
+
+    def add_line(self, **values):
+        line = Quotation_Detail(q_id=1, p_id=1, q_num=1, p_num="P1", **values)
+        db.session.add(line)
+        apply_line_change(after=line_snapshot(line))
+        db.session.commit()
+        return line
+
+    def test_line_changes_update_totals(self):
+        """
+        Test that adding, editing and deleting lines keeps the totals right
+        """
+        first = self.add_line(quantity=3, q_price=10, discount=0.1, option=False)
+        second = self.add_line(quantity=2, q_price=10, discount=0, option=False)
+        quotation = Quotation.query.get(1)
+        self.assertEqual(quotation.q_amount, 47)
+        self.assertEqual(quotation.q_subtotal, 50)
+
+        before = line_snapshot(second)
+        second.option = True
+        apply_line_change(before, line_snapshot(second))
+        db.session.commit()
+        self.assertEqual(quotation.q_amount, 27)
+        self.assertEqual(quotation.q_optional, 20)
+
+        apply_line_change(before=line_snapshot(first))
+        db.session.delete(first)
+        db.session.commit()
+        self.assertEqual(quotation.q_amount, 0)
+        self.assertEqual(quotation.q_discount, 0)
+
+    def test_unset_option_left_out(self):
+        """
+        Test that a line whose option is unset counts towards no total
+        """
+        self.add_line(quantity=2, q_price=10, discount=0, option=False)
+        line = self.add_line(quantity=5, q_price=10, discount=0, option=True)
+        apply_line_change(before=line_snapshot(line))
+        # the model defaults it to False, so only older rows have none
+        Quotation_Detail.query.filter_by(quote_detail_id=line.quote_detail_id) \
+            .update({Quotation_Detail.option: None}, synchronize_session=False)
+        db.session.commit()
+        self.assertEqual(reconcile(), 0)
+        self.assertEqual(Quotation.query.get(1).q_amount, 20)
+        self.assertEqual(line_totals(5, 10, 0, None), (0, 0, 0))
+
+    def test_reconcile(self):
+        """
+        Test that reconcile repairs drifted totals and nothing else
+        """
+        self.add_line(quantity=4, q_price=5, discount=0.5, option=False)
+        self.assertEqual(reconcile(), 0)
+
+        Quotation.query.get(1).q_amount = 999
+        db.session.commit()
+        self.assertEqual([repair['q_amount'] for repair in drifted()], [10])
+        self.assertEqual(Quotation.query.get(1).q_amount, 999)
+        version = shared_cache.version('dashboard.writes')
+        self.assertEqual(reconcile(), 1)
+        self.assertEqual(Quotation.query.get(1).q_amount, 10)
+        self.assertEqual(shared_cache.version('dashboard.writes'), version + 1)
+
+
+class TestConcurrency(TestBase):
+
+    def setUp(self):
+        super(TestConcurrency, self).setUp()
+        db.session.add(Customer(acc_code="AC1"))
+        db.session.add(Product(p_number="P1"))
+        db.session.add(Quotation(c_id=1, acc_code="AC1", q_num=1))
+        db.session.commit()
+        line = Quotation_Detail(q_id=1, p_id=1, q_num=1, p_num="P1",
+                                quantity=2, q_price=10, discount=0, option=False)
+        db.session.add(line)
+        apply_line_change(after=line_snapshot(line))
+        db.session.commit()
+
+    def change_behind_session(self, model, **values):
+        # what a commit by another employee looks like to this session
+        table = model.__table__
+        db.session.execute(table.update().values(
+            dict([(table.c.Version, table.c.Version + 1)] +
+                 [(model.__mapper__.c[key], value) for key, value in values.items()])))
+
+    def test_versions(self):
+        """
+        Test that editing a row moves its version on, and moving a
+        quotation's totals for its lines does not
+        """
+        customer = Customer.query.get(1)
+        self.assertEqual(customer.version, 1)
+        customer.comp_name = "Renamed"
+        db.session.commit()
+        self.assertEqual(customer.version, 2)
+
+        quotation = Quotation.query.get(1)
+        self.assertEqual(quotation.q_amount, 20)
+        self.assertEqual(quotation.version, 1)
+
+    def test_stale_edit(self):
+        """
+        Test that a line edited by someone else since it was read is not
+        overwritten, and its quotation's totals are left as they were
+        """
+        line = Quotation_Detail.query.get(1)
+        before = line_snapshot(line)
+        self.change_behind_session(Quotation_Detail, quantity=5)
+        line.quantity = 3
+        with self.assertRaises(StaleDataError):
+            apply_line_change(before, line_snapshot(line))
+            db.session.commit()
+        db.session.rollback()
+        self.assertEqual(Quotation_Detail.query.get(1).quantity, 2)
+        self.assertEqual(Quotation.query.get(1).q_amount, 20)
+        self.assertEqual(drifted(), [])
+
+    def test_edit_opportunity_view(self):
+        """
+        Test that an edited opportunity keeps what was entered and moves
+        on to its next version
+        """
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        db.session.add(Opportunity(q_id=1, q_num=1, source_of_lead="Web"))
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['user_id'] = str(Employee.query.filter_by(username="admin").one().id)
+            session['_fresh'] = True
+
+        response = self.client.post(url_for('admin.edit_opportunity', id=1), data={
+            'q_num': 1, 'source_of_lead': "Trade show", 'sale_ref_fee': 5, 'competitors': 2,
+            'sales_stage': 1, 'close_date': '2018-01-02', 'probability': 0.5,
+            'potential_money': 100, 'probable_money': 50, 'actual_money': 0, 'revenue': 0,
+            'version': 1})
+        self.assertRedirects(response, url_for('admin.list_opportunities', page_num=1))
+        opportunity = Opportunity.query.get(1)
+        self.assertEqual((opportunity.source_of_lead, opportunity.version), ("Trade show", 2))
+
+    def test_check_version(self):
+        """
+        Test that a form filled from an older version is refused
+        """
+        quotation = Quotation.query.get(1)
+        check_version(quotation, '1')
+        check_version(quotation, None)
+        self.assertRaises(EditConflict, check_version, quotation, '2')
+        self.assertRaises(EditConflict, check_version, quotation, 'x')
+
+    def test_retry_on_conflict(self):
+        """
+        Test that a conflicting change is rolled back and done again, and
+        that the conflict is raised once the attempts run out
+        """
+        calls = []
+
+        def toggle():
+            calls.append(1)
+            line = Quotation_Detail.query.get(1)
+            before = line_snapshot(line)
+            line.option = not line.option
+            apply_line_change(before, line_snapshot(line))
+            if len(calls) == 1:
+                raise StaleDataError()
+
+        retry_on_conflict(toggle)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(Quotation.query.get(1).q_amount, 0)
+        self.assertEqual(Quotation.query.get(1).q_optional, 20)
+        self.assertEqual(drifted(), [])
+
+        def conflict():
+            calls.append(1)
+            raise StaleDataError()
+
+        del calls[:]
+        self.assertRaises(StaleDataError, retry_on_conflict, conflict, attempts=2)
+        self.assertEqual(len(calls), 2)
+
+
+class TestCloneQuotation(TestBase):
+
+    def setUp(self):
+        super(TestCloneQuotation, self).setUp()
+        db.session.add(Customer(acc_code="AC1"))
+        db.session.add(Product(p_number="P1", p_name="Product one"))
+        for q_num in (5, 9):
+            db.session.add(Quotation(c_id=1, acc_code="AC1", q_num=q_num, q_title="Quote {}".format(q_num),
+                                     q_amount=20, q_subtotal=20, q_discount=0, q_optional=0))
+        db.session.flush()
+        for q_id in (1, 2):
+            for quantity in (1, 3):
+                db.session.add(Quotation_Detail(q_id=q_id, p_id=1, q_num=0, p_num="P1", p_name="Old name",
+                                                quantity=quantity, q_price=5, discount=0, option=False))
+        db.session.commit()
+
+    def test_clone_copies_header_and_lines(self):
+        """
+        Test that a clone gets a new number and copies of every line
+        """
+        copy = clone_quotation(1)
+        self.assertEqual(copy.q_num, 10)
+        self.assertEqual((copy.q_title, copy.q_amount, copy.c_id), ("Quote 5", 20, 1))
+        lines = copy.quote_details.order_by(Quotation_Detail.quote_detail_id).all()
+        self.assertEqual([(line.quantity, line.q_num, line.p_name) for line in lines],
+                         [(1, 10, "Product one"), (3, 10, "Product one")])
+        self.assertEqual(Quotation.query.get(1).quote_details.count(), 2)
+        self.assertEqual(clone_quotation(99), None)
+
+    def test_clone_keeps_lines_of_deleted_products(self):
+        """
+        Test that lines whose product is gone are copied with their own
+        name and number
+        """
+        db.session.execute(Product.__table__.delete())
+        db.session.commit()
+        lines = clone_quotation(1).quote_details.all()
+        self.assertEqual([(line.p_num, line.p_name) for line in lines],
+                         [("P1", "Old name"), ("P1", "Old name")])
+
+    def test_clone_many(self):
+        """
+        Test that several quotations are cloned together, in order
+        """
+        copies = clone_quotations([2, 99, 1])
+        self.assertEqual([(copy.q_title, copy.q_num) for copy in copies],
+                         [("Quote 9", 10), ("Quote 5", 11)])
+        self.assertEqual(Quotation_Detail.query.count(), 8)
+        self.assertEqual(sorted(search_index.search(Quotation, "Quote 9")), [2, copies[0].q_id])
+
+    def test_copy_customer_quotations_view(self):
+        """
+        Test that a customer's quotations are only copied by a POST from a
+        logged in user, never by following a link
+        """
+        target_url = url_for('admin.copy_customer_quotations', id=1)
+        self.assertEqual(self.client.get(target_url).status_code, 405)
+        response = self.client.post(target_url)
+        self.assertRedirects(response, url_for('auth.login', next=target_url))
+        self.assertEqual(Quotation.query.count(), 2)
+
+
+class TestQuotationDocument(TestBase):
+
+    def setUp(self):
+        super(TestQuotationDocument, self).setUp()
+        db.session.add(Customer(acc_code="AC1"))
+        db.session.add(Contact(c_id=1, acc_code="AC1", f_name="Ann"))
+        db.session.add(Quotation(c_id=1, acc_code="AC1", q_num=1, contact_id=1))
+        for i in range(20):
+            db.session.add(Product(p_number="P{}".format(i)))
+            db.session.add(Quotation_Detail(q_id=1, p_id=i + 1, q_num=1, p_num="P{}".format(i),
+                                            quantity=2, q_price=5, discount=0.5,
+                                            option=i >= 18))
+        db.session.commit()
+        db.session.expunge_all()
+
+    def test_document_is_loaded_in_two_queries(self):
+        """
+        Test that the whole document costs two queries however many lines
+        """
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            document = load_quotation_document(1)
+            names = [detail.product.p_number for detail in document.details]
+            contact = document.contact.f_name
+            account = document.customer.acc_code
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(len(names), 20)
+        self.assertEqual((contact, account), ("Ann", "AC1"))
+        self.assertEqual((document.subtotal, document.total), (200, 100))
+        self.assertEqual(document.optional_total, 10)
+
+    def test_fingerprint_follows_changes(self):
+        """
+        Test that the fingerprint changes with the lines and products
+        """
+        fingerprint = document_fingerprint(1)
+        self.assertEqual(document_fingerprint(1), fingerprint)
+        Quotation_Detail.query.get(1).quantity = 3
+        db.session.commit()
+        changed = document_fingerprint(1)
+        self.assertNotEqual(changed, fingerprint)
+        db.session.execute(Product.__table__.update().values({Product.__mapper__.c.p_name: "New"}))
+        self.assertNotEqual(document_fingerprint(1), changed)
+        self.assertEqual(document_fingerprint(99), None)
+
+
+class TestPdfQueue(TestBase):
+
+    def submit(self, html):
+        rendered = []
+
+        def render():
+            rendered.append(html)
+            return html
+
+        return pdf_queue.submit(pdf_queue.key(html), render), rendered
+
+    def test_rendered_pdfs_are_cached_by_key(self):
+        """
+        Test that a document is rendered once and a new key gets a new file
+        """
+        key, rendered = self.submit(u"<p>Quotation 1</p>")
+        self.assertEqual(pdf_queue.status(key), 'ready')
+        with open(pdf_queue.path(key), 'rb') as f:
+            self.assertTrue(f.read().startswith(b'%PDF'))
+
+        os.utime(pdf_queue.path(key), (0, 0))
+        self.assertEqual(self.submit(u"<p>Quotation 1</p>"), (key, []))
+        self.assertEqual(os.path.getmtime(pdf_queue.path(key)), 0)
+
+        other, rendered = self.submit(u"<p>Quotation 1, revision 2</p>")
+        self.assertNotEqual(other, key)
+        self.assertEqual(pdf_queue.status(other), 'ready')
+        self.assertEqual(len(rendered), 1)
+
+    def test_eviction(self):
+        """
+        Test that PDFs past their age or beyond the most kept are evicted
+        """
+        old, rendered = self.submit(u"<p>Old</p>")
+        os.utime(pdf_queue.path(old), (0, 0))
+        keys = [self.submit(u"<p>{}</p>".format(n))[0] for n in range(3)]
+        for n, key in enumerate(keys):
+            os.utime(pdf_queue.path(key), (time.time() - 10 + n, time.time() - 10 + n))
+        self.app.extensions['pdf']['max_files'] = 2
+        pdf_queue.evict()
+        self.assertEqual([pdf_queue.status(key) for key in [old] + keys],
+                         ['missing', 'missing', 'ready', 'ready'])
+
+    def test_failed_render_is_not_left_pending(self):
+        """
+        Test that a document whose HTML fails to render is not marked as
+        pending, so that it is rendered again on the next request
+        """
+        key = pdf_queue.key(u"<p>Broken</p>")
+
+        def render():
+            raise ValueError("template error")
+
+        self.assertRaises(ValueError, pdf_queue.submit, key, render)
+        self.assertEqual(pdf_queue.status(key), 'missing')
+        self.assertEqual(pdf_queue.submit(key, lambda: u"<p>Broken</p>"), key)
+        self.assertEqual(pdf_queue.status(key), 'ready')
+
+    def test_bad_keys_are_rejected(self):
+        """
+        Test that cache keys cannot point outside the cache
+        """
+        self.assertRaises(ValueError, pdf_queue.path, "../../etc/passwd")
+
+
+class TestPricebook(TestBase):
+
+    def setUp(self):
+        super(TestPricebook, self).setUp()
+        db.session.add(Product(p_number="PB-1", p_name="Old name", unit_price=1.0))
+        db.session.commit()
+
+    def write_csv(self, text):
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return path
+
+    def import_csv(self, text, **kwargs):
+        return import_pricebook(self.write_csv(text), **kwargs)
+
+    def test_import_inserts_updates_and_rejects(self):
+        """
+        Test that new part numbers are added, known ones updated and bad
+        rows reported instead of stopping the import
+        """
+        summary = self.import_csv(
+            u"Part Number,ProductName,UnitPrice,Date Created,Product Note to show - Japanese\n"
+            u"PB-1,New name,2.5,2018-01-02,\u30c6\u30b9\u30c8\n"
+            u"PB-2,Second,abc,,\n"
+            u",No number,3,,\n"
+            u"PB-3,Third,3,,\n"
+            u"PB-4,Fourth,4,,\n"
+            u"PB-3,Third again,5,,\n",
+            batch_size=2, chunk_size=3)
+
+        self.assertEqual((summary.inserted, summary.updated), (2, 1))
+        self.assertEqual([(row, reason) for row, p_number, reason in summary.rejected],
+                         [(3, 'bad UnitPrice: not a number'), (4, 'missing Part Number'),
+                          (5, 'Part Number repeated further down')])
+
+        updated = Product.query.filter_by(p_number="PB-1").one()
+        self.assertEqual((updated.p_name, updated.unit_price), ("New name", 2.5))
+        self.assertEqual(updated.japanese_note, u"\u30c6\u30b9\u30c8")
+        self.assertEqual(Product.query.filter_by(p_number="PB-3").one().unit_price, 5)
+        self.assertEqual(search_index.search(Product, "Fourth"),
+                         [Product.query.filter_by(p_number="PB-4").one().p_id])
+
+    def test_repeated_part_number_keeps_last_row(self):
+        """
+        Test that a part number repeated within a chunk is loaded once
+        """
+        summary = self.import_csv(u"Part Number,UnitPrice\nPB-5,1\nPB-5,2\n")
+        self.assertEqual(summary.inserted, 1)
+        self.assertEqual(Product.query.filter_by(p_number="PB-5").one().unit_price, 2)
+        self.assertEqual(summary.rejected[0][0], 2)
+
+    def test_repeated_part_number_across_chunks(self):
+        """
+        Test that a part number repeated in a later chunk is loaded once,
+        from the last row, in an import and in a dry run
+        """
+        text = u"Part Number,UnitPrice\nPB-5,1\nPB-6,1\nPB-5,2\n"
+        summary = self.import_csv(text, chunk_size=2)
+        self.assertEqual((summary.inserted, summary.updated), (2, 0))
+        self.assertEqual(summary.rejected, [(2, "PB-5", 'Part Number repeated further down')])
+        self.assertEqual(summary.written, ["PB-6", "PB-5"])
+        self.assertEqual(Product.query.filter_by(p_number="PB-5").one().unit_price, 2)
+
+        db.session.execute(Product.__table__.delete().where(Product.__table__.c['Part Number'] != "PB-1"))
+        db.session.commit()
+        report = diff_pricebook(self.write_csv(text), chunk_size=2)
+        self.assertEqual(report.inserts, ["PB-6", "PB-5"])
+        self.assertEqual([row for row, p_number, reason in report.rejected], [2])
+
+    def test_blank_cells_keep_current_values(self):
+        """
+        Test that a blank cell leaves the product's field as it is, in an
+        import and in a dry run
+        """
+        path = self.write_csv(u"Part Number,ProductName,UnitPrice\nPB-1,,1.5\n")
+        report = diff_pricebook(path)
+        self.assertEqual(report.updates, [("PB-1", {'unit_price': (1.0, 1.5)})])
+        summary = import_pricebook(path)
+        self.assertEqual(summary.updated, 1)
+        product = Product.query.filter_by(p_number="PB-1").one()
+        self.assertEqual((product.p_name, product.unit_price), ("Old name", 1.5))
+
+    def test_refused_batch_is_retried_row_by_row(self):
+        """
+        Test that only the rows the database refuses are rejected
+        """
+        insert = db.session.bulk_insert_mappings
+
+        def refuse(mapper, mappings):
+            if any(mapping['p_number'] == "PB-BAD" for mapping in mappings):
+                raise IntegrityError('INSERT', {}, Exception('refused'))
+            return insert(mapper, mappings)
+
+        db.session.bulk_insert_mappings = refuse
+        try:
+            summary = self.import_csv(u"Part Number,UnitPrice\nPB-7,1\nPB-BAD,1\nPB-8,1\n")
+        finally:
+            del db.session.bulk_insert_mappings
+        self.assertEqual(summary.inserted, 2)
+        self.assertEqual([(row, p_number) for row, p_number, reason in summary.rejected],
+                         [(3, "PB-BAD")])
+
+    def test_dry_run_reports_changes_without_writing(self):
+        """
+        Test that a dry run lists new part numbers and changed fields only
+        """
+        db.session.add(Product(p_number="PB-2", unit_price=2.0, p_status="Active"))
+        db.session.commit()
+        path = self.write_csv(u"Part Number,ProductName,UnitPrice,Product Status\n"
+                              u"PB-1,Renamed,1.5,\n"
+                              u"PB-2,,2.0,Active\n"
+                              u"PB-3,New,3,Active\n")
+
+        report = diff_pricebook(path)
+        self.assertEqual(report.inserts, ["PB-3"])
+        self.assertEqual(report.updates, [("PB-1", {'unit_price': (1.0, 1.5)})])
+        self.assertEqual(report.unchanged, 1)
+        self.assertEqual(list(report.rows())[1], ("PB-1", 'update', 'unit_price', 1.0, 1.5, 0.5))
+        self.assertEqual(Product.query.filter_by(p_number="PB-1").one().unit_price, 1.0)
+        self.assertEqual(Product.query.count(), 2)
+
 
 class TestErrorPages(TestBase):
 